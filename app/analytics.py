@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user time series of generations for the analytics dashboard.
+
+Generations are bucketed by day, week (starting on Monday) or month in SQL,
+per tariff, over the (user_id, created_at) index. A user's series is cached
+in this process and refreshed incrementally: generations are only ever
+added to the newest bucket, so a refresh recomputes that bucket (and any
+newer one) and keeps the older buckets as they are.
+
+An entry is refreshed on the next read after a generation of the user was
+stored by this process, or after ANALYTICS_CACHE_MAX_AGE seconds to pick up
+generations stored by other workers.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Date, cast, func
+from sqlalchemy.orm import Session
+
+from .models import Generation
+
+ANALYTICS_CACHE_SIZE = int(os.getenv('ANALYTICS_CACHE_SIZE', '1024'))
+ANALYTICS_CACHE_MAX_AGE = float(os.getenv('ANALYTICS_CACHE_MAX_AGE', '60'))
+
+PERIODS = ("day", "week", "month")
+
+# bucket start, tariff -> generations, cost_minor, tokens, processing_time
+Series = Dict[Tuple[date, str], Tuple[int, int, int, float]]
+
+def _bucket(db: Session, period: str):
+    """SQL expression of the first day of the period a generation falls in"""
+    if db.get_bind().dialect.name == 'postgresql':
+        return cast(func.date_trunc(period, Generation.created_at), Date)
+    if period == "day":
+        return func.date(Generation.created_at)
+    if period == "week":
+        return func.date(Generation.created_at, '-6 days', 'weekday 1')
+    return func.date(Generation.created_at, 'start of month')
+
+def _as_date(value) -> date:
+    # SQLite returns the date() of a column as text
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def compute(db: Session, user_id: int, period: str, since: Optional[date] = None) -> Series:
+    """Aggregate the user's generations per bucket and tariff, from the bucket starting at ``since`` on"""
+    bucket = _bucket(db, period).label("bucket")
+    query = db.query(
+        bucket,
+        Generation.tariff,
+        func.count(Generation.id),
+        func.coalesce(func.sum(Generation.cost_minor), 0),
+        func.coalesce(func.sum(Generation.tokens_used), 0),
+        func.coalesce(func.sum(Generation.processing_time), 0)
+    ).filter(Generation.user_id == user_id)
+    if since is not None:
+        # A second of slack: SQLite compares timestamps as text, and one
+        # stored without fractional seconds sorts before the bound's
+        query = query.filter(Generation.created_at >= datetime.combine(since, datetime.min.time()) - timedelta(seconds=1))
+    series = {}
+    for start, tariff, count, cost_minor, tokens, processing_time in query.group_by(bucket, Generation.tariff):
+        start = _as_date(start)
+        if since is None or start >= since:
+            series[(start, tariff)] = (count, cost_minor, tokens, processing_time)
+    return series
+
+class SeriesCache:
+    """LRU of per-user series with the newest bucket refreshed on demand"""
+
+    def __init__(self, max_size: int, max_age: float):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries = OrderedDict()  # (user_id, period) -> [series, refreshed_at, stale]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        self.misses = 0
+
+    def get(self, db: Session, user_id: int, period: str) -> Series:
+        key = (user_id, period)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                series, refreshed_at, stale = entry
+                if not stale and time.monotonic() - refreshed_at < self.max_age:
+                    self.hits += 1
+                    return series
+                # Cleared before querying so a generation stored meanwhile marks it again
+                entry[2] = False
+
+        started = time.monotonic()
+        if entry is None or not series:
+            series = compute(db, user_id, period)
+            counter = "misses"
+        else:
+            newest = max(start for start, _ in series)
+            series = {k: v for k, v in series.items() if k[0] < newest}
+            series.update(compute(db, user_id, period, since=newest))
+            counter = "refreshes"
+
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            current = self._entries.get(key)
+            self._entries[key] = [series, started, current[2] if current is not None else False]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return series
+
+    def mark_stale(self, user_id: int):
+        with self._lock:
+            for period in PERIODS:
+                entry = self._entries.get((user_id, period))
+                if entry is not None:
+                    entry[2] = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "refreshes": self.refreshes, "misses": self.misses}
+
+series_cache = SeriesCache(ANALYTICS_CACHE_SIZE, ANALYTICS_CACHE_MAX_AGE)
+
+def note_generation(user_id: int):
+    """Called once a generation of the user is committed"""
+    series_cache.mark_stale(user_id)
+
+def get_series(db: Session, user_id: int, period: str, limit: int) -> List[dict]:
+    """The user's ``limit`` most recent buckets with generations, oldest first"""
+    series = series_cache.get(db, user_id, period)
+    buckets = {}
+    for (start, tariff), values in series.items():
+        buckets.setdefault(start, {})[tariff] = values
+    return [{"start": start, "by_tariff": buckets[start]} for start in sorted(buckets)[-limit:]]
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import jwt
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, make_transient_to_detached
+from starlette.concurrency import run_in_threadpool
 from .models import User
-from .database import SessionLocal
+from .database import get_db
 from .schemas import Token
 
 # JWT Configuration
@@ -14,8 +21,23 @@ SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified principal cache
+PRINCIPAL_CACHE_TTL = float(os.getenv('PRINCIPAL_CACHE_TTL', '30'))
+PRINCIPAL_CACHE_SIZE = int(os.getenv('PRINCIPAL_CACHE_SIZE', '10000'))
+
+# Users allowed to read the operational endpoints (queues, hosts, cache samples)
+OPERATOR_EMAILS = {e.strip().lower() for e in os.getenv('OPERATOR_EMAILS', '').split(',') if e.strip()}
+
+# Password hashing
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt is deliberately slow and CPU bound; it runs on a small dedicated pool
+# so login bursts neither stall the event loop nor exhaust the shared threadpool
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -23,17 +45,37 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, get_password_hash, password)
+
 def get_user(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
 
-def authenticate_user(db: Session, email: str, password: str):
+def _get_login_user(db: Session, email: str):
     user = get_user(db, email)
+    if user is not None:
+        # Detached, the loaded row stays readable after the commit without a query
+        db.expunge(user)
+    # End the read transaction so the pooled connection is not held while bcrypt runs
+    db.commit()
+    return user
+
+async def authenticate_user(db: Session, email: str, password: str):
+    user = await run_in_threadpool(_get_login_user, db, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
+def shutdown():
+    _hash_executor.shutdown(wait=False)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -41,7 +83,70 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(lambda: SessionLocal())):
+class PrincipalCache:
+    """
+    Short-lived cache of verified tokens and the identity they resolve to.
+
+    A hit skips both the JWT verification and the user lookup. Only the
+    IDENTITY_COLUMNS are kept: the balance may change in any worker, so it
+    is loaded from the database when a handler reads it. Entries are dropped
+    after PRINCIPAL_CACHE_TTL seconds or when the token expires.
+    """
+    IDENTITY_COLUMNS = ("id", "email", "hashed_password")
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, values = entry
+            if expires_at < time.time():
+                del self._entries[token]
+                return None
+            return values
+
+    def set(self, token: str, token_expiry: float, user: User):
+        values = {key: getattr(user, key) for key in self.IDENTITY_COLUMNS}
+        expires_at = min(time.time() + self.ttl, token_expiry)
+        with self._lock:
+            self._entries[token] = (expires_at, values)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL, PRINCIPAL_CACHE_SIZE)
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    return resolve_token(db, token)
+
+async def get_current_operator(current_user: User = Depends(get_current_user)):
+    """The current user if listed in OPERATOR_EMAILS; 403 for everyone else"""
+    if current_user.email.lower() not in OPERATOR_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operator access required")
+    return current_user
+
+def resolve_token(db: Session, token: str) -> User:
+    """
+    Return the user a bearer token belongs to.
+
+    Raises:
+        HTTPException: 401 if the token is invalid or the user is gone
+    """
+    cached = principal_cache.get(token)
+    if cached is not None:
+        # Attach the cached identity to this request's session without
+        # querying it; the other columns are expired and load on first access
+        user = User(**cached)
+        make_transient_to_detached(user)
+        db.add(user)
+        return user
+    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -58,4 +163,5 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     user = get_user(db, email)
     if not user:
         raise credentials_exception
-    return user
\ No newline at end of file
+    principal_cache.set(token, payload["exp"], user)
+    return user
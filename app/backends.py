@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of Ollama hosts.
+
+Every host gets its own pooled client. A background task checks each host
+with /api/tags and remembers which models it serves. Requests for a model
+go to the healthy host with the fewest outstanding requests for that model.
+On a connection error the host is marked down and the request is retried
+on the next best host.
+
+Models can be pinned to a subset of hosts, e.g. the 12B model only on the
+machines with enough memory.
+
+The ollama library is imported when the first client is built rather than
+with this module; warm-up imports it off the event loop (see
+import_client_library) so workers load it once, before serving traffic.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import httpx
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HOST = os.getenv('OLLAMA_HOST', 'http://localhost:11434')
+# Comma separated list of hosts; OLLAMA_HOST is used when unset
+OLLAMA_HOSTS = [h.strip() for h in os.getenv('OLLAMA_HOSTS', OLLAMA_HOST).split(',') if h.strip()]
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', '100'))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv('OLLAMA_KEEPALIVE_EXPIRY', '60'))
+# Pin models to hosts: "gemma3:12b=http://big-1:11434|http://big-2:11434,..."
+OLLAMA_MODEL_HOSTS = os.getenv('OLLAMA_MODEL_HOSTS', '')
+BACKEND_HEALTH_INTERVAL = float(os.getenv('BACKEND_HEALTH_INTERVAL', '10'))
+# Other hosts tried after a connection error
+BACKEND_RETRIES = int(os.getenv('BACKEND_RETRIES', '2'))
+
+# Errors that mean the host is unreachable rather than the request being bad.
+# The ollama client turns connection failures into ConnectionError.
+CONNECTION_ERRORS = (ConnectionError, httpx.TransportError)
+
+class NoBackendError(Exception):
+    """Raised when no healthy host can serve a model"""
+
+def _parse_pins(raw: str) -> Dict[str, Set[str]]:
+    pins = {}
+    for part in filter(None, (p.strip() for p in raw.split(','))):
+        model, _, hosts = part.partition('=')
+        pins[model.strip()] = {h.strip() for h in hosts.split('|') if h.strip()}
+    return pins
+
+class Backend:
+    """One Ollama host and what the pool knows about it"""
+
+    def __init__(self, host: str):
+        self.host = host
+        self._client = None
+        self.healthy = True
+        # Models reported by /api/tags; None until the first successful check
+        self.models: Optional[Set[str]] = None
+        self.outstanding: Dict[str, int] = {}
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_check: Optional[float] = None
+
+    @property
+    def client(self):
+        # One long-lived client per host: its httpx pool keeps connections
+        # alive between requests instead of reconnecting for every generation.
+        if self._client is None:
+            import ollama
+
+            self._client = ollama.AsyncClient(
+                host=self.host,
+                limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_MAX_CONNECTIONS,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._client
+
+    @property
+    def total_outstanding(self) -> int:
+        return sum(self.outstanding.values())
+
+    def serves(self, model: str) -> bool:
+        # Ollama lists untagged pulls (e.g. embedding models) as name:latest
+        return self.models is None or model in self.models or f"{model}:latest" in self.models
+
+    async def check(self):
+        try:
+            response = await self.client.list()
+        except Exception as e:
+            self.mark_down(e)
+        else:
+            if not self.healthy:
+                logger.info("Backend is back up", extra={"host": self.host})
+            self.healthy = True
+            self.models = {m.model for m in response.models}
+        self.last_check = time.time()
+
+    def mark_down(self, error: Exception):
+        if self.healthy:
+            logger.warning("Backend is down", extra={"host": self.host, "error": str(error)})
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(error)
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "models": sorted(self.models) if self.models is not None else None,
+            "outstanding": {m: n for m, n in self.outstanding.items() if n},
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_check": self.last_check
+        }
+
+class BackendPool:
+    def __init__(self, hosts: List[str], pins: Dict[str, Set[str]]):
+        self.backends = [Backend(host) for host in hosts]
+        self.pins = pins
+        self.failovers = 0
+        self._health_task = None
+
+    def hosts_for(self, model: str) -> List[Backend]:
+        """Hosts a model may run on, healthy or not"""
+        pinned = self.pins.get(model)
+        return [b for b in self.backends if pinned is None or b.host in pinned]
+
+    def choose(self, model: str, exclude: Set[str] = frozenset(), prefer: Callable[[Backend], bool] = None) -> Backend:
+        """
+        Pick the healthy host with the fewest outstanding requests for the model.
+
+        Ties go to hosts ``prefer`` returns True for (e.g. the model is
+        already loaded there), then to the least busy host overall. When
+        every allowed host is marked down they are tried anyway, so a
+        single-host setup does not refuse work until the next health check.
+
+        Raises:
+            NoBackendError: If no host is left to serve the model
+        """
+        allowed = [b for b in self.hosts_for(model) if b.serves(model) and b.host not in exclude]
+        candidates = [b for b in allowed if b.healthy] or allowed
+        if not candidates:
+            raise NoBackendError(f"No backend left to serve {model}")
+        random.shuffle(candidates)
+        return min(candidates, key=lambda b: (
+            b.outstanding.get(model, 0),
+            not prefer(b) if prefer else False,
+            b.total_outstanding
+        ))
+
+    @asynccontextmanager
+    async def lease(self, backend: Backend, model: str):
+        """Count a request against the host for the duration of the block"""
+        backend.outstanding[model] = backend.outstanding.get(model, 0) + 1
+        try:
+            yield backend
+        finally:
+            backend.outstanding[model] -= 1
+
+    def failover(self, backend: Backend, model: str, error: Exception, tried: Set[str]) -> bool:
+        """Mark the host down after a connection error; True if another host may be tried"""
+        backend.mark_down(error)
+        tried.add(backend.host)
+        remaining = [b for b in self.hosts_for(model) if b.serves(model) and b.host not in tried]
+        if not remaining or len(tried) > BACKEND_RETRIES:
+            return False
+        self.failovers += 1
+        backend_failovers.inc(host=backend.host)
+        return True
+
+    async def call(self, model: str, func: Callable[[Backend], Awaitable], prefer: Callable[[Backend], bool] = None):
+        """
+        Run ``func`` against the best host, failing over on connection errors.
+
+        Raises:
+            NoBackendError: If no host is left to try
+        """
+        tried = set()
+        while True:
+            backend = self.choose(model, tried, prefer)
+            try:
+                async with self.lease(backend, model):
+                    return await func(backend)
+            except CONNECTION_ERRORS as e:
+                if not self.failover(backend, model, e, tried):
+                    raise
+
+    async def check_all(self):
+        await asyncio.gather(*[b.check() for b in self.backends])
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+            await self.check_all()
+
+    def start(self):
+        """Begin the periodic health checks, after the first one done by warm-up"""
+        if self._health_task is None:
+            self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for backend in self.backends:
+            if backend._client is not None:
+                await backend._client.close()
+
+    def stats(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "pins": {model: sorted(hosts) for model, hosts in self.pins.items()},
+            "hosts": {b.host: b.stats() for b in self.backends}
+        }
+
+async def import_client_library():
+    """Import ollama in a worker thread, so the first client is not built on a cold import"""
+    await asyncio.to_thread(importlib.import_module, 'ollama')
+
+pool = BackendPool(OLLAMA_HOSTS, _parse_pins(OLLAMA_MODEL_HOSTS))
+
+backend_failovers = metrics.Counter(
+    "backend_failovers_total", "Requests retried on another host after a connection error", ("host",)
+)
+metrics.Gauge(
+    "backend_up", "Whether the last health check of the host succeeded", ("host",),
+    lambda: {(b.host,): int(b.healthy) for b in pool.backends}
+)
+metrics.Gauge(
+    "backend_outstanding", "Requests in flight per host and model", ("host", "model"),
+    lambda: {(b.host, m): n for b in pool.backends for m, n in list(b.outstanding.items())}
+)
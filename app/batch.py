@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk generation jobs.
+
+A job is created from an uploaded JSONL or CSV catalogue. The cost of every
+item is reserved up front; each finished item captures its share of the
+reservation and whatever is left (failed or cancelled items) is released
+when the job ends.
+
+Items are processed by a small pool of workers per job that go through the
+scheduler as background work, so a job keeps the model busy without
+crowding out interactive requests.
+
+Like async generation jobs (app/jobs.py), batch jobs and their items are
+claimed with a conditional update that takes a JOB_LEASE lease, which the
+owning process keeps extending. Only the owner of a job claims its items
+and finishes it; another process takes a job over once its lease has run
+out, and only reclaims items whose own lease has run out, so an item is
+never generated twice.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import analytics
+from . import ledger
+from . import metrics
+from . import ml_utils
+from . import ratelimit
+from . import rollups
+from . import scheduler
+from . import semantic_cache
+from .database import SessionLocal
+from .jobs import JOB_LEASE
+from .models import BalanceHistory, BatchItem, BatchJob, Generation, Tariff, to_minor
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '5000'))
+BATCH_MAX_PROMPT_LENGTH = int(os.getenv('BATCH_MAX_PROMPT_LENGTH', '4000'))
+# Workers per job; defaults to the scheduler concurrency of the job's model
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '0'))
+BATCH_POLL_INTERVAL = float(os.getenv('BATCH_POLL_INTERVAL', '1.0'))
+
+FINISHED_ITEM_STATES = ('done', 'failed')
+
+batch_items = metrics.Counter(
+    "batch_items_total", "Processed batch items by outcome", ("tariff", "status")
+)
+
+class BatchInputError(ValueError):
+    """Raised when an uploaded catalogue cannot be turned into prompts"""
+
+def _spec_to_prompt(spec) -> str:
+    """Use a ``prompt`` field as is, otherwise list the spec as ``key: value`` lines"""
+    if isinstance(spec, str):
+        return spec.strip()
+    if not isinstance(spec, dict):
+        raise BatchInputError("Each item must be a string or an object")
+    if spec.get('prompt'):
+        return str(spec['prompt']).strip()
+    return "\n".join(f"{key}: {value}" for key, value in spec.items() if value not in (None, ''))
+
+def parse_items(content: bytes, filename: str) -> List[str]:
+    """
+    Turn an uploaded JSONL or CSV catalogue into prompts.
+
+    JSONL lines are strings or objects; CSV rows are read with their header.
+    Objects with a ``prompt`` field use it, other objects are rendered as
+    one ``key: value`` line per field.
+
+    Raises:
+        BatchInputError: If the file is malformed, empty or too large
+    """
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise BatchInputError("File must be UTF-8 encoded")
+
+    if filename.lower().endswith('.csv'):
+        reader = csv.DictReader(io.StringIO(text))
+        specs = [(reader.line_num, row) for row in reader]
+    else:
+        specs = []
+        for line_num, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                specs.append((line_num, json.loads(line)))
+            except json.JSONDecodeError as e:
+                raise BatchInputError(f"Line {line_num}: invalid JSON ({e.msg})")
+
+    if not specs:
+        raise BatchInputError("File contains no items")
+    if len(specs) > BATCH_MAX_ITEMS:
+        raise BatchInputError(f"A batch may contain at most {BATCH_MAX_ITEMS} items")
+
+    prompts = []
+    for line_num, spec in specs:
+        try:
+            prompt = _spec_to_prompt(spec)
+        except BatchInputError as e:
+            raise BatchInputError(f"Line {line_num}: {e}")
+        if not prompt:
+            raise BatchInputError(f"Line {line_num}: empty item")
+        if len(prompt) > BATCH_MAX_PROMPT_LENGTH:
+            raise BatchInputError(f"Line {line_num}: item is longer than {BATCH_MAX_PROMPT_LENGTH} characters")
+        prompts.append(prompt)
+    return prompts
+
+def create_job(db: Session, user_id: int, tariff: str, prompts: List[str], use_cache: bool = True) -> BatchJob:
+    """
+    Reserve the cost of every item and store the job.
+
+    Raises:
+        ledger.InsufficientFundsError: If the balance does not cover the batch
+    """
+    item_cost_minor = to_minor(Tariff.get_cost(tariff))
+    reservation = ledger.reserve(
+        db, user_id, item_cost_minor * len(prompts),
+        f'Batch of {len(prompts)} generations using {tariff} model'
+    )
+    try:
+        job = BatchJob(
+            user_id=user_id,
+            tariff=tariff,
+            total_items=len(prompts),
+            item_cost_minor=item_cost_minor,
+            reservation_id=reservation.id,
+            use_cache=use_cache
+        )
+        db.add(job)
+        db.flush()
+        db.execute(BatchItem.__table__.insert(), [
+            {"job_id": job.id, "position": position, "prompt": prompt, "status": 'pending'}
+            for position, prompt in enumerate(prompts)
+        ])
+        db.commit()
+    except Exception:
+        db.rollback()
+        ledger.release(db, reservation, "batch not created")
+        raise
+    return job
+
+def _claimable_item(now: float):
+    return or_(
+        BatchItem.status == 'pending',
+        and_(BatchItem.status == 'running', BatchItem.lease_expires < now)
+    )
+
+def _claim_item(db: Session, job_id: int) -> Optional[Tuple[int, str]]:
+    """Lease the next pending item of a running job, or one whose worker lost its lease; returns its id and prompt"""
+    while True:
+        now = time.time()
+        row = db.query(BatchItem.id, BatchItem.prompt)\
+            .join(BatchJob, BatchJob.id == BatchItem.job_id)\
+            .filter(BatchItem.job_id == job_id, _claimable_item(now), BatchJob.status == 'running')\
+            .order_by(BatchItem.id)\
+            .first()
+        if row is None:
+            db.rollback()
+            return None
+        claimed = db.query(BatchItem)\
+            .filter(BatchItem.id == row.id, _claimable_item(now))\
+            .update({BatchItem.status: 'running', BatchItem.lease_expires: now + JOB_LEASE}, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return row.id, row.prompt
+
+def _leased_items(db: Session, job_id: int) -> bool:
+    """Whether a running job has items leased by another process"""
+    leased = db.query(BatchItem.id)\
+        .join(BatchJob, BatchJob.id == BatchItem.job_id)\
+        .filter(BatchItem.job_id == job_id, BatchItem.status == 'running', BatchJob.status == 'running')\
+        .first()
+    db.rollback()
+    return leased is not None
+
+def _store_result(db: Session, job: BatchJob, item_id: int, prompt: str, text: str, usage: Optional[ml_utils.Usage], cost_minor: int, processing_time: float) -> int:
+    """Store the item's Generation and capture its cost in one transaction; returns the generation id"""
+    columns = ml_utils.usage_columns(usage)
+    # Cache hits and per-token tariffs may cost less than the reserved item
+    # price; the difference is released with the rest of the hold when the
+    # job finishes
+    cost_minor = min(job.item_cost_minor, cost_minor)
+    rollups.record_generation(db, job.user_id, job.tariff, columns["tokens_used"], cost_minor, processing_time, usage)
+    generation = Generation(
+        user_id=job.user_id,
+        prompt=prompt,
+        result=text,
+        tariff=job.tariff,
+        cost_minor=cost_minor,
+        processing_time=processing_time,
+        **columns
+    )
+    db.add(generation)
+    db.flush()
+    db.query(BatchItem).filter(BatchItem.id == item_id).update({
+        BatchItem.status: 'done',
+        BatchItem.generation_id: generation.id
+    }, synchronize_session=False)
+    db.query(BatchJob).filter(BatchJob.id == job.id).update(
+        {BatchJob.completed_items: BatchJob.completed_items + 1},
+        synchronize_session=False
+    )
+    ledger.capture(db, db.get(BalanceHistory, job.reservation_id), cost_minor, release_rest=False)
+    analytics.note_generation(job.user_id)
+    return generation.id
+
+def _fail_item(db: Session, job: BatchJob, item_id: int, error: str):
+    db.query(BatchItem).filter(BatchItem.id == item_id).update({
+        BatchItem.status: 'failed',
+        BatchItem.error: error[:500]
+    }, synchronize_session=False)
+    db.query(BatchJob).filter(BatchJob.id == job.id).update(
+        {BatchJob.failed_items: BatchJob.failed_items + 1},
+        synchronize_session=False
+    )
+    db.commit()
+
+def _requeue_item(db: Session, item_id: int):
+    db.query(BatchItem).filter(BatchItem.id == item_id, BatchItem.status == 'running')\
+        .update({BatchItem.status: 'pending', BatchItem.lease_expires: None}, synchronize_session=False)
+    db.commit()
+
+async def _process_item(db: Session, job: BatchJob, item_id: int, prompt: str):
+    start = time.perf_counter()
+    cost = job.item_cost
+    text = await semantic_cache.cached_result(prompt, job.tariff) if job.use_cache else None
+    usage = None
+    if text is not None:
+        cost = ml_utils.cache_hit_cost(cost)
+    else:
+        await ratelimit.limiter.wait_for_slot(job.user_id)
+        try:
+            async with scheduler.admit(job.tariff, background=True, user_id=job.user_id):
+                completion = await ml_utils.generate_text(prompt, job.tariff)
+        finally:
+            await ratelimit.limiter.release(job.user_id)
+        text, usage = completion.text, completion.usage
+        cost = ml_utils.usage_cost(job.tariff, cost, usage)
+        await ml_utils.generation_cache.set(prompt, job.tariff, text)
+    generation_id = await run_in_threadpool(_store_result, db, job, item_id, prompt, text, usage, to_minor(cost), time.perf_counter() - start)
+    if usage is not None and job.use_cache:
+        await semantic_cache.cache.add(prompt, job.tariff, generation_id)
+
+async def _worker(job: BatchJob):
+    db = SessionLocal()
+    try:
+        while True:
+            claimed = await run_in_threadpool(_claim_item, db, job.id)
+            if claimed is None:
+                return
+            item_id, prompt = claimed
+            _owned_items.add(item_id)
+            try:
+                await _process_item(db, job, item_id, prompt)
+                batch_items.inc(tariff=job.tariff, status='done')
+            except asyncio.CancelledError:
+                # Shutting down: leave the item for the next run of the job
+                await asyncio.shield(run_in_threadpool(_requeue_item, db, item_id))
+                raise
+            except Exception as e:
+                await run_in_threadpool(db.rollback)
+                logger.warning("Batch item failed", extra={"job_id": job.id, "item_id": item_id, "error": str(e)})
+                await run_in_threadpool(_fail_item, db, job, item_id, str(e))
+                batch_items.inc(tariff=job.tariff, status='failed')
+            finally:
+                _owned_items.discard(item_id)
+    finally:
+        db.close()
+
+def _claim_job(db: Session, job_id: int) -> bool:
+    """Lease an unfinished job that no live process holds; a queued job starts running"""
+    now = time.time()
+    claimed = db.query(BatchJob)\
+        .filter(
+            BatchJob.id == job_id,
+            BatchJob.finished_at.is_(None),
+            or_(BatchJob.lease_expires.is_(None), BatchJob.lease_expires < now)
+        )\
+        .update({
+            BatchJob.lease_expires: now + JOB_LEASE,
+            BatchJob.status: case((BatchJob.status == 'queued', 'running'), else_=BatchJob.status)
+        }, synchronize_session=False)
+    db.commit()
+    return bool(claimed)
+
+def _detached_job(db: Session, job_id: int) -> BatchJob:
+    job = db.get(BatchJob, job_id)
+    db.expunge(job)
+    return job
+
+def _release_job(db: Session, job_id: int):
+    """Give up the lease of a job this process stops running, so another process can take it over at once"""
+    db.query(BatchJob).filter(BatchJob.id == job_id, BatchJob.finished_at.is_(None))\
+        .update({BatchJob.lease_expires: None}, synchronize_session=False)
+    db.commit()
+
+def _finish_job(db: Session, job_id: int):
+    """
+    Record the final state and release what is still reserved; runs once
+    per job, in the process holding its lease
+    """
+    job = db.get(BatchJob, job_id)
+    status = job.status
+    if status in ('queued', 'running'):
+        status = 'completed' if job.completed_items else 'failed'
+    updated = db.query(BatchJob)\
+        .filter(BatchJob.id == job_id, BatchJob.finished_at.is_(None))\
+        .update({BatchJob.status: status, BatchJob.finished_at: datetime.now()}, synchronize_session=False)
+    db.commit()
+    if not updated:
+        return
+    reservation = db.get(BalanceHistory, job.reservation_id)
+    if reservation is not None and reservation.operation_type == 'reserve':
+        ledger.release(db, reservation, f"batch {status}")
+
+async def run_job(job_id: int):
+    db = SessionLocal()
+    owned = False
+    try:
+        owned = await run_in_threadpool(_claim_job, db, job_id)
+        if not owned:
+            # Finished, or run by a process that holds its lease
+            return
+        _owned_jobs.add(job_id)
+        job = await run_in_threadpool(_detached_job, db, job_id)
+        if job.status == 'running':
+            concurrency = BATCH_CONCURRENCY or scheduler.get_queue(job.tariff).concurrency
+            workers = min(concurrency, job.total_items)
+            logger.info("Batch job started", extra={"job_id": job_id, "items": job.total_items, "workers": workers})
+            while True:
+                await asyncio.gather(*[_worker(job) for _ in range(workers)])
+                # Items leased by a process that died are reclaimed once their lease runs out
+                if not await run_in_threadpool(_leased_items, db, job_id):
+                    break
+                await asyncio.sleep(BATCH_POLL_INTERVAL)
+        # Also settles a job cancelled while it ran here
+        await run_in_threadpool(_finish_job, db, job_id)
+        logger.info("Batch job finished", extra={"job_id": job_id})
+    except asyncio.CancelledError:
+        if owned:
+            await asyncio.shield(run_in_threadpool(_release_job, db, job_id))
+        raise
+    except Exception:
+        logger.exception("Batch job crashed", extra={"job_id": job_id})
+    finally:
+        _owned_jobs.discard(job_id)
+        db.close()
+
+_tasks: Dict[int, asyncio.Task] = {}
+# Jobs and items whose leases this process holds
+_owned_jobs: Set[int] = set()
+_owned_items: Set[int] = set()
+
+def start(job_id: int):
+    """Run the job in the background of the current event loop"""
+    task = asyncio.ensure_future(run_job(job_id))
+    _tasks[job_id] = task
+    task.add_done_callback(lambda t: _tasks.pop(job_id, None))
+
+def cancel_job(db: Session, job: BatchJob) -> BatchJob:
+    """
+    Stop claiming new items. The process running the job lets its running
+    items finish and then releases the rest; a job no live process holds is
+    settled here.
+    """
+    db.query(BatchJob)\
+        .filter(BatchJob.id == job.id, BatchJob.status.in_(('queued', 'running')))\
+        .update({BatchJob.status: 'cancelled'}, synchronize_session=False)
+    db.commit()
+    if _claim_job(db, job.id):
+        _finish_job(db, job.id)
+    db.refresh(job)
+    return job
+
+def _orphaned_jobs(db: Session) -> List[int]:
+    """Unfinished jobs that no live process holds"""
+    now = time.time()
+    job_ids = [job_id for job_id, in db.query(BatchJob.id).filter(
+        BatchJob.finished_at.is_(None),
+        or_(BatchJob.lease_expires.is_(None), BatchJob.lease_expires < now)
+    )]
+    db.rollback()
+    return job_ids
+
+def _extend_leases(db: Session, job_ids: list, item_ids: list):
+    lease_expires = time.time() + JOB_LEASE
+    if job_ids:
+        db.query(BatchJob)\
+            .filter(BatchJob.id.in_(job_ids), BatchJob.finished_at.is_(None))\
+            .update({BatchJob.lease_expires: lease_expires}, synchronize_session=False)
+    if item_ids:
+        db.query(BatchItem)\
+            .filter(BatchItem.id.in_(item_ids), BatchItem.status == 'running')\
+            .update({BatchItem.lease_expires: lease_expires}, synchronize_session=False)
+    db.commit()
+
+async def _monitor():
+    """Extend this process's leases and take over the jobs of processes that stopped"""
+    db = SessionLocal()
+    try:
+        while True:
+            try:
+                await run_in_threadpool(_extend_leases, db, list(_owned_jobs), list(_owned_items))
+                job_ids = [job_id for job_id in await run_in_threadpool(_orphaned_jobs, db) if job_id not in _tasks]
+            except Exception:
+                await run_in_threadpool(db.rollback)
+                logger.exception("Error checking batch job leases")
+            else:
+                for job_id in job_ids:
+                    start(job_id)
+                if job_ids:
+                    logger.info("Resumed batch jobs", extra={"job_ids": job_ids})
+            await asyncio.sleep(JOB_LEASE / 3)
+    finally:
+        db.close()
+
+_monitor_task = None
+
+async def resume():
+    """Take over unfinished jobs that no live process holds, now and whenever a lease runs out"""
+    global _monitor_task
+    if _monitor_task is None:
+        _monitor_task = asyncio.ensure_future(_monitor())
+
+async def shutdown():
+    """Cancel running jobs; their unfinished items go back to pending and their leases are given up"""
+    global _monitor_task
+    tasks = list(_tasks.values())
+    if _monitor_task is not None:
+        tasks.append(_monitor_task)
+        _monitor_task = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def _finished_items(db: Session, job_id: int, after_id: int) -> list:
+    return db.query(BatchItem, Generation.result)\
+        .outerjoin(Generation, Generation.id == BatchItem.generation_id)\
+        .filter(BatchItem.job_id == job_id, BatchItem.status.in_(FINISHED_ITEM_STATES), BatchItem.id > after_id)\
+        .order_by(BatchItem.id)\
+        .all()
+
+def _unfinished_floor(db: Session, job_id: int) -> Optional[int]:
+    """Lowest id of an item that is not finished yet"""
+    return db.query(func.min(BatchItem.id))\
+        .filter(BatchItem.job_id == job_id, BatchItem.status.notin_(FINISHED_ITEM_STATES))\
+        .scalar()
+
+def _job_finished(db: Session, job_id: int) -> bool:
+    return db.query(BatchJob.finished_at).filter(BatchJob.id == job_id).scalar() is not None
+
+async def iter_results(job_id: int):
+    """
+    Yield finished items as they complete until the job is over.
+
+    Items finish roughly in id order, so everything below the lowest
+    unfinished id has been sent and only the ids above it are tracked.
+    """
+    db = SessionLocal()
+    try:
+        floor, sent = 0, set()
+        while True:
+            # Read the job state first: once it is over, the rows read next
+            # are the last ones that will ever finish
+            finished = await run_in_threadpool(_job_finished, db, job_id)
+            unfinished = await run_in_threadpool(_unfinished_floor, db, job_id)
+            rows = await run_in_threadpool(_finished_items, db, job_id, floor)
+            await run_in_threadpool(db.rollback)
+            for item, result in rows:
+                if item.id not in sent:
+                    sent.add(item.id)
+                    yield item, result
+            if finished or unfinished is None:
+                return
+            floor = unfinished - 1
+            sent = {item_id for item_id in sent if item_id > floor}
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+    finally:
+        db.close()
+
+RESULT_FIELDS = ("position", "status", "prompt", "result", "error", "generation_id")
+
+def _result_row(item: BatchItem, result: Optional[str]) -> dict:
+    return {
+        "position": item.position,
+        "status": item.status,
+        "prompt": item.prompt,
+        "result": result,
+        "error": item.error,
+        "generation_id": item.generation_id
+    }
+
+async def stream_ndjson(job_id: int):
+    async for item, result in iter_results(job_id):
+        yield json.dumps(_result_row(item, result), ensure_ascii=False) + "\n"
+
+async def stream_csv(job_id: int):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=RESULT_FIELDS)
+    writer.writeheader()
+    async for item, result in iter_results(job_id):
+        writer.writerow(_result_row(item, result))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
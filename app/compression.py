@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Response compression and JSON charset in one pure ASGI middleware.
+
+Bodies above COMPRESSION_MINIMUM_SIZE are compressed with brotli when the
+client accepts it and the ``brotli`` package is installed, with gzip
+otherwise. Streaming responses are compressed chunk by chunk and flushed,
+so NDJSON and CSV downloads still arrive incrementally; event streams and
+already compressed types are passed through. Only Starlette's public
+header helpers are used, so the middleware does not depend on the internals
+of a particular Starlette release.
+
+JSON responses rendered outside UTF8JSONResponse (Pydantic's fast path,
+FastAPI's error handlers) get the charset added to their Content-Type on
+the way out, without a BaseHTTPMiddleware round trip.
+"""
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .responses import JSON_MEDIA_TYPE
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSION_MINIMUM_SIZE = int(os.getenv('COMPRESSION_MINIMUM_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '5'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+
+# Media type prefixes passed through as they are: event streams must not be
+# buffered by a compressor and the rest is compressed already
+UNCOMPRESSED_TYPES = (
+    "text/event-stream", "application/gzip", "application/x-gzip", "application/zip",
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/avif", "audio/", "video/", "font/woff"
+)
+
+def accepted_encodings(header: str) -> set:
+    """Codings of an Accept-Encoding header, leaving out those with q=0"""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+class GzipEncoder:
+    content_encoding = "gzip"
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        return self._compressor.compress(body) + self._compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+
+class BrotliEncoder:
+    content_encoding = "br"
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        data = self._compressor.process(body)
+        return data + (self._compressor.flush() if more_body else self._compressor.finish())
+
+def compressible(start: Message) -> bool:
+    """Whether a response may be compressed, judging by its start message"""
+    headers = Headers(raw=start["headers"])
+    media_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+    return start["status"] != 206 and "content-encoding" not in headers and not media_type.startswith(UNCOMPRESSED_TYPES)
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            encoder = BrotliEncoder
+        elif "gzip" in accepted:
+            encoder = GzipEncoder
+        else:
+            encoder = None
+        # The start message is held back until the first body chunk shows
+        # whether the response is worth compressing
+        held = None
+        compressor = None
+
+        async def send_compressed(message: Message):
+            nonlocal held, compressor
+            if message["type"] == "http.response.start":
+                message["headers"] = headers = list(message.get("headers", ()))
+                mutable = MutableHeaders(raw=headers)
+                if mutable.get("content-type") == "application/json":
+                    mutable["content-type"] = JSON_MEDIA_TYPE
+                if encoder is not None and compressible(message):
+                    held = message
+                    return
+            elif message["type"] == "http.response.body" and held is not None:
+                start, held = held, None
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                if more_body or len(body) >= self.minimum_size:
+                    compressor = encoder()
+                    message["body"] = compressor.compress(body, more_body)
+                    headers = MutableHeaders(raw=start["headers"])
+                    headers["content-encoding"] = compressor.content_encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if more_body or start.get("trailers", False):
+                        del headers["content-length"]
+                    else:
+                        headers["content-length"] = str(len(message["body"]))
+                await send(start)
+            elif message["type"] == "http.response.body" and compressor is not None:
+                message["body"] = compressor.compress(message.get("body", b""), message.get("more_body", False))
+            elif held is not None:
+                # e.g. http.response.pathsend: the file is sent as it is
+                start, held = held, None
+                await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
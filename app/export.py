@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of a user's generation history.
+
+Rows are read with ``yield_per`` (a server-side cursor on PostgreSQL, a
+lazily stepped cursor on SQLite) and serialized one batch at a time, so
+memory stays flat however many generations the user has. Fetching,
+serializing and compressing run in the threadpool; the event loop only
+forwards finished chunks.
+"""
+import csv
+import io
+import json
+import os
+import zlib
+from typing import Iterator
+
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from .database import SessionLocal
+from .models import Generation, from_minor
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '500'))
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8"
+}
+
+EXPORT_FIELDS = (
+    "id", "created_at", "tariff", "model", "prompt", "result", "cost", "tokens_used",
+    "prompt_tokens", "processing_time", "load_duration", "prompt_eval_duration", "eval_duration"
+)
+
+_COLUMNS = (
+    Generation.id, Generation.created_at, Generation.tariff, Generation.model, Generation.prompt,
+    Generation.result, Generation.cost_minor, Generation.tokens_used, Generation.prompt_tokens,
+    Generation.processing_time, Generation.load_duration, Generation.prompt_eval_duration,
+    Generation.eval_duration
+)
+
+def _export_row(row) -> dict:
+    values = dict(zip(EXPORT_FIELDS, row))
+    values["cost"] = from_minor(values["cost"])
+    if values["created_at"] is not None:
+        values["created_at"] = values["created_at"].isoformat()
+    return values
+
+def _batches(user_id: int) -> Iterator[list]:
+    """Yield the user's generations oldest first, EXPORT_BATCH_SIZE rows at a time"""
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select(*_COLUMNS)
+            .where(Generation.user_id == user_id)
+            .order_by(Generation.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        for partition in result.partitions():
+            yield [_export_row(row) for row in partition]
+    finally:
+        db.close()
+
+def _ndjson_chunks(user_id: int) -> Iterator[str]:
+    for rows in _batches(user_id):
+        yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+def _csv_chunks(user_id: int) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for rows in _batches(user_id):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+def _gzip(chunks: Iterator[str]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def chunks(user_id: int, format: str, compress: bool = False) -> Iterator:
+    """Synchronous iterator over the encoded export"""
+    body = _csv_chunks(user_id) if format == "csv" else _ndjson_chunks(user_id)
+    return _gzip(body) if compress else body
+
+_DONE = object()
+
+async def stream(user_id: int, format: str, compress: bool = False):
+    """
+    Drive ``chunks`` in the threadpool for a StreamingResponse.
+
+    The iterator is closed explicitly, from the threadpool, when the client
+    goes away, so its session is returned to the pool right away.
+    """
+    iterator = chunks(user_id, format, compress)
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, iterator, _DONE)
+            if chunk is _DONE:
+                return
+            yield chunk
+    finally:
+        await run_in_threadpool(iterator.close)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous generation jobs.
+
+``POST /generate?mode=async`` reserves the cost, stores a GenerationJob and
+returns at once. A pool of background workers per process claims queued
+jobs from the table, so a job survives the client disconnecting and any
+process sharing the database can pick it up.
+
+A claimed job carries a lease that its worker keeps extending. When a
+process dies its leases run out and the jobs are claimed again; on a clean
+shutdown running jobs are put straight back in the queue.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import analytics
+from . import ledger
+from . import metrics
+from . import ml_utils
+from . import ratelimit
+from . import rollups
+from . import scheduler
+from . import semantic_cache
+from .database import SessionLocal
+from .models import BalanceHistory, Generation, GenerationJob, Tariff, to_minor, from_minor
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '8'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2.0'))
+JOB_LEASE = float(os.getenv('JOB_LEASE', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+
+FINISHED_STATES = ('completed', 'failed')
+
+jobs_processed = metrics.Counter(
+    "generation_jobs_total", "Finished async generation jobs by outcome", ("tariff", "status")
+)
+
+def submit(db: Session, user_id: int, prompt: str, tariff: str, use_cache: bool = True) -> GenerationJob:
+    """
+    Reserve the tariff cost and queue the job.
+
+    Raises:
+        ledger.InsufficientFundsError: If the balance does not cover the cost
+    """
+    cost_minor = to_minor(Tariff.get_cost(tariff))
+    reservation = ledger.reserve(db, user_id, cost_minor, f'Content generation using {tariff} model')
+    try:
+        job = GenerationJob(
+            user_id=user_id,
+            prompt=prompt,
+            tariff=tariff,
+            use_cache=use_cache,
+            reservation_id=reservation.id
+        )
+        db.add(job)
+        db.commit()
+    except Exception:
+        db.rollback()
+        ledger.release(db, reservation, "job not created")
+        raise
+    _wake_workers()
+    return job
+
+def get_job(db: Session, job_id: int, user_id: int) -> Optional[dict]:
+    """Job state with its result once completed, or None if the user has no such job"""
+    row = db.query(GenerationJob, Generation.result, Generation.cost_minor)\
+        .outerjoin(Generation, Generation.id == GenerationJob.generation_id)\
+        .filter(GenerationJob.id == job_id, GenerationJob.user_id == user_id)\
+        .first()
+    if row is None:
+        return None
+    job, result, cost_minor = row
+    return {
+        "id": job.id,
+        "status": job.status,
+        "tariff": job.tariff,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "result": result,
+        "cost": from_minor(cost_minor) if cost_minor is not None else None,
+        "generation_id": job.generation_id,
+        "error": job.error
+    }
+
+def fetch_job(job_id: int, user_id: int) -> Optional[dict]:
+    """get_job on a short-lived session of its own"""
+    with SessionLocal() as db:
+        return get_job(db, job_id, user_id)
+
+# Job updates of this process, for the WebSocket push channel
+_updates: Dict[int, asyncio.Event] = {}
+# Open watches per job; the job's event is dropped when the last one closes
+_watchers: Dict[int, int] = {}
+
+@contextmanager
+def watching(job_id: int):
+    """
+    Watch a job for the duration of the block; wait_for_update is called
+    inside it. However the watch ends (the job finishes here or in another
+    process, the client leaves), the last watcher to leave drops the event.
+    """
+    _watchers[job_id] = _watchers.get(job_id, 0) + 1
+    try:
+        yield
+    finally:
+        _watchers[job_id] -= 1
+        if not _watchers[job_id]:
+            del _watchers[job_id]
+            _updates.pop(job_id, None)
+
+def _notify(job_id: int):
+    event = _updates.pop(job_id, None)
+    if event is not None:
+        event.set()
+
+async def wait_for_update(job_id: int, timeout: float):
+    """
+    Wait until a worker of this process changes the job, or ``timeout``.
+
+    Jobs handled by another process are only noticed by the timeout, so
+    callers re-read the job after every wait. Call it within ``watching``.
+    """
+    event = _updates.setdefault(job_id, asyncio.Event())
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+def _claimable(now: float):
+    return or_(
+        GenerationJob.status == 'queued',
+        and_(GenerationJob.status == 'running', GenerationJob.lease_expires < now)
+    )
+
+def _claim(db: Session) -> Optional[GenerationJob]:
+    """Take the oldest queued job, or one whose worker lost its lease"""
+    while True:
+        now = time.time()
+        job_id = db.query(GenerationJob.id)\
+            .filter(_claimable(now))\
+            .order_by(GenerationJob.id)\
+            .limit(1)\
+            .scalar()
+        if job_id is None:
+            db.rollback()
+            return None
+        claimed = db.query(GenerationJob)\
+            .filter(GenerationJob.id == job_id, _claimable(now))\
+            .update({
+                GenerationJob.status: 'running',
+                GenerationJob.lease_expires: now + JOB_LEASE,
+                GenerationJob.attempts: GenerationJob.attempts + 1,
+                GenerationJob.started_at: datetime.now()
+            }, synchronize_session=False)
+        db.commit()
+        if claimed:
+            job = db.get(GenerationJob, job_id)
+            db.expunge(job)
+            return job
+
+def _store_result(db: Session, job: GenerationJob, text: str, usage: Optional[ml_utils.Usage], cost_minor: int, processing_time: float) -> int:
+    """Store the Generation, complete the job and capture its cost in one transaction; returns the generation id"""
+    columns = ml_utils.usage_columns(usage)
+    rollups.record_generation(db, job.user_id, job.tariff, columns["tokens_used"], cost_minor, processing_time, usage)
+    generation = Generation(
+        user_id=job.user_id,
+        prompt=job.prompt,
+        result=text,
+        tariff=job.tariff,
+        cost_minor=cost_minor,
+        processing_time=processing_time,
+        **columns
+    )
+    db.add(generation)
+    db.flush()
+    db.query(GenerationJob).filter(GenerationJob.id == job.id).update({
+        GenerationJob.status: 'completed',
+        GenerationJob.generation_id: generation.id,
+        GenerationJob.lease_expires: None,
+        GenerationJob.finished_at: datetime.now()
+    }, synchronize_session=False)
+    if job.reservation_id is not None:
+        ledger.capture(db, db.get(BalanceHistory, job.reservation_id), cost_minor)
+    else:
+        db.commit()
+    analytics.note_generation(job.user_id)
+    return generation.id
+
+def _fail(db: Session, job: GenerationJob, error: str):
+    db.query(GenerationJob).filter(GenerationJob.id == job.id).update({
+        GenerationJob.status: 'failed',
+        GenerationJob.error: error[:500],
+        GenerationJob.lease_expires: None,
+        GenerationJob.finished_at: datetime.now()
+    }, synchronize_session=False)
+    db.commit()
+    if job.reservation_id is not None:
+        ledger.release(db, db.get(BalanceHistory, job.reservation_id), "generation failed")
+
+def _requeue(db: Session, job: GenerationJob, count_attempt: bool = True):
+    values = {GenerationJob.status: 'queued', GenerationJob.lease_expires: None}
+    if not count_attempt:
+        values[GenerationJob.attempts] = GenerationJob.attempts - 1
+    db.query(GenerationJob).filter(GenerationJob.id == job.id, GenerationJob.status == 'running')\
+        .update(values, synchronize_session=False)
+    db.commit()
+
+async def _generate(job: GenerationJob) -> ml_utils.Completion:
+    while True:
+        try:
+            async with scheduler.admit(job.tariff, user_id=job.user_id):
+                return await ml_utils.generate_text(job.prompt, job.tariff)
+        except scheduler.QueueFullError as e:
+            # The job is already accepted, so wait for room instead of failing
+            await asyncio.sleep(e.retry_after)
+
+async def _process(db: Session, job: GenerationJob):
+    start = time.perf_counter()
+    cost = Tariff.get_cost(job.tariff)
+    text = await semantic_cache.cached_result(job.prompt, job.tariff) if job.use_cache else None
+    usage = None
+    if text is not None:
+        cost = ml_utils.cache_hit_cost(cost)
+    else:
+        completion = await _generate(job)
+        text, usage = completion.text, completion.usage
+        cost = ml_utils.usage_cost(job.tariff, cost, usage)
+        await ml_utils.generation_cache.set(job.prompt, job.tariff, text)
+    generation_id = await run_in_threadpool(_store_result, db, job, text, usage, to_minor(cost), time.perf_counter() - start)
+    if usage is not None and job.use_cache:
+        await semantic_cache.cache.add(job.prompt, job.tariff, generation_id)
+
+_owned: Dict[int, GenerationJob] = {}
+
+async def _worker():
+    db = SessionLocal()
+    try:
+        while True:
+            _wake.clear()
+            job = await run_in_threadpool(_claim, db)
+            if job is None:
+                try:
+                    await asyncio.wait_for(_wake.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _owned[job.id] = job
+            _notify(job.id)
+            try:
+                if job.attempts > JOB_MAX_ATTEMPTS:
+                    await run_in_threadpool(_fail, db, job, "Too many attempts")
+                    status = 'failed'
+                else:
+                    await _process(db, job)
+                    status = 'completed'
+            except asyncio.CancelledError:
+                # Shutting down: hand the job to the next process to start
+                await asyncio.shield(run_in_threadpool(_requeue, db, job, False))
+                raise
+            except Exception as e:
+                await run_in_threadpool(db.rollback)
+                logger.warning("Generation job failed", extra={"job_id": job.id, "attempt": job.attempts, "error": str(e)})
+                if isinstance(e, ml_utils.GenerationError) and job.attempts < JOB_MAX_ATTEMPTS:
+                    await run_in_threadpool(_requeue, db, job)
+                    status = None
+                else:
+                    await run_in_threadpool(_fail, db, job, str(e))
+                    status = 'failed'
+            finally:
+                _owned.pop(job.id, None)
+            if status:
+                jobs_processed.inc(tariff=job.tariff, status=status)
+                # Taken when the job was submitted
+                await ratelimit.limiter.release(job.user_id)
+            _notify(job.id)
+    finally:
+        db.close()
+
+def _extend_leases(db: Session, job_ids: list):
+    db.query(GenerationJob)\
+        .filter(GenerationJob.id.in_(job_ids), GenerationJob.status == 'running')\
+        .update({GenerationJob.lease_expires: time.time() + JOB_LEASE}, synchronize_session=False)
+    db.commit()
+
+async def _heartbeat():
+    db = SessionLocal()
+    try:
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            if _owned:
+                try:
+                    await run_in_threadpool(_extend_leases, db, list(_owned))
+                except Exception:
+                    await run_in_threadpool(db.rollback)
+                    logger.exception("Error extending job leases")
+    finally:
+        db.close()
+
+# Created by start(): on Python 3.9 an Event binds to the loop current when
+# it is made, which at import time need not be the serving loop
+_wake: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_tasks = []
+
+def _wake_workers():
+    """Wake an idle worker; safe to call from the threadpool"""
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_wake.set)
+
+def start():
+    """Start the workers on the running event loop"""
+    global _wake, _loop
+    if _tasks:
+        return
+    _wake = asyncio.Event()
+    _loop = asyncio.get_running_loop()
+    _tasks.append(asyncio.ensure_future(_heartbeat()))
+    _tasks.extend(asyncio.ensure_future(_worker()) for _ in range(JOB_WORKERS))
+
+async def shutdown():
+    """Stop the workers; jobs they were running go back to the queue"""
+    global _loop
+    _loop = None
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Balance ledger.
+
+Every balance movement is a conditional SQL update of users.balance_minor
+plus a BalanceHistory row, committed together. The balance is never read,
+modified in Python and written back, so concurrent requests and workers
+cannot overspend or lose updates.
+
+Generations use a reserve / capture-or-release flow: the cost is held
+before the model runs and is either captured as a spend or released when
+the generation fails.
+"""
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from . import rollups
+from .models import BalanceHistory, User, from_minor
+
+class InsufficientFundsError(Exception):
+    """Raised when a debit would take the balance below zero"""
+
+class LedgerError(Exception):
+    """Raised when a ledger operation is not valid for the given entry"""
+
+def _apply(db: Session, user_id: int, delta_minor: int, require_funds: bool = False) -> bool:
+    query = db.query(User).filter(User.id == user_id)
+    if require_funds:
+        query = query.filter(User.balance_minor >= -delta_minor)
+    updated = query.update(
+        {User.balance_minor: User.balance_minor + delta_minor},
+        synchronize_session=False
+    )
+    return updated == 1
+
+def _commit(db: Session):
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+def credit(db: Session, user_id: int, amount_minor: int, description: str) -> BalanceHistory:
+    """Add funds to the user's balance"""
+    if amount_minor <= 0:
+        raise LedgerError("Credit amount must be positive")
+    rollups.record_balance_change(db, user_id, amount_minor, 'add')
+    _apply(db, user_id, amount_minor)
+    entry = BalanceHistory(
+        user_id=user_id,
+        amount_minor=amount_minor,
+        operation_type='add',
+        description=description
+    )
+    db.add(entry)
+    _commit(db)
+    return entry
+
+def reserve(db: Session, user_id: int, amount_minor: int, description: str) -> BalanceHistory:
+    """
+    Hold funds for an operation whose outcome is not known yet.
+
+    Raises:
+        InsufficientFundsError: If the balance does not cover the amount
+    """
+    if amount_minor <= 0:
+        raise LedgerError("Reserved amount must be positive")
+    if not _apply(db, user_id, -amount_minor, require_funds=True):
+        db.rollback()
+        raise InsufficientFundsError("Insufficient funds")
+    rollups.record_balance_change(db, user_id, -amount_minor, 'reserve')
+    entry = BalanceHistory(
+        user_id=user_id,
+        amount_minor=-amount_minor,
+        operation_type='reserve',
+        description=description
+    )
+    db.add(entry)
+    _commit(db)
+    return entry
+
+def _held(db: Session, reservation: BalanceHistory) -> int:
+    row = db.query(BalanceHistory.operation_type, BalanceHistory.amount_minor)\
+        .filter(BalanceHistory.id == reservation.id)\
+        .one()
+    if row.operation_type != 'reserve':
+        raise LedgerError(f"Entry {reservation.id} is a '{row.operation_type}', not a reservation")
+    return -row.amount_minor
+
+def _settle(db: Session, reservation: BalanceHistory, held_minor: int, values: dict):
+    """Rewrite a reservation, provided nobody changed it since it was read"""
+    updated = db.query(BalanceHistory).filter(
+        BalanceHistory.id == reservation.id,
+        BalanceHistory.operation_type == 'reserve',
+        BalanceHistory.amount_minor == -held_minor
+    ).update(values, synchronize_session=False)
+    if updated != 1:
+        db.rollback()
+        raise LedgerError(f"Reservation {reservation.id} was modified concurrently")
+
+def capture(db: Session, reservation: BalanceHistory, amount_minor: Optional[int] = None, release_rest: bool = True) -> BalanceHistory:
+    """
+    Turn held funds into a spend and commit it with anything else the caller
+    staged on the session (e.g. the Generation row).
+
+    Without ``amount_minor`` the whole hold is captured. With ``release_rest``
+    the reservation is settled: the captured amount becomes the spend and the
+    remainder goes back to the balance. Otherwise only ``amount_minor`` is
+    split off as a separate spend and the rest stays held for later captures.
+    """
+    user_id = reservation.user_id
+    held_minor = _held(db, reservation)
+    if amount_minor is None:
+        amount_minor = held_minor
+    if not 0 <= amount_minor <= held_minor:
+        raise LedgerError("Captured amount exceeds the reservation")
+
+    if release_rest or amount_minor == held_minor:
+        _settle(db, reservation, held_minor, {
+            BalanceHistory.amount_minor: -amount_minor,
+            BalanceHistory.operation_type: 'spend'
+        })
+        if held_minor > amount_minor:
+            _apply(db, user_id, held_minor - amount_minor)
+        rollups.record_balance_change(db, user_id, -amount_minor, 'spend', new_entry=False)
+        entry = reservation
+    else:
+        # Partial captures may race each other, so the hold shrinks in SQL
+        updated = db.query(BalanceHistory).filter(
+            BalanceHistory.id == reservation.id,
+            BalanceHistory.operation_type == 'reserve',
+            BalanceHistory.amount_minor <= -amount_minor
+        ).update(
+            {BalanceHistory.amount_minor: BalanceHistory.amount_minor + amount_minor},
+            synchronize_session=False
+        )
+        if updated != 1:
+            db.rollback()
+            raise LedgerError("Captured amount exceeds the reservation")
+        rollups.record_balance_change(db, user_id, -amount_minor, 'spend')
+        entry = BalanceHistory(
+            user_id=user_id,
+            amount_minor=-amount_minor,
+            operation_type='spend',
+            description=reservation.description
+        )
+        db.add(entry)
+    _commit(db)
+    return entry
+
+def release(db: Session, reservation: BalanceHistory, reason: str = "released") -> BalanceHistory:
+    """Return whatever is still held by the reservation to the balance"""
+    user_id = reservation.user_id
+    held_minor = _held(db, reservation)
+    _settle(db, reservation, held_minor, {
+        BalanceHistory.amount_minor: 0,
+        BalanceHistory.operation_type: 'release',
+        BalanceHistory.description: f"{reservation.description} ({reason}, {from_minor(held_minor):.2f} returned)"
+    })
+    if held_minor:
+        _apply(db, user_id, held_minor)
+    _commit(db)
+    return reservation
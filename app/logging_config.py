@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Structured application logging.
+
+Records are written as one JSON object per line. Handlers only enqueue the
+record; a background listener thread does the formatting and I/O, so
+logging never blocks the event loop on a slow stdout.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_STANDARD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        payload.update({k: v for k, v in record.__dict__.items() if k not in _STANDARD_ATTRS})
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+_listener = None
+_queue_handler = None
+
+def setup_logging():
+    """Route the ``app`` logger through a queue to a JSON stdout handler; called by the lifespan"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    logger = logging.getLogger('app')
+    logger.setLevel(LOG_LEVEL)
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    logger.addHandler(_queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+def shutdown_logging():
+    """Flush queued records, stop the listener thread and hand the ``app`` logger back"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        logger = logging.getLogger('app')
+        logger.removeHandler(_queue_handler)
+        logger.propagate = True
+        _listener.stop()
+        _listener = None
+        _queue_handler = None
@@ -1,38 +1,77 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, Response, status, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from .database import SessionLocal, engine, recreate_tables
-from .models import User, Tariff, Base, Generation, BalanceHistory
+from fastapi.datastructures import Default
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, defer
+from .database import SessionLocal, engine, get_db
+from .models import User, Tariff, Base, Generation, BalanceHistory, BatchJob, to_minor, from_minor
 from .schemas import (
     UserCreate, UserLogin, Token, GenerateRequest, 
     GenerateResponse, BalanceUpdate, AnalyticsResponse,
-    GenerationStats, BalanceStats, UserStats, GenerationHistory,
-    HistoryResponse
+    GenerationStats, ModelStats, BalanceStats, UserStats, GenerationHistory,
+    HistoryResponse, BalanceHistoryItem, BalanceHistoryResponse, BatchJobResponse,
+    GenerationJobResponse, AnalyticsSeriesResponse, SeriesBucket, SeriesStats
 )
+from . import analytics
 from . import auth
+from . import backends
+from . import batch
+from . import compression
+from . import export
+from . import jobs
 from . import ml_utils
+from . import ratelimit
+from . import scheduler
+from . import semantic_cache
+from .warmup import warmup
+from . import rollups
+from . import ledger
+from . import metrics
+from .logging_config import setup_logging, shutdown_logging
+from .responses import UTF8JSONResponse
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from sqlalchemy import func, or_, and_
+from typing import Awaitable, Callable, Optional
+from contextlib import asynccontextmanager
+import anyio
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Started here rather than on import, so importing app.main (tests,
+    # benchmarks, tooling) does not leave a listener thread running
+    setup_logging()
+    # Serve /healthz at once; /readyz reports when warm-up has finished
+    warmup.start()
+    yield
+    await warmup.stop()
+    await jobs.shutdown()
+    await batch.shutdown()
+    await ml_utils.close()
+    semantic_cache.cache.close()
+    auth.shutdown()
+    shutdown_logging()
 
 app = FastAPI(
     title="AI Content Generator",
-    default_response_class=JSONResponse,
+    lifespan=lifespan,
+    # Wrapped in Default so routes with a response_model keep FastAPI's
+    # Pydantic dump_json fast path; the class renders everything else
+    default_response_class=Default(UTF8JSONResponse),
     openapi_url="/openapi.json",
     docs_url="/docs",
     redoc_url="/redoc",
 )
 
-# Add middleware for encoding handling
-@app.middleware("http")
-async def add_encoding_header(request, call_next):
-    response = await call_next(request)
-    if "text/html" not in response.headers.get("Content-Type", ""):
-        response.headers["Content-Type"] = "application/json; charset=utf-8"
-    return response
-
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -43,31 +82,29 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
-# Recreate all tables on startup
-recreate_tables()
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
-# Database session dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def _email_registered(db: Session, email: str) -> bool:
+    registered = auth.get_user(db, email) is not None
+    # Return the connection to the pool while the password is hashed
+    db.rollback()
+    return registered
+
+def _create_user(db: Session, email: str, hashed_password: str):
+    db.add(User(email=email, hashed_password=hashed_password))
+    db.commit()
 
 @app.post("/register", response_model=Token)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: Session = Depends(get_db)):
     """Register a new user"""
-    existing_user = db.query(User).filter(User.email == user.email).first()
-    if existing_user:
+    if await run_in_threadpool(_email_registered, db, user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = auth.get_password_hash(user.password)
-    db_user = User(email=user.email, hashed_password=hashed_password)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    hashed_password = await auth.get_password_hash_async(user.password)
+    await run_in_threadpool(_create_user, db, user.email, hashed_password)
     
-    access_token = auth.create_access_token(data={"sub": db_user.email})
+    access_token = auth.create_access_token(data={"sub": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/token", response_model=Token)
@@ -75,7 +112,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     """Get access token"""
     try:
         # Use email as username
-        user = auth.authenticate_user(db, form_data.username, form_data.password)
+        user = await auth.authenticate_user(db, form_data.username, form_data.password)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -84,6 +121,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             )
         access_token = auth.create_access_token(data={"sub": user.email})
         return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -94,29 +133,16 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 def update_balance(amount: float, db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
     """Update current user's balance"""
     try:
-        if amount <= 0:
+        amount_minor = to_minor(amount)
+        if amount_minor <= 0:
             raise HTTPException(status_code=400, detail="Amount must be positive")
         
-        user = db.query(User).filter(User.email == current_user.email).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-            
-        user.balance += amount
-        db.commit()
-        
-        balance_history = BalanceHistory(
-            user_id=user.id,
-            amount=amount,
-            operation_type='add',
-            description='Balance top-up'
-        )
-        db.add(balance_history)
-        db.commit()
-        
+        user = current_user
+        ledger.credit(db, user.id, amount_minor, 'Balance top-up')
         db.refresh(user)
         
         return {
-            "amount": amount, 
+            "amount": from_minor(amount_minor), 
             "new_balance": user.balance,
             "message": "Balance successfully updated"
         }
@@ -129,120 +155,600 @@ def update_balance(amount: float, db: Session = Depends(get_db), current_user: U
         )
 
 @app.get("/balance", response_model=BalanceUpdate)
-def check_balance(db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
+def check_balance(current_user: User = Depends(auth.get_current_user)):
     """Check current balance"""
-    user = db.query(User).filter(User.email == current_user.email).first()
     return {
         "amount": 0,
-        "new_balance": user.balance,
+        "new_balance": current_user.balance,
         "message": "Current balance"
     }
 
-@app.post("/generate", response_model=GenerateResponse)
-def generate_content(request: GenerateRequest, db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
-    """Generate text content with token-based payment"""
-    start_time = datetime.now()
+def _record_generation(db: Session, user: User, request: GenerateRequest, generated_text: str, usage: Optional[ml_utils.Usage], reservation: Optional[BalanceHistory], cost_minor: int, processing_time: float) -> Generation:
+    """Store the generation and capture its cost in one transaction"""
+    columns = ml_utils.usage_columns(usage)
+    rollups.record_generation(db, user.id, request.tariff, columns["tokens_used"], cost_minor, processing_time, usage)
+    
+    generation = Generation(
+        user_id=user.id,
+        prompt=request.prompt,
+        result=generated_text,
+        tariff=request.tariff,
+        cost_minor=cost_minor,
+        processing_time=processing_time,
+        **columns
+    )
+    db.add(generation)
+    
+    if reservation is not None:
+        # Per-token tariffs may cost less than the reserved flat price
+        ledger.capture(db, reservation, cost_minor)
+    else:
+        db.commit()
+    analytics.note_generation(user.id)
+    db.refresh(generation)
+    db.refresh(user)
+    return generation
+
+def _reserve_generation(db: Session, user_id: int, tariff: str, cost_minor: int) -> Optional[BalanceHistory]:
+    if cost_minor <= 0:
+        return None
+    return ledger.reserve(db, user_id, cost_minor, f'Content generation using {tariff} model')
+
+async def _release_reservation(db: Session, reservation: BalanceHistory, reason: str = "generation failed"):
+    # Shielded so the hold is returned even when the request is being cancelled
+    with anyio.CancelScope(shield=True):
+        try:
+            await run_in_threadpool(ledger.release, db, reservation, reason)
+        except Exception as e:
+            logger.exception("Error releasing reservation", extra={"reservation_id": reservation.id, "error": str(e)})
+
+def _queue_full_exception(error: scheduler.QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Generation queue is full, please retry later",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def _rate_limit_exception(error: ratelimit.RateLimitExceeded) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after), **error.headers}
+    )
+
+async def _check_rate_limit(user_id: int, tariff: str) -> dict:
+    """Take a token from the user's bucket; returns the RateLimit-* headers for the response"""
+    try:
+        quota = await ratelimit.limiter.check(user_id, tariff)
+    except ratelimit.RateLimitExceeded as e:
+        raise _rate_limit_exception(e)
+    return quota.headers() if quota is not None else {}
+
+def _sse_event(event: str, data: dict) -> str:
+    """Format a single server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _observe_phase(tariff: str, phase: str, seconds: float):
+    metrics.generation_phase_duration.observe(seconds, tariff=tariff, model=ml_utils.MODEL_MAP[tariff], phase=phase)
+
+def _observe_generation(tariff: str, started: float, cached: bool):
+    if not cached:
+        metrics.generation_duration.observe(time.perf_counter() - started, tariff=tariff, model=ml_utils.MODEL_MAP[tariff])
+
+# Refund reasons of cancelled generations, by metric reason
+CANCELLATION_REASONS = {
+    "client_disconnect": "client disconnected",
+    "deadline": "deadline exceeded"
+}
+
+def _deadline(timeout: Optional[float]) -> Optional[float]:
+    """Monotonic deadline from the X-Request-Timeout header and GENERATION_TIMEOUT"""
+    limits = [t for t in (timeout, ml_utils.GENERATION_TIMEOUT) if t]
+    return time.monotonic() + min(limits) if limits else None
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+def _record_cancellation(user_id: int, tariff: str, reason: str) -> str:
+    """Count and log a cancelled generation; returns the refund reason"""
+    metrics.generation_cancellations.inc(tariff=tariff, reason=reason)
+    logger.info("Generation cancelled", extra={"user_id": user_id, "tariff": tariff, "reason": reason})
+    return CANCELLATION_REASONS[reason]
+
+async def _disconnected(http_request: Request):
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+async def _guard(http_request: Request, deadline: Optional[float], work: Awaitable):
+    """
+    Await ``work`` unless the client disconnects or the deadline passes first.
+
+    Either way the work is cancelled, which aborts the backend request and
+    frees its scheduler slot.
+
+    Raises:
+        ml_utils.GenerationCancelled: With reason "client_disconnect" or "deadline"
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(_disconnected(http_request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=_remaining(deadline), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    await asyncio.wait({task})
+    if not task.cancelled():
+        task.exception()  # finished in the meantime; the result is dropped all the same
+    raise ml_utils.GenerationCancelled("client_disconnect" if watcher in done else "deadline")
+
+async def _run_generation(request: GenerateRequest, user_id: int) -> ml_utils.Completion:
+    """Run a generation through the scheduler and remember its result"""
+    try:
+        async with scheduler.admit(request.tariff, user_id=user_id) as queue_time:
+            _observe_phase(request.tariff, "queue", queue_time)
+            backend_start = time.perf_counter()
+            completion = await ml_utils.generate_text(request.prompt, request.tariff)
+            _observe_phase(request.tariff, "backend", time.perf_counter() - backend_start)
+    except scheduler.QueueFullError:
+        metrics.generation_errors.inc(tariff=request.tariff, reason="queue_full")
+        raise
+    except ml_utils.GenerationError:
+        metrics.generation_errors.inc(tariff=request.tariff, reason="backend")
+        raise
+    await ml_utils.generation_cache.set(request.prompt, request.tariff, completion.text)
+    return completion
+
+async def _store_generation(db: Session, user: User, request: GenerateRequest, generated_text: str, usage: Optional[ml_utils.Usage], reservation: Optional[BalanceHistory], cost_minor: int, started: float) -> Generation:
+    """Run _record_generation in the threadpool and time the DB phase"""
+    db_start = time.perf_counter()
+    try:
+        generation = await run_in_threadpool(_record_generation, db, user, request, generated_text, usage, reservation, cost_minor, db_start - started)
+    except Exception:
+        metrics.generation_errors.inc(tariff=request.tariff, reason="db")
+        raise
+    _observe_phase(request.tariff, "db", time.perf_counter() - db_start)
+    return generation
+
+@app.post("/generate", response_model=GenerateResponse, responses={202: {"model": GenerationJobResponse}})
+async def generate_content(
+    request: GenerateRequest,
+    http_request: Request,
+    response: Response,
+    mode: str = "sync",
+    x_request_timeout: Optional[float] = Header(None, gt=0),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(auth.get_current_user)
+):
+    """Generate text content with token-based payment.
     
-    user = db.query(User).filter(User.email == current_user.email).first()
-    print(f"\n=== Starting generation for user: {user.email} (ID: {user.id}) ===")
+    With ``mode=async`` the generation is queued as a job and a 202 with the
+    job is returned at once; poll ``/jobs/{id}`` or subscribe to
+    ``/jobs/{id}/ws`` for the result.
     
+    A sync generation is aborted and its reservation refunded when the client
+    disconnects or ``X-Request-Timeout`` seconds pass (504). Requests over the
+    user's rate or concurrency limit get a 429 with ``Retry-After``.
+    """
+    started = time.perf_counter()
+    deadline = _deadline(x_request_timeout)
+    
+    user = current_user
+    # Read once: the reservation's commit expires the user, and reloading it
+    # from the event loop would block on the connection pool
+    user_id = user.id
     cost = Tariff.get_cost(request.tariff)
     if cost == 0:
         raise HTTPException(status_code=400, detail="Invalid tariff type")
-    print(f"Using tariff: {request.tariff} with cost: {cost}")
+    if mode not in ("sync", "async"):
+        raise HTTPException(status_code=400, detail="mode must be sync or async")
+    rate_headers = await _check_rate_limit(user_id, request.tariff)
+    if mode == "async":
+        return await _submit_job(db, user_id, request, rate_headers)
+    response.headers.update(rate_headers)
     
-    if user.balance < cost:
-        raise HTTPException(status_code=402, detail="Insufficient funds")
-    print(f"Current balance: {user.balance}")
+    generated_text = await semantic_cache.cached_result(request.prompt, request.tariff) if request.use_cache else None
+    usage = None
+    cached = generated_text is not None
+    if cached:
+        cost = ml_utils.cache_hit_cost(cost)
+    cost_minor = to_minor(cost)
     
-    generated_text = ml_utils.generate_text(request.prompt, request.tariff)
-    print(f"Generated text length: {len(generated_text)}")
-    
-    if isinstance(generated_text, bytes):
-        generated_text = generated_text.decode('utf-8')
+    # A concurrency slot is held until the generation is stored
+    if not cached:
+        try:
+            await ratelimit.limiter.acquire(user_id, request.tariff)
+        except ratelimit.RateLimitExceeded as e:
+            raise _rate_limit_exception(e)
     
+    reservation = None
+    release_reason = "generation failed"
     try:
-        user.balance -= cost
+        try:
+            reservation = await run_in_threadpool(_reserve_generation, db, user_id, request.tariff, cost_minor)
+        except ledger.InsufficientFundsError:
+            metrics.insufficient_funds.inc(tariff=request.tariff)
+            raise HTTPException(status_code=402, detail="Insufficient funds")
         
-        generation = Generation(
-            user_id=user.id,
-            prompt=request.prompt,
-            result=generated_text,
-            tariff=request.tariff,
-            cost=cost,
-            tokens_used=len(generated_text.split()),
-            processing_time=(datetime.now() - start_time).total_seconds()
-        )
-        db.add(generation)
+        if not cached:
+            try:
+                if request.use_cache:
+                    work = ml_utils.inflight.do(
+                        ml_utils.cache_key(request.prompt, request.tariff),
+                        lambda: _run_generation(request, user_id)
+                    )
+                else:
+                    work = _run_generation(request, user_id)
+                completion = await _guard(http_request, deadline, work)
+            except ml_utils.GenerationCancelled as e:
+                release_reason = _record_cancellation(user_id, request.tariff, e.reason)
+                if e.reason == "deadline":
+                    raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Generation deadline exceeded")
+                # Nobody reads this; the status is what access logs show for it
+                raise HTTPException(status_code=499, detail="Client closed request")
+            except scheduler.QueueFullError as e:
+                raise _queue_full_exception(e)
+            except ml_utils.GenerationError as e:
+                logger.warning("Generation backend failed", extra={"user_id": user_id, "tariff": request.tariff, "error": str(e)})
+                raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=str(e))
+            generated_text, usage = completion.text, completion.usage
+            cost_minor = min(cost_minor, to_minor(ml_utils.usage_cost(request.tariff, cost, usage)))
         
-        balance_history = BalanceHistory(
-            user_id=user.id,
-            amount=-cost,
-            operation_type='spend',
-            description=f'Content generation using {request.tariff} model'
-        )
-        db.add(balance_history)
-        
-        db.commit()
-        db.refresh(generation)
-        db.refresh(user)
+        try:
+            generation = await _store_generation(db, user, request, generated_text, usage, reservation, cost_minor, started)
+        except Exception as e:
+            db.rollback()
+            logger.exception("Error storing generation", extra={"user_id": user_id, "tariff": request.tariff})
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error during generation: {str(e)}"
+            )
+        reservation = None
+    finally:
+        if reservation is not None:
+            await _release_reservation(db, reservation, release_reason)
+        if not cached:
+            await ratelimit.limiter.release(user_id)
+    
+    if not cached and request.use_cache:
+        await semantic_cache.cache.add(request.prompt, request.tariff, generation.id)
+    _observe_generation(request.tariff, started, cached)
+    logger.info("Generation completed", extra={
+        "user_id": user_id,
+        "generation_id": generation.id,
+        "tariff": request.tariff,
+        "cached": cached,
+        "cost": generation.cost,
+        "duration": round(time.perf_counter() - started, 3)
+    })
+    
+    return GenerateResponse(
+        text=generated_text,
+        cost=generation.cost,
+        remaining_balance=user.balance,
+        cached=cached
+    )
+
+async def _submit_job(db: Session, user_id: int, request: GenerateRequest, headers: dict) -> UTF8JSONResponse:
+    # The job holds one of the user's concurrency slots until it finishes;
+    # the worker that finishes it gives the slot back
+    try:
+        await ratelimit.limiter.acquire(user_id, request.tariff)
+    except ratelimit.RateLimitExceeded as e:
+        raise _rate_limit_exception(e)
+    submitted = False
+    try:
+        job = await run_in_threadpool(jobs.submit, db, user_id, request.prompt, request.tariff, request.use_cache)
+        submitted = True
+    except ledger.InsufficientFundsError:
+        metrics.insufficient_funds.inc(tariff=request.tariff)
+        raise HTTPException(status_code=402, detail="Insufficient funds")
+    finally:
+        if not submitted:
+            await ratelimit.limiter.release(user_id)
+    view = await run_in_threadpool(jobs.get_job, db, job.id, user_id)
+    return UTF8JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content=jsonable_encoder(GenerationJobResponse(**view)),
+        headers={"Location": f"/jobs/{job.id}", **headers}
+    )
+
+@app.get("/jobs/{job_id}", response_model=GenerationJobResponse)
+def get_generation_job(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
+    """Get the state of an async generation job and its result once completed"""
+    view = jobs.get_job(db, job_id, current_user.id)
+    if view is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return GenerationJobResponse(**view)
+
+@app.websocket("/jobs/{job_id}/ws")
+async def generation_job_updates(websocket: WebSocket, job_id: int, token: str):
+    """Push the job state on every change until it is finished.
+    
+    Browsers cannot set headers on a WebSocket, so the access token is
+    passed as the ``token`` query parameter.
+    """
+    def _authenticate():
+        with SessionLocal() as db:
+            return auth.resolve_token(db, token).id
+    
+    try:
+        user_id = await run_in_threadpool(_authenticate)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    last_sent = None
+    try:
+        with jobs.watching(job_id):
+            while True:
+                view = await run_in_threadpool(jobs.fetch_job, job_id, user_id)
+                if view is None:
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Job not found")
+                    return
+                if view != last_sent:
+                    await websocket.send_json(jsonable_encoder(GenerationJobResponse(**view)))
+                    last_sent = view
+                if view["status"] in jobs.FINISHED_STATES:
+                    await websocket.close()
+                    return
+                await jobs.wait_for_update(job_id, jobs.JOB_POLL_INTERVAL)
+    except WebSocketDisconnect:
+        pass
+
+@app.post("/generate/stream")
+async def generate_content_stream(
+    request: GenerateRequest,
+    x_request_timeout: Optional[float] = Header(None, gt=0),
+    current_user: User = Depends(auth.get_current_user)
+):
+    """Generate text content as a server-sent event stream.
+    
+    Emits ``token`` events while the model is producing text and a final ``done``
+    event with the cost and remaining balance once the generation is stored.
+    When the client disconnects or ``X-Request-Timeout`` seconds pass, the
+    backend stream is aborted and the reservation refunded.
+    """
+    deadline = _deadline(x_request_timeout)
+    cost = Tariff.get_cost(request.tariff)
+    if cost == 0:
+        raise HTTPException(status_code=400, detail="Invalid tariff type")
+    
+    rate_headers = await _check_rate_limit(current_user.id, request.tariff)
+    
+    # Fast rejection only; the authoritative checks are the reservation and
+    # the concurrency slot taken once the body is streaming. The balance is
+    # not part of a cached principal and loads from the database here
+    if await run_in_threadpool(getattr, current_user, "balance") < cost:
+        metrics.insufficient_funds.inc(tariff=request.tariff)
+        raise HTTPException(status_code=402, detail="Insufficient funds")
+    
+    try:
+        scheduler.check_capacity(request.tariff)
+        await ratelimit.limiter.check_slot(current_user.id, request.tariff)
+    except scheduler.QueueFullError as e:
+        raise _queue_full_exception(e)
+    except ratelimit.RateLimitExceeded as e:
+        raise _rate_limit_exception(e)
+    
+    return StreamingResponse(
+        _stream_generation(current_user.id, request, cost, deadline),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **rate_headers}
+    )
+
+async def _produce_stream(request: GenerateRequest, user_id: int, pieces: asyncio.Queue, on_usage: Callable[[ml_utils.Usage], None]):
+    """
+    Run the backend stream of _stream_generation in a task of its own.
+
+    Pieces are handed over through the queue, followed by None when the
+    model is done or by the exception that ended the stream. Keeping the
+    backend call out of the response task lets the consumer wait with a
+    deadline and cancel it cleanly.
+    """
+    try:
+        async with scheduler.admit(request.tariff, user_id=user_id) as queue_time:
+            _observe_phase(request.tariff, "queue", queue_time)
+            backend_start = time.perf_counter()
+            async for piece in ml_utils.generate_text_stream(request.prompt, request.tariff, on_usage):
+                pieces.put_nowait(piece)
+            _observe_phase(request.tariff, "backend", time.perf_counter() - backend_start)
+    except Exception as e:
+        pieces.put_nowait(e)
+    else:
+        pieces.put_nowait(None)
+
+async def _stream_generation(user_id: int, request: GenerateRequest, cost: float, deadline: Optional[float] = None):
+    started = time.perf_counter()
+    generated_text = await semantic_cache.cached_result(request.prompt, request.tariff) if request.use_cache else None
+    usages = []
+    cached = generated_text is not None
+    if cached:
+        cost = ml_utils.cache_hit_cost(cost)
+    cost_minor = to_minor(cost)
+    
+    # The request-scoped session is already closed once the body is streaming,
+    # so the generation is stored through a session of its own.
+    db = SessionLocal()
+    reservation = None
+    release_reason = "generation failed"
+    holds_slot = False
+    try:
+        if not cached:
+            try:
+                await ratelimit.limiter.acquire(user_id, request.tariff)
+            except ratelimit.RateLimitExceeded as e:
+                yield _sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+                return
+            holds_slot = True
+        try:
+            reservation = await run_in_threadpool(_reserve_generation, db, user_id, request.tariff, cost_minor)
+        except ledger.InsufficientFundsError:
+            metrics.insufficient_funds.inc(tariff=request.tariff)
+            yield _sse_event("error", {"detail": "Insufficient funds"})
+            return
         
-        print(f"Updated balance: {user.balance}")
-        print(f"Created generation record with ID: {generation.id}")
-        print("=== Generation completed successfully ===\n")
+        if cached:
+            yield _sse_event("token", {"text": generated_text})
+        else:
+            chunks = []
+            pieces = asyncio.Queue()
+            producer = asyncio.ensure_future(_produce_stream(request, user_id, pieces, usages.append))
+            try:
+                while True:
+                    piece = await asyncio.wait_for(pieces.get(), _remaining(deadline))
+                    if piece is None:
+                        break
+                    if isinstance(piece, Exception):
+                        raise piece
+                    chunks.append(piece)
+                    yield _sse_event("token", {"text": piece})
+            except asyncio.TimeoutError:
+                release_reason = _record_cancellation(user_id, request.tariff, "deadline")
+                yield _sse_event("error", {"detail": "Generation deadline exceeded"})
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                # The response task is cancelled (or the body closed) when the client goes away
+                release_reason = _record_cancellation(user_id, request.tariff, "client_disconnect")
+                raise
+            except scheduler.QueueFullError as e:
+                metrics.generation_errors.inc(tariff=request.tariff, reason="queue_full")
+                yield _sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+                return
+            except ml_utils.GenerationError as e:
+                metrics.generation_errors.inc(tariff=request.tariff, reason="backend")
+                logger.warning("Generation backend failed", extra={"user_id": user_id, "tariff": request.tariff, "error": str(e)})
+                yield _sse_event("error", {"detail": str(e)})
+                return
+            finally:
+                producer.cancel()
+            generated_text = "".join(chunks)
+            await ml_utils.generation_cache.set(request.prompt, request.tariff, generated_text)
+        usage = usages[-1] if usages else None
+        cost_minor = min(cost_minor, to_minor(ml_utils.usage_cost(request.tariff, cost, usage)))
         
-        return GenerateResponse(
-            text=generated_text,
-            cost=cost,
-            remaining_balance=user.balance
-        )
-    except Exception as e:
-        db.rollback()
-        print(f"Error during generation: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error during generation: {str(e)}"
+        user = await run_in_threadpool(db.get, User, user_id)
+        try:
+            generation = await _store_generation(db, user, request, generated_text, usage, reservation, cost_minor, started)
+        except Exception as e:
+            await run_in_threadpool(db.rollback)
+            logger.exception("Error storing generation", extra={"user_id": user_id, "tariff": request.tariff})
+            yield _sse_event("error", {"detail": f"Error during generation: {str(e)}"})
+            return
+        reservation = None
+        if not cached and request.use_cache:
+            await semantic_cache.cache.add(request.prompt, request.tariff, generation.id)
+        _observe_generation(request.tariff, started, cached)
+        yield _sse_event("done", {"cost": generation.cost, "remaining_balance": user.balance, "cached": cached})
+    finally:
+        if reservation is not None:
+            await _release_reservation(db, reservation, release_reason)
+        if holds_slot:
+            await ratelimit.limiter.release(user_id)
+        db.close()
+
+@app.post("/batch", response_model=BatchJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_batch(
+    response: Response,
+    tariff: str = Form(...),
+    file: UploadFile = File(...),
+    use_cache: bool = Form(True),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(auth.get_current_user)
+):
+    """Submit a JSONL or CSV catalogue of product specs as one background job.
+    
+    The cost of all items is reserved up front; failed items are refunded
+    when the job finishes.
+    """
+    if Tariff.get_cost(tariff) == 0:
+        raise HTTPException(status_code=400, detail="Invalid tariff type")
+    # A submission takes one token; its items are bounded by the user's
+    # concurrency cap while they run
+    response.headers.update(await _check_rate_limit(current_user.id, tariff))
+    try:
+        prompts = batch.parse_items(await file.read(), file.filename or "")
+    except batch.BatchInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        job = await run_in_threadpool(batch.create_job, db, current_user.id, tariff, prompts, use_cache)
+    except ledger.InsufficientFundsError:
+        metrics.insufficient_funds.inc(tariff=tariff)
+        raise HTTPException(status_code=402, detail="Insufficient funds")
+    batch.start(job.id)
+    return BatchJobResponse.model_validate(job)
+
+def _get_batch_job(db: Session, job_id: int, user: User) -> BatchJob:
+    job = db.query(BatchJob).filter(BatchJob.id == job_id, BatchJob.user_id == user.id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job
+
+@app.get("/batch/{job_id}", response_model=BatchJobResponse)
+def get_batch(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
+    """Get the progress of a batch job"""
+    return BatchJobResponse.model_validate(_get_batch_job(db, job_id, current_user))
+
+@app.post("/batch/{job_id}/cancel", response_model=BatchJobResponse)
+def cancel_batch(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
+    """Stop a batch job; items not started yet are refunded"""
+    job = batch.cancel_job(db, _get_batch_job(db, job_id, current_user))
+    return BatchJobResponse.model_validate(job)
+
+@app.get("/batch/{job_id}/results")
+def get_batch_results(job_id: int, format: str = "ndjson", db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
+    """Stream batch results as NDJSON or CSV while the items complete"""
+    _get_batch_job(db, job_id, current_user)
+    if format == "csv":
+        return StreamingResponse(
+            batch.stream_csv(job_id),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="batch-{job_id}.csv"'}
         )
+    if format != "ndjson":
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    return StreamingResponse(batch.stream_ndjson(job_id), media_type="application/x-ndjson")
 
 @app.get("/analytics", response_model=AnalyticsResponse)
 def get_user_analytics(db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
     """Get user analytics"""
-    user = db.query(User).filter(User.email == current_user.email).first()
+    user = current_user
     
-    generations = db.query(Generation).filter(Generation.user_id == user.id).all()
-    generations_by_tariff = {}
-    total_tokens = 0
-    total_cost = 0
-    total_processing_time = 0
+    rollup, tariff_rollups, model_rollups = rollups.get_rollups(db, user.id)
     
-    for gen in generations:
-        generations_by_tariff[gen.tariff] = generations_by_tariff.get(gen.tariff, 0) + 1
-        total_tokens += gen.tokens_used
-        total_cost += gen.cost
-        total_processing_time += gen.processing_time
+    total_generations = sum(r.generations for r in tariff_rollups)
+    total_processing_time = sum(r.processing_time for r in tariff_rollups)
     
     generation_stats = GenerationStats(
-        total_generations=len(generations),
-        total_tokens=total_tokens,
-        total_cost=total_cost,
-        avg_processing_time=total_processing_time / len(generations) if generations else 0,
-        generations_by_tariff=generations_by_tariff
+        total_generations=total_generations,
+        total_tokens=sum(r.tokens for r in tariff_rollups),
+        total_cost=from_minor(sum(r.cost_minor for r in tariff_rollups)),
+        avg_processing_time=total_processing_time / total_generations if total_generations else 0,
+        generations_by_tariff={r.tariff: r.generations for r in tariff_rollups if r.generations},
+        models={
+            r.model: ModelStats(
+                generations=r.generations,
+                prompt_tokens=r.prompt_tokens,
+                completion_tokens=r.completion_tokens,
+                tokens_per_second=r.tokens_per_second,
+                avg_load_time=r.load_duration / r.generations,
+                avg_prompt_eval_time=r.prompt_eval_duration / r.generations
+            )
+            for r in model_rollups if r.generations
+        }
     )
     
-    balance_history = db.query(BalanceHistory).filter(BalanceHistory.user_id == user.id).all()
-    total_spent = sum(h.amount for h in balance_history if h.operation_type == 'spend')
-    total_added = sum(h.amount for h in balance_history if h.operation_type == 'add')
-    
     balance_stats = BalanceStats(
         current_balance=user.balance,
-        total_spent=abs(total_spent),
-        total_added=total_added,
-        balance_history=[{
-            'amount': h.amount,
-            'type': h.operation_type,
-            'description': h.description,
-            'date': h.created_at
-        } for h in balance_history]
+        total_spent=rollup.total_spent,
+        total_added=rollup.total_added,
+        balance_operations=rollup.balance_operations
     )
     
     user_stats = UserStats(
@@ -285,71 +791,227 @@ def get_user_analytics(db: Session = Depends(get_db), current_user: User = Depen
         recent_balance_changes=recent_balance_data
     )
 
-@app.get("/history", response_model=HistoryResponse)
-def get_generation_history(
-    page: int = 1,
-    page_size: int = 10,
+@app.get("/analytics/series", response_model=AnalyticsSeriesResponse)
+def get_analytics_series(
+    period: str = "day",
+    limit: int = 30,
     db: Session = Depends(get_db),
     current_user: User = Depends(auth.get_current_user)
 ):
-    """Get user generation history with pagination"""
-    print(f"\n=== History request for user: {current_user.email} ===")
-    print(f"Page: {page}, Page size: {page_size}")
-    
-    user = db.query(User).filter(User.email == current_user.email).first()
-    if not user:
-        print(f"User not found: {current_user.email}")
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    print(f"Found user with ID: {user.id}")
+    """Generations, spend, tokens and average processing time per tariff in
+    day, week or month buckets.
     
-    total_count = db.query(Generation).filter(Generation.user_id == user.id).count()
-    print(f"Total generations found: {total_count}")
-    
-    generations = (
-        db.query(Generation)
-        .filter(Generation.user_id == user.id)
-        .order_by(Generation.created_at.desc())
+    Returns the ``limit`` most recent buckets that have generations, oldest
+    first. Only the newest bucket is recomputed after a new generation.
+    """
+    if period not in analytics.PERIODS:
+        raise HTTPException(status_code=400, detail="period must be day, week or month")
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    buckets = analytics.get_series(db, current_user.id, period, limit)
+    return AnalyticsSeriesResponse(
+        period=period,
+        buckets=[
+            SeriesBucket(
+                start=bucket["start"],
+                by_tariff={
+                    tariff: SeriesStats(
+                        generations=count,
+                        cost=from_minor(cost_minor),
+                        tokens=tokens,
+                        avg_processing_time=processing_time / count
+                    )
+                    for tariff, (count, cost_minor, tokens, processing_time) in bucket["by_tariff"].items()
+                }
+            )
+            for bucket in buckets
+        ]
+    )
+
+@app.get("/balance/history", response_model=BalanceHistoryResponse)
+def get_balance_history(
+    page: int = 1,
+    page_size: int = 20,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(auth.get_current_user)
+):
+    """Get user balance history with pagination"""
+    rollup = rollups.get_rollups(db, current_user.id)[0]
+    entries = (
+        db.query(BalanceHistory)
+        .filter(BalanceHistory.user_id == current_user.id)
+        .order_by(BalanceHistory.created_at.desc(), BalanceHistory.id.desc())
         .offset((page - 1) * page_size)
         .limit(page_size)
         .all()
     )
-    print(f"Retrieved {len(generations)} generations for page {page}")
-    
-    for gen in generations:
-        print(f"\nGeneration ID: {gen.id}")
-        print(f"Created at: {gen.created_at}")
-        print(f"Tariff: {gen.tariff}")
-        print(f"Cost: {gen.cost}")
-        print(f"Prompt length: {len(gen.prompt)}")
-        print(f"Result length: {len(gen.result)}")
-    
-    response = HistoryResponse(
-        generations=[
-            GenerationHistory(
-                id=gen.id,
-                prompt=gen.prompt,
-                result=gen.result,
-                tariff=gen.tariff,
-                cost=gen.cost,
-                created_at=gen.created_at,
-                processing_time=gen.processing_time
+    return BalanceHistoryResponse(
+        items=[
+            BalanceHistoryItem(
+                amount=h.amount,
+                type=h.operation_type,
+                description=h.description,
+                date=h.created_at
             )
-            for gen in generations
+            for h in entries
         ],
-        total_count=total_count,
+        total_count=rollup.balance_operations,
         page=page,
         page_size=page_size
     )
-    print(f"Returning response with {len(response.generations)} generations")
-    print("=== End of history request ===\n")
-    return response
-
-@app.get("/debug/generations")
-def debug_generations(db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
-    """Debug endpoint to get all generations"""
-    generations = db.query(Generation).filter(Generation.user_id == current_user.id).all()
-    return [{"id": g.id, "prompt": g.prompt, "result": g.result, "created_at": g.created_at} for g in generations]
+
+HISTORY_PREVIEW_LENGTH = 300
+
+@app.get("/history", response_model=HistoryResponse)
+def get_generation_history(
+    page: int = 1,
+    page_size: int = 10,
+    cursor: Optional[int] = None,
+    preview: bool = False,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(auth.get_current_user)
+):
+    """Get user generation history, newest first.
+    
+    Pass the ``next_cursor`` of a response as ``cursor`` to fetch the following
+    page with a keyset seek; ``page`` is only used when no cursor is given.
+    With ``preview`` the result text is truncated to a short snippet.
+    """
+    query = db.query(Generation).filter(Generation.user_id == current_user.id)
+    if preview:
+        snippet = func.substr(Generation.result, 1, HISTORY_PREVIEW_LENGTH).label("snippet")
+        query = db.query(Generation, snippet)\
+            .filter(Generation.user_id == current_user.id)\
+            .options(defer(Generation.result))
+    
+    query = query.order_by(Generation.created_at.desc(), Generation.id.desc())
+    if cursor is not None:
+        # Compare against the stored created_at of the cursor row so the seek
+        # does not depend on how the database renders timestamps
+        anchor = db.query(Generation.created_at)\
+            .filter(Generation.id == cursor, Generation.user_id == current_user.id)\
+            .scalar_subquery()
+        query = query.filter(or_(
+            Generation.created_at < anchor,
+            and_(Generation.created_at == anchor, Generation.id < cursor)
+        ))
+    else:
+        query = query.offset((page - 1) * page_size)
+    
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    
+    generations = []
+    for row in rows:
+        gen, result = row if preview else (row, row.result)
+        generations.append(GenerationHistory(
+            id=gen.id,
+            prompt=gen.prompt,
+            result=result,
+            tariff=gen.tariff,
+            cost=gen.cost,
+            created_at=gen.created_at,
+            processing_time=gen.processing_time,
+            model=gen.model,
+            tokens_used=gen.tokens_used,
+            prompt_tokens=gen.prompt_tokens,
+            tokens_per_second=gen.tokens_per_second
+        ))
+    
+    return HistoryResponse(
+        generations=generations,
+        total_count=rollups.generation_count(db, current_user.id),
+        page=page,
+        page_size=page_size,
+        next_cursor=generations[-1].id if has_more else None
+    )
+
+@app.get("/history/export")
+def export_generation_history(format: str = "ndjson", gzip: bool = False, current_user: User = Depends(auth.get_current_user)):
+    """Download every generation of the user as NDJSON or CSV, optionally gzipped.
+    
+    Rows are streamed in batches, so the export size does not affect memory.
+    """
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    filename = f"generations.{format}"
+    media_type = export.FORMATS[format]
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        export.stream(current_user.id, format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/history/{generation_id}", response_model=GenerationHistory)
+def get_generation(generation_id: int, db: Session = Depends(get_db), current_user: User = Depends(auth.get_current_user)):
+    """Get a single generation with its full result"""
+    gen = db.query(Generation)\
+        .filter(Generation.id == generation_id, Generation.user_id == current_user.id)\
+        .first()
+    if not gen:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return GenerationHistory(
+        id=gen.id,
+        prompt=gen.prompt,
+        result=gen.result,
+        tariff=gen.tariff,
+        cost=gen.cost,
+        created_at=gen.created_at,
+        processing_time=gen.processing_time,
+        model=gen.model,
+        tokens_used=gen.tokens_used,
+        prompt_tokens=gen.prompt_tokens,
+        tokens_per_second=gen.tokens_per_second
+    )
+
+@app.get("/scheduler/stats", dependencies=[Depends(auth.get_current_operator)])
+def get_scheduler_stats():
+    """Get queue depth and wait time per model"""
+    return scheduler.stats()
+
+@app.get("/models/stats", dependencies=[Depends(auth.get_current_operator)])
+def get_model_stats():
+    """Get resident models, traffic scores, cold starts and evictions per host"""
+    return {host: manager.stats() for host, manager in ml_utils.models.items()}
+
+@app.get("/backends/stats", dependencies=[Depends(auth.get_current_operator)])
+def get_backend_stats():
+    """Get health, served models and outstanding requests per Ollama host"""
+    return backends.pool.stats()
+
+@app.get("/cache/stats", dependencies=[Depends(auth.get_current_operator)])
+def get_cache_stats():
+    """Get generation cache, semantic cache and in-flight coalescing counters"""
+    return {
+        **ml_utils.generation_cache.stats(),
+        "inflight": ml_utils.inflight.stats(),
+        "semantic": semantic_cache.cache.stats(),
+        "analytics_series": analytics.series_cache.stats()
+    }
+
+@app.get("/cache/semantic/samples", dependencies=[Depends(auth.get_current_operator)])
+def get_semantic_cache_samples():
+    """Recently sampled semantic cache hits with both prompts, for reviewing false positives"""
+    return list(semantic_cache.cache.samples)
+
+@app.get("/healthz")
+async def get_liveness():
+    """Liveness: the worker's event loop is serving requests"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def get_readiness():
+    """Readiness: 200 once warm-up has finished, 503 with the progress of each step before"""
+    return UTF8JSONResponse(warmup.status(), status_code=200 if warmup.ready else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text exposition of the process metrics"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/users/me")
 def get_current_user_info(current_user: User = Depends(auth.get_current_user)):
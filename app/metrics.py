@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics rendered in the Prometheus text exposition format.
+
+Metrics are kept per worker process; scrape each worker (or run a single
+worker per container) to aggregate them.
+"""
+import threading
+import time
+from typing import Callable, Dict, Iterable, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class Gauge(_Metric):
+    """Gauge whose samples are collected from a callback at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...], collect: Callable[[], Dict[tuple, float]]):
+        super().__init__(name, documentation, labelnames)
+        self._collect = collect
+
+    def _samples(self):
+        for key, value in self._collect().items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class CallbackCounter(Gauge):
+    """Counter whose samples are read from existing running totals at scrape time"""
+    kind = 'counter'
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += 1
+            state[2] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: ([*state[0]], state[1], state[2]) for key, state in self._values.items()}
+        bucket_labels = self.labelnames + ('le',)
+        for key, (counts, count, total) in values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_format_labels(bucket_labels, key + (bound,))} {bucket_count}"
+            yield f"{self.name}_bucket{_format_labels(bucket_labels, key + ('+Inf',))} {count}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+# HTTP
+http_requests = Counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route")
+)
+
+# Generation
+generation_duration = Histogram(
+    "generation_duration_seconds", "End-to-end generation latency", ("tariff", "model")
+)
+generation_phase_duration = Histogram(
+    "generation_phase_seconds", "Generation latency split into queue, backend and db phases", ("tariff", "model", "phase")
+)
+generation_errors = Counter(
+    "generation_errors_total", "Failed generations by reason", ("tariff", "reason")
+)
+generation_cancellations = Counter(
+    "generation_cancellations_total", "Generations aborted and refunded because the client disconnected or the deadline passed", ("tariff", "reason")
+)
+insufficient_funds = Counter(
+    "insufficient_funds_total", "Generations rejected for insufficient balance", ("tariff",)
+)
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by its route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - start, method=scope["method"], route=route_path)
+            http_requests.inc(method=scope["method"], route=route_path, status=status_code)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Database schema migration, run once per deployment rather than by every worker.
+
+    python -m app.migrate           bring the schema up to date
+    python -m app.migrate --check   list what is missing; exits 1 if anything is
+
+The schema is brought in line with app/models.py additively: missing tables
+are created with their indexes, missing columns are added to existing
+tables (e.g. the model and token columns of ``generations`` or
+``user_model_rollups`` on a database created before they existed) and
+missing indexes are created. Nothing is dropped or altered, so running it
+again, or against an up to date database, is a no-op.
+
+A column that takes over the data of one the models no longer define is
+filled from it by a backfill registered with backfill(), in the same
+transaction that adds it. Adding a NOT NULL column next to such leftover
+columns without a backfill is refused: existing rows would silently get
+the column's default instead of their data.
+
+Users with history from before the analytics rollups existed get their
+rollups backfilled last (see app/rollups.py).
+
+Workers check during warm-up that nothing is left to do and stay unready
+until then (see app/warmup.py).
+"""
+import argparse
+import logging
+import sys
+from typing import Dict, List, Tuple
+
+from sqlalchemy import inspect, literal
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import Column, CreateColumn
+
+from . import models  # noqa: F401  registers every table on Base.metadata
+from . import rollups
+from .database import Base, engine
+from .models import MINOR_UNITS
+
+logger = logging.getLogger(__name__)
+
+class MigrationError(Exception):
+    """Raised when a difference cannot be fixed by adding to the schema"""
+
+# (table, column) -> (columns it replaces, SQL expression over them)
+BACKFILLS: Dict[Tuple[str, str], Tuple[Tuple[str, ...], str]] = {}
+
+def backfill(table: str, column: str, replaces: Tuple[str, ...], expression: str):
+    """Fill ``table.column`` from the columns it ``replaces`` when a migration adds it"""
+    BACKFILLS[(table, column)] = (tuple(replaces), expression)
+
+# Money moved from float credits to integer minor units
+backfill("users", "balance_minor", ("balance",), f"CAST(ROUND(COALESCE(balance, 0) * {MINOR_UNITS}) AS INTEGER)")
+backfill("balance_history", "amount_minor", ("amount",), f"CAST(ROUND(amount * {MINOR_UNITS}) AS INTEGER)")
+backfill("generations", "cost_minor", ("cost",), f"CAST(ROUND(cost * {MINOR_UNITS}) AS INTEGER)")
+
+def _missing(conn: Connection) -> tuple:
+    """
+    Tables, (table, column, backfill) triples and indexes of the models that
+    the database lacks; the backfill is None or the replaced columns and the
+    expression filling the column from them.
+
+    Raises:
+        MigrationError: If a NOT NULL column would replace leftover columns without a backfill
+    """
+    inspector = inspect(conn)
+    existing = set(inspector.get_table_names())
+    tables, columns, indexes = [], [], []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            tables.append(table)
+            continue
+        present = {c["name"] for c in inspector.get_columns(table.name)}
+        added = []
+        for column in table.columns:
+            if column.name not in present:
+                filler = BACKFILLS.get((table.name, column.name))
+                added.append((table, column, filler if filler is not None and set(filler[0]) <= present else None))
+        replaced = {name for _, _, filler in added if filler is not None for name in filler[0]}
+        leftover = present - {c.name for c in table.columns} - replaced
+        for _, column, filler in added:
+            if filler is None and leftover and not column.nullable and column.server_default is None:
+                raise MigrationError(
+                    f"{table.name}.{column.name} may replace {', '.join(sorted(leftover))}; "
+                    f"register a backfill for it in app/migrate.py"
+                )
+        columns.extend(added)
+        present = {i["name"] for i in inspector.get_indexes(table.name)}
+        indexes.extend(i for i in table.indexes if i.name not in present)
+    return tables, columns, indexes
+
+def pending(conn: Connection) -> List[str]:
+    """
+    What a migration would do, one line per change; empty when it has nothing left to do.
+
+    Raises:
+        MigrationError: If the migration would refuse to run
+    """
+    tables, columns, indexes = _missing(conn)
+    changes = [f"create table {t.name}" for t in tables] + \
+        [f"add column {t.name}.{c.name}" + (f", filled from {', '.join(f[0])}" if f else "") for t, c, f in columns] + \
+        [f"create index {i.name} on {i.table.name}" for i in indexes]
+    # The rollups can only be counted once the tables they aggregate are complete;
+    # until then upgrade() backfills them after changing the schema
+    return changes or _rollup_changes(_rollup_users(conn))
+
+def _rollup_users(conn: Connection) -> List[int]:
+    with Session(bind=conn) as db:
+        return rollups.users_to_backfill(db)
+
+def _rollup_changes(user_ids: List[int]) -> List[str]:
+    return [f"backfill rollups of {len(user_ids)} users"] if user_ids else []
+
+def _add_column_ddl(conn: Connection, table, column: Column) -> str:
+    ddl = str(CreateColumn(column).compile(dialect=conn.dialect))
+    if not column.nullable and column.server_default is None:
+        # Existing rows need a value: a constant Python default, overwritten by the backfill if there is one
+        if column.default is None or not column.default.is_scalar:
+            raise MigrationError(f"{table.name}.{column.name} is NOT NULL without a constant default")
+        default = literal(column.default.arg).compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+        ddl += f" DEFAULT {default}"
+    return f"ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} ADD COLUMN {ddl}"
+
+def upgrade(bind=engine) -> List[str]:
+    """
+    Bring the schema up to date and backfill added columns, in one transaction.
+
+    Returns:
+        list: The changes made, as listed by pending()
+
+    Raises:
+        MigrationError: If a missing column cannot be added to existing rows
+    """
+    with bind.begin() as conn:
+        changes = pending(conn)
+        tables, columns, indexes = _missing(conn)
+        Base.metadata.create_all(bind=conn, tables=tables)
+        for table, column, filler in columns:
+            conn.exec_driver_sql(_add_column_ddl(conn, table, column))
+            if filler is not None:
+                preparer = conn.dialect.identifier_preparer
+                conn.exec_driver_sql(
+                    f"UPDATE {preparer.format_table(table)} SET {preparer.format_column(column)} = {filler[1]}"
+                )
+        for index in indexes:
+            index.create(bind=conn)
+        user_ids = _rollup_users(conn)
+        if tables or columns or indexes:
+            changes += _rollup_changes(user_ids)
+        with Session(bind=conn) as db:
+            rollups.backfill(db, user_ids)
+    for change in changes:
+        logger.info("Migrated schema", extra={"change": change})
+    return changes
+
+def check(bind=engine) -> List[str]:
+    """pending() on a connection of its own"""
+    with bind.connect() as conn:
+        return pending(conn)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="Only list the pending changes")
+    args = parser.parse_args()
+    try:
+        changes = check() if args.check else upgrade()
+    except MigrationError as e:
+        print(f"Migration failed: {e}", file=sys.stderr)
+        sys.exit(2)
+    for change in changes:
+        print(change)
+    if not changes:
+        print("Nothing to migrate")
+    elif args.check:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
-import ollama
+import asyncio
+import hashlib
+import logging
+import math
 import os
-from typing import Dict
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Union
 
-# Configure Ollama client
-OLLAMA_HOST = os.getenv('OLLAMA_HOST', 'http://localhost:11434')
-ollama.Client(host=OLLAMA_HOST)
+from . import metrics
+from .backends import CONNECTION_ERRORS, Backend, NoBackendError, import_client_library, pool
+from .database import SessionLocal
+from .models import CachedGeneration
+
+logger = logging.getLogger(__name__)
 
 # Map tariffs to model names
 MODEL_MAP = {
@@ -14,40 +25,625 @@ MODEL_MAP = {
     "premium": "gemma3:12b"
 }
 
-def generate_text(prompt: str, tariff: str) -> str:
+SYSTEM_PROMPT = """
+    You are a helpful seller assistant that generates text based on the user's request.
+    You should generate text on RUSSIAN that is relevant to the user's request and is appropriate for the selected tariff.
+    Your task is to write ONLY a very saleable sales description in RUSSIAN for a product based on the provided specifications.
+    Reply only in RUSSIAN.
+    """
+
+GENERATION_OPTIONS = {
+    "num_predict": 2048
+}
+
+# Server-side deadline for interactive generations in seconds (0 = none);
+# clients can ask for a shorter one with the X-Request-Timeout header
+GENERATION_TIMEOUT = float(os.getenv('GENERATION_TIMEOUT', '0'))
+
+class GenerationError(Exception):
+    """Raised when the model backend fails to produce a result"""
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is abandoned because its client disconnected or its deadline passed"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Generation cancelled: {reason}")
+        self.reason = reason
+
+def _pairs_setting(name: str, default: str) -> Dict[str, str]:
+    """Parse ``key=value,key=value`` from the environment"""
+    pairs = {}
+    for part in filter(None, (p.strip() for p in os.getenv(name, default).split(','))):
+        key, _, value = part.rpartition('=')
+        pairs[key] = value
+    return pairs
+
+# Model lifecycle
+# How long each tariff's model stays loaded after a request (Ollama duration
+# syntax; -1 keeps it loaded until it is evicted)
+MODEL_KEEP_ALIVE = _pairs_setting('MODEL_KEEP_ALIVE', 'premium=-1,pro=30m,standart=10m')
+# Tariffs whose models are loaded at startup, most important first
+MODEL_PRELOAD = [t for t in os.getenv('MODEL_PRELOAD', 'premium,pro,standart').split(',') if t.strip()]
+# Memory the resident models may use in total; 0 leaves eviction to Ollama
+MODEL_RAM_BUDGET_GB = float(os.getenv('MODEL_RAM_BUDGET_GB', '0'))
+# Resident size per model until Ollama reports the real one
+MODEL_SIZES_GB = {
+    model: float(size)
+    for model, size in _pairs_setting('MODEL_SIZES_GB', 'gemma3:1b=1.0,gemma3:4b=3.5,gemma3:12b=8.5').items()
+}
+MODEL_TRAFFIC_HALF_LIFE = float(os.getenv('MODEL_TRAFFIC_HALF_LIFE', '600'))
+MODEL_COLD_START_THRESHOLD = float(os.getenv('MODEL_COLD_START_THRESHOLD', '0.5'))
+
+model_loads = metrics.Histogram(
+    "model_load_seconds", "Time Ollama spent loading a model before generating", ("model",),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+)
+model_cold_starts = metrics.Counter(
+    "model_cold_starts_total", "Requests that had to wait for their model to load", ("model", "tariff")
+)
+model_evictions = metrics.Counter(
+    "model_evictions_total", "Models unloaded to stay within the memory budget", ("model",)
+)
+
+def _keep_alive(tariff: str) -> Union[float, str, None]:
+    value = MODEL_KEEP_ALIVE.get(tariff)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+class ModelManager:
+    """
+    Decide which models stay resident on one Ollama host.
+
+    Every request bumps its model's traffic score, which decays with
+    MODEL_TRAFFIC_HALF_LIFE. When loading a model would exceed the memory
+    budget, idle resident models are unloaded lowest score first, so a
+    model that is both stale and rarely used goes before a busy one.
+    """
+
+    def __init__(self, backend: Backend, budget_gb: float, sizes: Dict[str, float], half_life: float):
+        self.backend = backend
+        self.budget_gb = budget_gb
+        self.sizes = dict(sizes)
+        self.half_life = half_life
+        self.resident: Dict[str, float] = {}
+        self.active: Dict[str, int] = {}
+        self._scores: Dict[str, tuple] = {}
+        # Created on first use: on Python 3.9 a Lock binds to the loop current
+        # when it is made, and managers are built at import
+        self._lock: Optional[asyncio.Lock] = None
+        self.cold_starts = 0
+        self.evictions = 0
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def score(self, model: str, now: Optional[float] = None) -> float:
+        score, updated_at = self._scores.get(model, (0.0, 0.0))
+        now = time.monotonic() if now is None else now
+        return score * math.pow(0.5, (now - updated_at) / self.half_life)
+
+    def _touch(self, model: str):
+        now = time.monotonic()
+        self._scores[model] = (self.score(model, now) + 1.0, now)
+
+    def size(self, model: str) -> float:
+        return self.sizes.get(model, 0.0)
+
+    async def acquire(self, model: str, tariff: str) -> Union[float, str, None]:
+        """Account for a request and make room for its model; returns its keep_alive"""
+        self._touch(model)
+        if self.budget_gb and model not in self.resident:
+            async with self.lock:
+                if model not in self.resident:
+                    await self._make_room(model)
+                    self.resident[model] = self.size(model)
+        self.active[model] = self.active.get(model, 0) + 1
+        return _keep_alive(tariff)
+
+    def release(self, model: str):
+        self.active[model] -= 1
+
+    async def _make_room(self, model: str):
+        used = sum(self.resident.values())
+        victims = sorted(
+            (m for m in self.resident if m != model and not self.active.get(m)),
+            key=self.score
+        )
+        while victims and used + self.size(model) > self.budget_gb:
+            victim = victims.pop(0)
+            try:
+                await self.backend.client.generate(model=victim, keep_alive=0)
+            except Exception as e:
+                logger.warning("Error unloading model", extra={"host": self.backend.host, "model": victim, "error": str(e)})
+                continue
+            used -= self.resident.pop(victim)
+            self.evictions += 1
+            model_evictions.inc(model=victim)
+            logger.info("Unloaded model", extra={"host": self.backend.host, "model": victim, "for_model": model})
+        if used + self.size(model) > self.budget_gb:
+            logger.warning("Model memory budget exceeded", extra={"host": self.backend.host, "model": model, "used_gb": used, "budget_gb": self.budget_gb})
+
+    def record_load(self, model: str, tariff: str, load_duration_ns: Optional[int]):
+        """Record Ollama's load_duration of a response as a cold start when it is significant"""
+        if not load_duration_ns:
+            return
+        seconds = load_duration_ns / 1e9
+        model_loads.observe(seconds, model=model)
+        if seconds >= MODEL_COLD_START_THRESHOLD:
+            self.cold_starts += 1
+            model_cold_starts.inc(model=model, tariff=tariff)
+            logger.info("Model cold start", extra={"host": self.backend.host, "model": model, "tariff": tariff, "load_seconds": round(seconds, 3)})
+
+    async def refresh(self):
+        """Adopt the models Ollama actually has loaded and their real sizes"""
+        running = await self.backend.client.ps()
+        self.resident = {}
+        for entry in running.models:
+            if entry.size:
+                self.sizes[entry.model] = entry.size / 1024 ** 3
+            self.resident[entry.model] = self.size(entry.model)
+
+    async def preload(self, tariffs: Iterable[str]):
+        """Load the tariffs' models in order while they fit in the budget"""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("Error listing loaded models", extra={"host": self.backend.host, "error": str(e)})
+            return
+        for tariff in tariffs:
+            model = MODEL_MAP.get(tariff.strip())
+            if model is None or model in self.resident or self.backend not in pool.hosts_for(model):
+                continue
+            if self.budget_gb and sum(self.resident.values()) + self.size(model) > self.budget_gb:
+                logger.info("Skipping preload over the memory budget", extra={"host": self.backend.host, "model": model})
+                continue
+            try:
+                response = await self.backend.client.generate(model=model, keep_alive=_keep_alive(tariff))
+            except Exception as e:
+                logger.warning("Error preloading model", extra={"host": self.backend.host, "model": model, "error": str(e)})
+                continue
+            self.resident[model] = self.size(model)
+            model_loads.observe((response.get('load_duration') or 0) / 1e9, model=model)
+            logger.info("Preloaded model", extra={"host": self.backend.host, "model": model, "tariff": tariff})
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "budget_gb": self.budget_gb,
+            "resident": self.resident,
+            "used_gb": sum(self.resident.values()),
+            "active": {m: n for m, n in self.active.items() if n},
+            "traffic_score": {m: round(self.score(m, now), 3) for m in self._scores},
+            "cold_starts": self.cold_starts,
+            "evictions": self.evictions
+        }
+
+# Residency is decided per host; the budget applies to each of them
+models: Dict[str, ModelManager] = {
+    backend.host: ModelManager(backend, MODEL_RAM_BUDGET_GB, MODEL_SIZES_GB, MODEL_TRAFFIC_HALF_LIFE)
+    for backend in pool.backends
+}
+
+def _is_resident(model: str) -> Callable[[Backend], bool]:
+    return lambda backend: model in models[backend.host].resident
+
+class Usage:
+    """Token counts and timings Ollama reports with a finished generation"""
+
+    def __init__(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 load_duration: float = 0.0, prompt_eval_duration: float = 0.0, eval_duration: float = 0.0):
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.load_duration = load_duration
+        self.prompt_eval_duration = prompt_eval_duration
+        self.eval_duration = eval_duration
+
+    @classmethod
+    def from_response(cls, model: str, response) -> 'Usage':
+        """Read the statistics of a non-streaming response or the final stream chunk"""
+        return cls(
+            model,
+            prompt_tokens=response.get('prompt_eval_count') or 0,
+            completion_tokens=response.get('eval_count') or 0,
+            load_duration=(response.get('load_duration') or 0) / 1e9,
+            prompt_eval_duration=(response.get('prompt_eval_duration') or 0) / 1e9,
+            eval_duration=(response.get('eval_duration') or 0) / 1e9
+        )
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.eval_duration if self.eval_duration else 0.0
+
+    def columns(self) -> dict:
+        """Values for the matching Generation columns"""
+        return {
+            "model": self.model,
+            "tokens_used": self.completion_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "load_duration": self.load_duration,
+            "prompt_eval_duration": self.prompt_eval_duration,
+            "eval_duration": self.eval_duration
+        }
+
+class Completion:
+    """Generated text together with what it took to produce"""
+
+    def __init__(self, text: str, usage: Usage):
+        self.text = text
+        self.usage = usage
+
+def usage_columns(usage: Optional[Usage]) -> dict:
+    """Generation column values; a cached result (no usage) generated no tokens"""
+    return usage.columns() if usage is not None else {"tokens_used": 0}
+
+model_tokens = metrics.Counter(
+    "model_tokens_total", "Tokens processed by the backend", ("model", "kind")
+)
+model_tokens_per_second = metrics.Histogram(
+    "model_tokens_per_second", "Decoding speed of finished generations", ("model",),
+    buckets=(1, 2, 5, 10, 20, 40, 80, 160)
+)
+
+def _record_usage(usage: Usage):
+    model_tokens.inc(usage.prompt_tokens, model=usage.model, kind="prompt")
+    model_tokens.inc(usage.completion_tokens, model=usage.model, kind="completion")
+    if usage.eval_duration:
+        model_tokens_per_second.observe(usage.tokens_per_second, model=usage.model)
+
+def _get_model(tariff: str) -> str:
+    model_name = MODEL_MAP.get(tariff)
+    if not model_name:
+        raise GenerationError("Invalid tariff selected")
+    return model_name
+
+def _decode(piece) -> str:
+    if isinstance(piece, bytes):
+        return piece.decode('utf-8')
+    return str(piece)
+
+async def generate_text(prompt: str, tariff: str) -> Completion:
     """
     Generate text using Ollama's Gemma models based on the selected tariff.
-    
+
     Args:
         prompt (str): The input prompt for text generation
         tariff (str): The tariff level (standart, pro, or premium)
-        
+
     Returns:
-        str: Generated text response
-    """
-    system_prompt = f"""
-    You are a helpful seller assistant that generates text based on the user's request.
-    You should generate text on RUSSIAN that is relevant to the user's request and is appropriate for the selected tariff.
-    Your task is to write ONLY a very saleable sales description in RUSSIAN for a product based on the provided specifications.
-    Reply only in RUSSIAN.
+        Completion: Generated text with the backend's token counts and timings
+
+    Raises:
+        GenerationError: If the tariff is unknown or the backend call fails
     """
+    model_name = _get_model(tariff)
+
+    async def _call(backend: Backend):
+        manager = models[backend.host]
+        keep_alive = await manager.acquire(model_name, tariff)
+        try:
+            response = await backend.client.generate(
+                model=model_name,
+                prompt=SYSTEM_PROMPT + "\n" + prompt,
+                stream=False,
+                options=GENERATION_OPTIONS,
+                keep_alive=keep_alive
+            )
+        finally:
+            manager.release(model_name)
+        manager.record_load(model_name, tariff, response.get('load_duration'))
+        return response
+
     try:
-        model_name = MODEL_MAP.get(tariff)
-        if not model_name:
-            return "Error: Invalid tariff selected"
-            
-        response = ollama.generate(
-            model=model_name,
-            prompt=system_prompt + "\n" + prompt,
-            stream=False,
-            options={
-                "num_predict": 2048
-            }
-        )
-        
-        if isinstance(response['response'], bytes):
-            return response['response'].decode('utf-8')
-        return str(response['response'])
-        
+        response = await pool.call(model_name, _call, _is_resident(model_name))
     except Exception as e:
-        return f"Error generating text: {str(e)}"
\ No newline at end of file
+        raise GenerationError(f"Error generating text: {str(e)}") from e
+    usage = Usage.from_response(model_name, response)
+    _record_usage(usage)
+    return Completion(_decode(response['response']), usage)
+
+async def generate_text_stream(prompt: str, tariff: str, on_usage: Callable[[Usage], None] = None) -> AsyncIterator[str]:
+    """
+    Stream generated text from Ollama token by token.
+
+    Args:
+        prompt (str): The input prompt for text generation
+        tariff (str): The tariff level (standart, pro, or premium)
+        on_usage: Called with the token counts and timings when the model is done
+
+    Yields:
+        str: Pieces of the generated text as the model produces them
+
+    Raises:
+        GenerationError: If the tariff is unknown or the backend call fails
+    """
+    model_name = _get_model(tariff)
+    tried = set()
+    while True:
+        try:
+            backend = pool.choose(model_name, tried, _is_resident(model_name))
+        except NoBackendError as e:
+            raise GenerationError(f"Error generating text: {str(e)}") from e
+        manager = models[backend.host]
+        started = False
+        async with pool.lease(backend, model_name):
+            keep_alive = await manager.acquire(model_name, tariff)
+            try:
+                stream = await backend.client.generate(
+                    model=model_name,
+                    prompt=SYSTEM_PROMPT + "\n" + prompt,
+                    stream=True,
+                    options=GENERATION_OPTIONS,
+                    keep_alive=keep_alive
+                )
+                async for chunk in stream:
+                    started = True
+                    if chunk.get('done'):
+                        manager.record_load(model_name, tariff, chunk.get('load_duration'))
+                        usage = Usage.from_response(model_name, chunk)
+                        _record_usage(usage)
+                        if on_usage is not None:
+                            on_usage(usage)
+                    piece = _decode(chunk['response'])
+                    if piece:
+                        yield piece
+                return
+            except CONNECTION_ERRORS as e:
+                # Fail over only while nothing has been sent to the client
+                if started or not pool.failover(backend, model_name, e, tried):
+                    raise GenerationError(f"Error generating text: {str(e)}") from e
+            except Exception as e:
+                raise GenerationError(f"Error generating text: {str(e)}") from e
+            finally:
+                manager.release(model_name)
+
+# Generation result cache
+GENERATION_CACHE_SIZE = int(os.getenv('GENERATION_CACHE_SIZE', '1024'))
+GENERATION_CACHE_TTL = float(os.getenv('GENERATION_CACHE_TTL', '3600'))
+GENERATION_CACHE_PERSIST = os.getenv('GENERATION_CACHE_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+# What a cache hit costs: "full" tariff price or "free"
+CACHE_HIT_BILLING = os.getenv('CACHE_HIT_BILLING', 'full')
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and unicode forms so trivially different prompts match"""
+    return unicodedata.normalize('NFC', ' '.join(prompt.split()))
+
+def cache_key(prompt: str, tariff: str) -> str:
+    model_name = _get_model(tariff)
+    payload = '\0'.join((model_name, tariff, normalize_prompt(prompt)))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class GenerationCache:
+    """
+    Exact-match cache of generation results.
+
+    Entries live in an in-process LRU bounded by size and TTL. When
+    ``persist`` is enabled they are also written to the generation_cache
+    table so hits survive restarts and are shared between workers.
+    """
+
+    def __init__(self, max_size: int, ttl: float, persist: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    async def get(self, prompt: str, tariff: str) -> Optional[str]:
+        key = cache_key(prompt, tariff)
+        result = self._get_memory(key)
+        if result is None and self.persist:
+            result = await asyncio.to_thread(self._get_persistent, key)
+            if result is not None:
+                self.persistent_hits += 1
+                self._set_memory(key, result)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    async def set(self, prompt: str, tariff: str, result: str):
+        key = cache_key(prompt, tariff)
+        self._set_memory(key, result)
+        if self.persist:
+            await asyncio.to_thread(self._set_persistent, key, tariff, result)
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def _set_memory(self, key: str, result: str):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_persistent(self, key: str) -> Optional[str]:
+        db = SessionLocal()
+        try:
+            entry = db.get(CachedGeneration, key)
+            if entry is None:
+                return None
+            if entry.created_at < datetime.utcnow() - timedelta(seconds=self.ttl):
+                db.delete(entry)
+                db.commit()
+                return None
+            return entry.result
+        finally:
+            db.close()
+
+    def _set_persistent(self, key: str, tariff: str, result: str):
+        db = SessionLocal()
+        try:
+            db.merge(CachedGeneration(
+                key=key,
+                tariff=tariff,
+                model=MODEL_MAP[tariff],
+                result=result,
+                created_at=datetime.utcnow()
+            ))
+            db.commit()
+        except Exception as e:
+            # A failed cache write must never fail the generation itself
+            db.rollback()
+            logger.warning("Error writing generation cache", extra={"tariff": tariff, "error": str(e)})
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "persist": self.persist,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+generation_cache = GenerationCache(GENERATION_CACHE_SIZE, GENERATION_CACHE_TTL, GENERATION_CACHE_PERSIST)
+
+def cache_hit_cost(cost: float) -> float:
+    """Price of serving a tariff request from the cache"""
+    if CACHE_HIT_BILLING == 'free':
+        return 0.0
+    return cost
+
+# Per-token tariffs: credits per 1000 tokens (prompt and completion), e.g.
+# "premium=0.02". The flat tariff cost is still reserved up front and caps
+# the charge; tariffs without a price are billed flat.
+TOKEN_PRICES = {tariff: float(price) for tariff, price in _pairs_setting('TOKEN_PRICES', '').items()}
+
+def usage_cost(tariff: str, cost: float, usage: Optional[Usage]) -> float:
+    """Price of a generation given what the backend reports it used"""
+    price = TOKEN_PRICES.get(tariff)
+    if price is None or usage is None:
+        return cost
+    return min(cost, price * (usage.prompt_tokens + usage.completion_tokens) / 1000)
+
+class SingleFlight:
+    """
+    Coalesce identical in-flight calls.
+
+    The first caller for a key starts the work; callers arriving while it
+    is still running await the same task instead of starting their own.
+    The task is shielded so one caller going away does not cancel it for
+    the others, and cancelled once the last caller has gone away.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    # Nobody is left to read the result
+                    task.cancel()
+                    self.abandoned += 1
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved when nobody is left to await it
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned
+        }
+
+inflight = SingleFlight()
+
+metrics.Gauge(
+    "model_resident_gb", "Memory of the models believed to be loaded in Ollama", ("host", "model"),
+    lambda: {(host, model): size for host, manager in models.items() for model, size in list(manager.resident.items())}
+)
+metrics.Gauge(
+    "model_traffic_score", "Decayed request count used to pick eviction victims", ("host", "model"),
+    lambda: {(host, model): manager.score(model) for host, manager in models.items() for model in list(manager._scores)}
+)
+metrics.CallbackCounter(
+    "generation_cache_lookups_total", "Generation cache lookups by result", ("result",),
+    lambda: {
+        ("hit",): generation_cache.hits - generation_cache.persistent_hits,
+        ("persistent_hit",): generation_cache.persistent_hits,
+        ("miss",): generation_cache.misses
+    }
+)
+metrics.CallbackCounter(
+    "generation_inflight_calls_total", "Generations started, joined to an identical in-flight call or abandoned by every caller", ("outcome",),
+    lambda: {("started",): inflight.started, ("coalesced",): inflight.coalesced, ("abandoned",): inflight.abandoned}
+)
+metrics.Gauge(
+    "generation_inflight", "Distinct generations currently in flight", (),
+    lambda: {(): len(inflight._calls)}
+)
+
+_preload_task = None
+
+async def _preload():
+    await asyncio.gather(*[manager.preload(MODEL_PRELOAD) for manager in models.values()])
+
+async def warm_up():
+    """
+    Import the client library, check every backend once, then start the
+    periodic health checks and preload the configured models.
+
+    Preloading runs in the background: a worker is ready to serve once it
+    knows which backends are up, not once every model is resident.
+    """
+    global _preload_task
+    await import_client_library()
+    await pool.check_all()
+    pool.start()
+    _preload_task = asyncio.ensure_future(_preload())
+
+async def close():
+    """Stop preloading and health checks and close the pooled backend connections"""
+    if _preload_task is not None:
+        _preload_task.cancel()
+    await pool.close()
@@ -1,21 +1,36 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, Index, Boolean
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from datetime import datetime
+from typing import Optional
 from .database import Base
 
+# Money is stored as integer minor units (1/100 of a credit)
+MINOR_UNITS = 100
+
+def to_minor(amount: float) -> int:
+    return int(round(amount * MINOR_UNITS))
+
+def from_minor(amount_minor: int) -> float:
+    return (amount_minor or 0) / MINOR_UNITS
+
 class User(Base):
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
-    balance = Column(Float, default=0.0)
+    balance_minor = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     last_login = Column(DateTime(timezone=True), nullable=True)
     
     # Relationships
     generations = relationship("Generation", back_populates="user")
     balance_history = relationship("BalanceHistory", back_populates="user")
+    
+    @property
+    def balance(self) -> float:
+        return from_minor(self.balance_minor)
 
 class Generation(Base):
     __tablename__ = "generations"
@@ -25,26 +40,54 @@ class Generation(Base):
     prompt = Column(Text)
     result = Column(Text)
     tariff = Column(String)
-    cost = Column(Float)
-    tokens_used = Column(Integer)
+    cost_minor = Column(Integer)
+    tokens_used = Column(Integer)  # completion tokens reported by the model
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    processing_time = Column(Float)  # in seconds
+    processing_time = Column(Float)  # in seconds, until the result was ready
+    # As reported by Ollama; empty for results served from the cache
+    model = Column(String, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    load_duration = Column(Float, nullable=True)  # in seconds
+    prompt_eval_duration = Column(Float, nullable=True)  # in seconds
+    eval_duration = Column(Float, nullable=True)  # in seconds
     
     # Relationships
     user = relationship("User", back_populates="generations")
+    
+    @property
+    def cost(self) -> float:
+        return from_minor(self.cost_minor)
+    
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if not self.eval_duration:
+            return None
+        return self.tokens_used / self.eval_duration
+    
+    __table_args__ = (
+        Index("ix_generations_user_created", "user_id", "created_at", "id"),
+    )
 
 class BalanceHistory(Base):
     __tablename__ = "balance_history"
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    amount = Column(Float)
-    operation_type = Column(String)  # 'add' or 'spend'
+    amount_minor = Column(Integer)
+    operation_type = Column(String)  # 'add', 'spend', 'reserve' or 'release'
     description = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
     user = relationship("User", back_populates="balance_history")
+    
+    @property
+    def amount(self) -> float:
+        return from_minor(self.amount_minor)
+    
+    __table_args__ = (
+        Index("ix_balance_history_user_created", "user_id", "created_at"),
+    )
 
 class Tariff(Base):
     __tablename__ = "tariffs"
@@ -62,4 +105,158 @@ class Tariff(Base):
             "pro": 4.0,
             "premium": 12.0
         }
-        return tariffs.get(tariff_name, 0.0)
\ No newline at end of file
+        return tariffs.get(tariff_name, 0.0)
+
+class CachedGeneration(Base):
+    __tablename__ = "generation_cache"
+
+    key = Column(String(64), primary_key=True)
+    tariff = Column(String)
+    model = Column(String)
+    result = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class UserRollup(Base):
+    """Running per-user balance totals, maintained alongside every balance change"""
+    __tablename__ = "user_rollups"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    total_spent_minor = Column(Integer, nullable=False, default=0)
+    total_added_minor = Column(Integer, nullable=False, default=0)
+    balance_operations = Column(Integer, nullable=False, default=0)
+    
+    @property
+    def total_spent(self) -> float:
+        return from_minor(self.total_spent_minor)
+    
+    @property
+    def total_added(self) -> float:
+        return from_minor(self.total_added_minor)
+
+
+class UserTariffRollup(Base):
+    """Running per-user, per-tariff generation totals"""
+    __tablename__ = "user_tariff_rollups"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    tariff = Column(String, primary_key=True)
+    generations = Column(Integer, nullable=False, default=0)
+    tokens = Column(Integer, nullable=False, default=0)
+    cost_minor = Column(Integer, nullable=False, default=0)
+    processing_time = Column(Float, nullable=False, default=0.0)
+    
+    @property
+    def cost(self) -> float:
+        return from_minor(self.cost_minor)
+
+
+class UserModelRollup(Base):
+    """Running per-user, per-model token counts and Ollama timings"""
+    __tablename__ = "user_model_rollups"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    model = Column(String, primary_key=True)
+    generations = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    load_duration = Column(Float, nullable=False, default=0.0)
+    prompt_eval_duration = Column(Float, nullable=False, default=0.0)
+    eval_duration = Column(Float, nullable=False, default=0.0)
+    
+    @property
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.eval_duration if self.eval_duration else 0.0
+
+
+class BatchJob(Base):
+    """A catalogue of prompts generated in the background under one reservation"""
+    __tablename__ = "batch_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    tariff = Column(String)
+    status = Column(String, nullable=False, default='queued')  # 'queued', 'running', 'completed', 'failed' or 'cancelled'
+    total_items = Column(Integer, nullable=False, default=0)
+    completed_items = Column(Integer, nullable=False, default=0)
+    failed_items = Column(Integer, nullable=False, default=0)
+    item_cost_minor = Column(Integer, nullable=False, default=0)
+    reservation_id = Column(Integer, ForeignKey("balance_history.id"), nullable=True)
+    use_cache = Column(Boolean, nullable=False, default=True)
+    # Unix time until which the process running the job owns it; only that
+    # process claims its items and finishes it, until the lease expires
+    lease_expires = Column(Float, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    items = relationship("BatchItem", back_populates="job")
+    
+    @property
+    def item_cost(self) -> float:
+        return from_minor(self.item_cost_minor)
+
+
+class BatchItem(Base):
+    __tablename__ = "batch_items"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, ForeignKey("batch_jobs.id"))
+    position = Column(Integer, nullable=False)
+    prompt = Column(Text)
+    status = Column(String, nullable=False, default='pending')  # 'pending', 'running', 'done' or 'failed'
+    generation_id = Column(Integer, ForeignKey("generations.id"), nullable=True)
+    error = Column(String, nullable=True)
+    # Unix time until which the worker that claimed the item owns it
+    lease_expires = Column(Float, nullable=True)
+    
+    job = relationship("BatchJob", back_populates="items")
+    generation = relationship("Generation")
+    
+    __table_args__ = (
+        Index("ix_batch_items_job_status", "job_id", "status", "id"),
+    )
+
+
+class GenerationJob(Base):
+    """A single generation requested in async mode and processed by the job workers"""
+    __tablename__ = "generation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    prompt = Column(Text)
+    tariff = Column(String)
+    use_cache = Column(Boolean, nullable=False, default=True)
+    status = Column(String, nullable=False, default='queued')  # 'queued', 'running', 'completed' or 'failed'
+    reservation_id = Column(Integer, ForeignKey("balance_history.id"), nullable=True)
+    generation_id = Column(Integer, ForeignKey("generations.id"), nullable=True)
+    error = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Unix time until which the claiming worker owns the job; an expired
+    # lease means the worker died and the job may be claimed again
+    lease_expires = Column(Float, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    generation = relationship("Generation")
+    
+    __table_args__ = (
+        Index("ix_generation_jobs_status", "status", "id"),
+    )
+
+
+class RateLimitState(Base):
+    """
+    Shared rate-limit state when RATE_LIMIT_STORE=database.
+
+    ``bucket:`` keys hold a token bucket (tokens, updated_at); ``slots:``
+    keys count a user's running generations. A counter untouched since
+    ``active_until`` (Unix time) is stale, e.g. left by a dead worker.
+    """
+    __tablename__ = "rate_limits"
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(Float, nullable=False, default=0.0)
+    active = Column(Integer, nullable=False, default=0)
+    active_until = Column(Float, nullable=False, default=0.0)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user rate limits on generation.
+
+Two limits apply to the authenticated user of a generation request:
+
+- a token bucket per user and tariff, refilled at RATE_LIMIT_PER_MINUTE
+  and holding up to RATE_LIMIT_BURST requests; every request takes a token
+- a cap of RATE_LIMIT_CONCURRENCY generations running at once per user;
+  an async job holds its slot from submission until it finishes, batch
+  items wait for a free slot instead of failing
+
+Sharing the backend fairly between the users that are within their limits
+is the scheduler's job (its queues are fair-queued by user); these limits
+keep a single user from filling the queues in the first place.
+
+State lives in this process by default. With RATE_LIMIT_STORE=database it
+is kept in the rate_limits table and changed with single conditional
+UPDATE statements, so the limits hold across uvicorn workers.
+"""
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import anyio
+from sqlalchemy import case, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from . import metrics
+from .database import SessionLocal
+from .ml_utils import MODEL_MAP
+from .models import RateLimitState
+
+def _tariff_setting(name: str, default: float) -> Dict[str, float]:
+    """A number for every tariff (``10``) or per-tariff overrides (``premium=2,pro=5``)"""
+    raw = os.getenv(name, '')
+    settings = {tariff: default for tariff in MODEL_MAP}
+    for part in filter(None, (p.strip() for p in raw.split(','))):
+        tariff, sep, value = part.rpartition('=')
+        if not sep:
+            settings = {t: float(value) for t in settings}
+        else:
+            settings[tariff] = float(value)
+    return settings
+
+# Sustained generations per minute per user and tariff (0 = unlimited)
+RATE_LIMIT_PER_MINUTE = _tariff_setting('RATE_LIMIT_PER_MINUTE', 0)
+RATE_LIMIT_BURST = _tariff_setting('RATE_LIMIT_BURST', 10)
+# Generations a user may have running at once (0 = unlimited)
+RATE_LIMIT_CONCURRENCY = int(os.getenv('RATE_LIMIT_CONCURRENCY', '4'))
+# "memory" or "database"
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memory')
+# A running-generation counter untouched for this long is stale (a worker died holding it)
+RATE_LIMIT_SLOT_TTL = float(os.getenv('RATE_LIMIT_SLOT_TTL', '900'))
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is over one of the user's limits"""
+
+    def __init__(self, detail: str, retry_after: int, headers: Dict[str, str] = None):
+        super().__init__(detail)
+        self.retry_after = retry_after
+        self.headers = headers or {}
+
+class Quota:
+    """A token bucket after a request, as RateLimit-* response headers"""
+
+    def __init__(self, burst: float, remaining: float, per_minute: float):
+        self.burst = burst
+        self.remaining = remaining
+        self.per_minute = per_minute
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+    def retry_after(self) -> int:
+        """Seconds until the next token"""
+        return max(1, math.ceil((1 - self.remaining) / self.rate))
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "RateLimit-Limit": str(int(self.burst)),
+            "RateLimit-Remaining": str(max(0, int(self.remaining))),
+            # Seconds until the bucket is full again
+            "RateLimit-Reset": str(math.ceil((self.burst - self.remaining) / self.rate)),
+            "RateLimit-Policy": f"{self.per_minute:g};w=60;burst={self.burst:g}"
+        }
+
+class MemoryStore:
+    """Limits of this process only"""
+
+    shared = False
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}  # tokens, updated_at, full_at
+        self._slots: Dict[str, Tuple[int, float]] = {}  # active, active_until
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> Tuple[bool, float]:
+        """Take a token if there is one; returns whether it was taken and the tokens left"""
+        tokens, updated_at, _ = self._buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        if len(self._buckets) > self.max_keys:
+            # A full bucket is the same as no bucket
+            self._buckets = {k: v for k, v in self._buckets.items() if v[2] > now}
+        return allowed, tokens
+
+    def acquire(self, key: str, limit: int, now: float, ttl: float) -> bool:
+        active, active_until = self._slots.get(key, (0, 0.0))
+        if active_until < now:
+            active = 0
+        if active >= limit:
+            return False
+        self._slots[key] = (active + 1, now + ttl)
+        return True
+
+    def release(self, key: str, now: float):
+        active, active_until = self._slots.get(key, (0, 0.0))
+        if active <= 1:
+            self._slots.pop(key, None)
+        else:
+            self._slots[key] = (active - 1, active_until)
+
+    def active(self, key: str, now: float) -> int:
+        active, active_until = self._slots.get(key, (0, 0.0))
+        return active if active_until >= now else 0
+
+class DatabaseStore:
+    """
+    Limits shared by every worker through the rate_limits table.
+
+    Each decision is one UPDATE whose WHERE clause holds the limit, so
+    concurrent workers cannot both take the last token or slot; a missing
+    row is inserted, retrying the UPDATE if another worker inserted first.
+    """
+
+    shared = True
+
+    def _insert(self, db, state: RateLimitState) -> bool:
+        db.add(state)
+        try:
+            db.commit()
+            return True
+        except IntegrityError:
+            db.rollback()
+            return False
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> Tuple[bool, float]:
+        refilled = RateLimitState.tokens + (now - RateLimitState.updated_at) * rate
+        tokens = case((refilled > burst, burst), else_=refilled)
+        db = SessionLocal()
+        try:
+            while True:
+                result = db.execute(
+                    update(RateLimitState)
+                    .where(RateLimitState.key == key, tokens >= 1)
+                    .values(tokens=tokens - 1, updated_at=now)
+                )
+                if result.rowcount:
+                    left = db.execute(select(RateLimitState.tokens).where(RateLimitState.key == key)).scalar()
+                    db.commit()
+                    return True, left
+                left = db.execute(select(tokens).where(RateLimitState.key == key)).scalar()
+                db.rollback()
+                if left is not None:
+                    return False, left
+                if self._insert(db, RateLimitState(key=key, tokens=burst - 1, updated_at=now)):
+                    return True, burst - 1
+        finally:
+            db.close()
+
+    def acquire(self, key: str, limit: int, now: float, ttl: float) -> bool:
+        active = case((RateLimitState.active_until < now, 0), else_=RateLimitState.active)
+        db = SessionLocal()
+        try:
+            while True:
+                result = db.execute(
+                    update(RateLimitState)
+                    .where(RateLimitState.key == key, active < limit)
+                    .values(active=active + 1, active_until=now + ttl)
+                )
+                if result.rowcount:
+                    db.commit()
+                    return True
+                exists = db.execute(select(RateLimitState.key).where(RateLimitState.key == key)).scalar()
+                db.rollback()
+                if exists is not None:
+                    return False
+                if self._insert(db, RateLimitState(key=key, active=1, active_until=now + ttl)):
+                    return True
+        finally:
+            db.close()
+
+    def release(self, key: str, now: float):
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(RateLimitState)
+                .where(RateLimitState.key == key)
+                .values(active=case((RateLimitState.active > 0, RateLimitState.active - 1), else_=0))
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def active(self, key: str, now: float) -> int:
+        db = SessionLocal()
+        try:
+            state = db.get(RateLimitState, key)
+            return state.active if state is not None and state.active_until >= now else 0
+        finally:
+            db.close()
+
+rate_limited = metrics.Counter(
+    "rate_limited_total", "Generation requests rejected by a per-user limit", ("tariff", "limit")
+)
+
+class RateLimiter:
+    def __init__(self, store, per_minute: Dict[str, float], burst: Dict[str, float], concurrency: int, slot_ttl: float):
+        self.store = store
+        self.per_minute = per_minute
+        self.burst = burst
+        self.concurrency = concurrency
+        self.slot_ttl = slot_ttl
+
+    async def _call(self, func, *args):
+        if self.store.shared:
+            return await run_in_threadpool(func, *args)
+        return func(*args)
+
+    async def check(self, user_id: int, tariff: str) -> Optional[Quota]:
+        """
+        Take a token from the user's bucket for the tariff.
+
+        Returns:
+            Quota: The bucket afterwards, or None when the tariff is not rate limited
+
+        Raises:
+            RateLimitExceeded: If the bucket is empty
+        """
+        per_minute = self.per_minute.get(tariff, 0)
+        if not per_minute:
+            return None
+        burst = max(1.0, self.burst.get(tariff, 1))
+        allowed, tokens = await self._call(self.store.take, f"bucket:{user_id}:{tariff}", per_minute / 60, burst, time.time())
+        quota = Quota(burst, tokens, per_minute)
+        if not allowed:
+            rate_limited.inc(tariff=tariff, limit="rate")
+            raise RateLimitExceeded(f"Rate limit of {per_minute:g} {tariff} generations per minute exceeded", quota.retry_after(), quota.headers())
+        return quota
+
+    def _concurrency_error(self, tariff: str) -> RateLimitExceeded:
+        rate_limited.inc(tariff=tariff, limit="concurrency")
+        return RateLimitExceeded(f"At most {self.concurrency} generations may run at once", 1)
+
+    async def check_slot(self, user_id: int, tariff: str):
+        """Fail fast with RateLimitExceeded if the user is at the concurrency cap, without taking a slot"""
+        if self.concurrency and await self._call(self.store.active, f"slots:{user_id}", time.time()) >= self.concurrency:
+            raise self._concurrency_error(tariff)
+
+    async def acquire(self, user_id: int, tariff: str):
+        """Take one of the user's concurrency slots or raise RateLimitExceeded"""
+        if self.concurrency and not await self._call(self.store.acquire, f"slots:{user_id}", self.concurrency, time.time(), self.slot_ttl):
+            raise self._concurrency_error(tariff)
+
+    async def wait_for_slot(self, user_id: int):
+        """Take one of the user's concurrency slots, waiting for one to free up; for work already accepted"""
+        while self.concurrency and not await self._call(self.store.acquire, f"slots:{user_id}", self.concurrency, time.time(), self.slot_ttl):
+            await anyio.sleep(1)
+
+    async def release(self, user_id: int):
+        if self.concurrency:
+            # Shielded so the slot is returned even when the request is being cancelled
+            with anyio.CancelScope(shield=True):
+                await self._call(self.store.release, f"slots:{user_id}", time.time())
+
+limiter = RateLimiter(
+    DatabaseStore() if RATE_LIMIT_STORE == 'database' else MemoryStore(),
+    RATE_LIMIT_PER_MINUTE,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_CONCURRENCY,
+    RATE_LIMIT_SLOT_TTL
+)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+JSON response class of the app.
+
+orjson is used when it is installed; otherwise the stdlib encoder with the
+same output (UTF-8, no ASCII escaping of Russian text) is the fallback.
+"""
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+JSON_MEDIA_TYPE = "application/json; charset=utf-8"
+
+class UTF8JSONResponse(JSONResponse):
+    """JSON serialized with orjson when available, labelled with its charset"""
+
+    media_type = JSON_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Incrementally maintained per-user analytics totals.
+
+The record_* helpers only stage statements on the caller's session, so the
+rollups are committed in the same transaction as the generation or balance
+change they describe.
+
+Users with history from before the rollups existed are backfilled by
+``python -m app.migrate``. Until then, read paths compute their totals from
+the raw tables without writing anything, so a GET never takes the write
+lock or leaves an insert for get_db to roll back.
+"""
+from typing import List, Tuple
+
+from sqlalchemy import case, exists, func, or_
+from sqlalchemy.orm import Session
+
+from .models import BalanceHistory, Generation, User, UserModelRollup, UserRollup, UserTariffRollup
+
+def _insert_ignore(db: Session, model, rows: list):
+    """INSERT ... ON CONFLICT DO NOTHING for SQLite and PostgreSQL"""
+    if not rows:
+        return
+    if db.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    db.execute(insert(model).values(rows).on_conflict_do_nothing())
+
+def _compute(db: Session, user_id: int) -> Tuple[dict, List[dict], List[dict]]:
+    """The user's rollup, tariff rollup and model rollup rows, aggregated from the raw tables"""
+    balance = db.query(
+        func.coalesce(func.sum(case((BalanceHistory.operation_type == 'spend', -BalanceHistory.amount_minor), else_=0)), 0),
+        func.coalesce(func.sum(case((BalanceHistory.operation_type == 'add', BalanceHistory.amount_minor), else_=0)), 0),
+        func.count(BalanceHistory.id)
+    ).filter(BalanceHistory.user_id == user_id).one()
+
+    by_tariff = db.query(
+        Generation.tariff,
+        func.count(Generation.id),
+        func.coalesce(func.sum(Generation.tokens_used), 0),
+        func.coalesce(func.sum(Generation.cost_minor), 0),
+        func.coalesce(func.sum(Generation.processing_time), 0)
+    ).filter(Generation.user_id == user_id).group_by(Generation.tariff).all()
+
+    by_model = db.query(
+        Generation.model,
+        func.count(Generation.id),
+        func.coalesce(func.sum(Generation.prompt_tokens), 0),
+        func.coalesce(func.sum(Generation.tokens_used), 0),
+        func.coalesce(func.sum(Generation.load_duration), 0),
+        func.coalesce(func.sum(Generation.prompt_eval_duration), 0),
+        func.coalesce(func.sum(Generation.eval_duration), 0)
+    ).filter(Generation.user_id == user_id, Generation.eval_duration.isnot(None)).group_by(Generation.model).all()
+
+    return {
+        "user_id": user_id,
+        "total_spent_minor": balance[0],
+        "total_added_minor": balance[1],
+        "balance_operations": balance[2]
+    }, [{
+        "user_id": user_id,
+        "tariff": tariff,
+        "generations": count,
+        "tokens": tokens,
+        "cost_minor": cost_minor,
+        "processing_time": processing_time
+    } for tariff, count, tokens, cost_minor, processing_time in by_tariff], [{
+        "user_id": user_id,
+        "model": model,
+        "generations": count,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "load_duration": load_duration,
+        "prompt_eval_duration": prompt_eval_duration,
+        "eval_duration": eval_duration
+    } for model, count, prompt_tokens, completion_tokens, load_duration, prompt_eval_duration, eval_duration in by_model]
+
+def ensure_rollups(db: Session, user_id: int) -> UserRollup:
+    """
+    Return the user's rollup, backfilling it from the raw tables on first use.
+
+    Only for write paths, whose transaction commits the backfill. Must run
+    before the caller stages new Generation or BalanceHistory rows,
+    otherwise they would be counted twice.
+    """
+    rollup = db.get(UserRollup, user_id)
+    if rollup is not None:
+        return rollup
+    user, tariffs, models = _compute(db, user_id)
+    _insert_ignore(db, UserRollup, [user])
+    _insert_ignore(db, UserTariffRollup, tariffs)
+    _insert_ignore(db, UserModelRollup, models)
+    return db.get(UserRollup, user_id)
+
+def users_to_backfill(db: Session) -> List[int]:
+    """Users with generations or balance history but no rollups yet"""
+    has_history = or_(
+        exists().where(Generation.user_id == User.id),
+        exists().where(BalanceHistory.user_id == User.id)
+    )
+    return [user_id for user_id, in db.query(User.id).filter(~exists().where(UserRollup.user_id == User.id), has_history)]
+
+def backfill(db: Session, user_ids: List[int]):
+    for user_id in user_ids:
+        ensure_rollups(db, user_id)
+
+def record_generation(db: Session, user_id: int, tariff: str, tokens: int, cost_minor: int, processing_time: float, usage=None):
+    """
+    Account for a stored generation.
+
+    ``usage`` is the backend's ml_utils.Usage; results served from the cache
+    have none and only count towards the tariff totals.
+    """
+    ensure_rollups(db, user_id)
+    _insert_ignore(db, UserTariffRollup, [{"user_id": user_id, "tariff": tariff}])
+    db.query(UserTariffRollup).filter(
+        UserTariffRollup.user_id == user_id,
+        UserTariffRollup.tariff == tariff
+    ).update({
+        UserTariffRollup.generations: UserTariffRollup.generations + 1,
+        UserTariffRollup.tokens: UserTariffRollup.tokens + tokens,
+        UserTariffRollup.cost_minor: UserTariffRollup.cost_minor + cost_minor,
+        UserTariffRollup.processing_time: UserTariffRollup.processing_time + processing_time
+    }, synchronize_session=False)
+    if usage is None:
+        return
+    _insert_ignore(db, UserModelRollup, [{"user_id": user_id, "model": usage.model}])
+    db.query(UserModelRollup).filter(
+        UserModelRollup.user_id == user_id,
+        UserModelRollup.model == usage.model
+    ).update({
+        UserModelRollup.generations: UserModelRollup.generations + 1,
+        UserModelRollup.prompt_tokens: UserModelRollup.prompt_tokens + usage.prompt_tokens,
+        UserModelRollup.completion_tokens: UserModelRollup.completion_tokens + usage.completion_tokens,
+        UserModelRollup.load_duration: UserModelRollup.load_duration + usage.load_duration,
+        UserModelRollup.prompt_eval_duration: UserModelRollup.prompt_eval_duration + usage.prompt_eval_duration,
+        UserModelRollup.eval_duration: UserModelRollup.eval_duration + usage.eval_duration
+    }, synchronize_session=False)
+
+def record_balance_change(db: Session, user_id: int, amount_minor: int, operation_type: str, new_entry: bool = True):
+    """
+    Account for a balance movement.
+
+    ``new_entry`` is False when an existing BalanceHistory row changes its
+    type (a reservation being captured) instead of a new row being added.
+    """
+    ensure_rollups(db, user_id)
+    values = {}
+    if new_entry:
+        values[UserRollup.balance_operations] = UserRollup.balance_operations + 1
+    if operation_type == 'spend':
+        values[UserRollup.total_spent_minor] = UserRollup.total_spent_minor - amount_minor
+    elif operation_type == 'add':
+        values[UserRollup.total_added_minor] = UserRollup.total_added_minor + amount_minor
+    if not values:
+        return
+    db.query(UserRollup).filter(UserRollup.user_id == user_id).update(values, synchronize_session=False)
+
+def get_rollups(db: Session, user_id: int) -> Tuple[UserRollup, list, list]:
+    """
+    The user's rollup, tariff rollups and model rollups, for read paths.
+
+    Computed without being stored when the user has not been backfilled.
+    """
+    rollup = db.get(UserRollup, user_id)
+    if rollup is None:
+        user, tariffs, models = _compute(db, user_id)
+        return UserRollup(**user), [UserTariffRollup(**r) for r in tariffs], [UserModelRollup(**r) for r in models]
+    return (
+        rollup,
+        db.query(UserTariffRollup).filter(UserTariffRollup.user_id == user_id).all(),
+        db.query(UserModelRollup).filter(UserModelRollup.user_id == user_id).all()
+    )
+
+def generation_count(db: Session, user_id: int) -> int:
+    if db.get(UserRollup, user_id) is None:
+        return db.query(func.count(Generation.id)).filter(Generation.user_id == user_id).scalar()
+    return db.query(func.coalesce(func.sum(UserTariffRollup.generations), 0))\
+        .filter(UserTariffRollup.user_id == user_id).scalar()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, Optional
+
+from . import metrics
+from .backends import pool
+from .ml_utils import MODEL_MAP
+
+# Lower value is served first
+TARIFF_PRIORITY = {
+    "premium": 0,
+    "pro": 1,
+    "standart": 2
+}
+
+def _model_setting(name: str, default: int) -> Dict[str, int]:
+    """
+    Read a per-model integer setting from the environment.
+
+    The variable is either a single number applied to every model
+    (``SCHEDULER_CONCURRENCY=4``) or a comma separated list of overrides
+    (``SCHEDULER_CONCURRENCY=gemma3:12b=1,gemma3:4b=2``).
+    """
+    raw = os.getenv(name, '')
+    settings = {model: default for model in MODEL_MAP.values()}
+    for part in filter(None, (p.strip() for p in raw.split(','))):
+        model, sep, value = part.rpartition('=')
+        if not sep:
+            settings = {m: int(value) for m in settings}
+        else:
+            settings[model] = int(value)
+    return settings
+
+SCHEDULER_CONCURRENCY = _model_setting('SCHEDULER_CONCURRENCY', 2)
+SCHEDULER_MAX_QUEUE = _model_setting('SCHEDULER_MAX_QUEUE', 32)
+# Generations a host runs at once across all its models (0 = no shared limit);
+# this is the capacity the tariffs compete for in priority order
+SCHEDULER_HOST_CONCURRENCY = int(os.getenv('SCHEDULER_HOST_CONCURRENCY', '4'))
+
+class QueueFullError(Exception):
+    """Raised when a model queue cannot accept another request"""
+
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"Generation queue for {model} is full")
+        self.model = model
+        self.retry_after = retry_after
+
+class ModelQueue:
+    """
+    Bounded priority queue guarding a number of generation slots: those of a
+    single model, or the host slots shared by every model.
+
+    Within a priority, waiters are ordered by start-time fair queuing over
+    flows (users): each request is tagged with
+    ``max(virtual time, the flow's previous finish tag)`` and costs one
+    unit of virtual time, so a user with many queued requests takes turns
+    with everyone else instead of being served first come, first served.
+    Every user has the same share.
+    """
+
+    def __init__(self, model: str, concurrency: int, max_queue: int):
+        self.model = model
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.background_queued = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self.virtual_time = 0.0
+        self._finish: Dict[Hashable, float] = {}
+
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.completed = 0
+        self.total_service = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Estimate in seconds until a queued request would be admitted"""
+        avg_service = self.total_service / self.completed if self.completed else 1.0
+        return max(1, math.ceil(avg_service * (self.queued + 1) / self.concurrency))
+
+    def check_capacity(self):
+        # Background work is bounded by its own worker pools and does not count
+        # against the queue limit of interactive requests
+        if self.active >= self.concurrency and self.queued - self.background_queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(self.model, self.retry_after())
+
+    def _tag(self, flow: Optional[Hashable]) -> float:
+        """Start tag of a new request of the flow; advances the flow's finish tag"""
+        if flow is None:
+            return self.virtual_time
+        tag = max(self.virtual_time, self._finish.get(flow, 0.0))
+        self._finish[flow] = tag + 1.0
+        return tag
+
+    def _advance(self, tag: float):
+        self.virtual_time = max(self.virtual_time, tag)
+        if len(self._finish) > 4096:
+            # Flows that are not ahead of the virtual time are tagged with it anyway
+            self._finish = {f: t for f, t in self._finish.items() if t > self.virtual_time}
+
+    async def acquire(self, priority: int, background: bool = False, flow: Optional[Hashable] = None) -> float:
+        """Wait for a free slot and return the time spent in the queue"""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self._advance(self._tag(flow))
+            self._record_admission(0.0)
+            return 0.0
+
+        if background:
+            self.background_queued += 1
+        else:
+            self.check_capacity()
+        start = time.monotonic()
+        tag = self._tag(flow)
+        entry = (priority, tag, next(self._counter), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        try:
+            await entry[3]
+        except asyncio.CancelledError:
+            if entry[3].done() and not entry[3].cancelled():
+                # The slot was handed over just before the cancellation
+                self.release()
+            else:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                if flow is not None and self._finish.get(flow) == tag + 1.0:
+                    # Give the turn back when nothing of the flow was queued after it
+                    self._finish[flow] = tag
+            raise
+        finally:
+            if background:
+                self.background_queued -= 1
+
+        wait = time.monotonic() - start
+        self._record_admission(wait)
+        return wait
+
+    def release(self):
+        """Hand the slot to the highest priority waiter or free it"""
+        while self._waiters:
+            _, tag, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._advance(tag)
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _record_admission(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "background_queued": self.background_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait,
+            "avg_service": self.total_service / self.completed if self.completed else 0.0
+        }
+
+# Both settings are per Ollama host, so adding a host to OLLAMA_HOSTS adds
+# capacity for every model it may serve
+queues = {
+    model: ModelQueue(
+        model,
+        SCHEDULER_CONCURRENCY[model] * max(1, len(pool.hosts_for(model))),
+        SCHEDULER_MAX_QUEUE[model] * max(1, len(pool.hosts_for(model)))
+    )
+    for model in set(MODEL_MAP.values())
+}
+
+# Every waiter here already holds a model slot, so the queue is bounded by
+# the model concurrency and never rejects
+host_queue = ModelQueue(
+    "all models",
+    SCHEDULER_HOST_CONCURRENCY * max(1, len(pool.backends)),
+    sum(queue.concurrency for queue in queues.values())
+) if SCHEDULER_HOST_CONCURRENCY else None
+
+def get_queue(tariff: str) -> ModelQueue:
+    return queues[MODEL_MAP[tariff]]
+
+def check_capacity(tariff: str):
+    """Fail fast with QueueFullError if the tariff's model queue is full"""
+    get_queue(tariff).check_capacity()
+
+@asynccontextmanager
+async def admit(tariff: str, background: bool = False, user_id: Optional[int] = None):
+    """
+    Hold a backend slot for the tariff's model for the duration of the block.
+
+    A request first takes a slot of its model, then one of the host slots
+    shared by all models. The host slots go out in tariff priority order
+    (premium, pro, standart), so once the hosts are saturated a premium
+    request overtakes standart ones waiting for any model. Within a
+    priority, waiters are fair-queued by ``user_id``, first-come
+    first-served for a single user. ``background`` work (batch items) is
+    admitted after all interactive requests and is never rejected.
+
+    Yields:
+        float: Seconds the request spent waiting in the queue
+
+    Raises:
+        QueueFullError: If the model queue is already at its limit
+    """
+    queue = get_queue(tariff)
+    priority = TARIFF_PRIORITY.get(tariff, len(TARIFF_PRIORITY))
+    if background:
+        priority += len(TARIFF_PRIORITY) + 1
+    wait = await queue.acquire(priority, background, user_id)
+    try:
+        if host_queue is not None:
+            wait += await host_queue.acquire(priority, background, user_id)
+        start = time.monotonic()
+        try:
+            yield wait
+        finally:
+            service = time.monotonic() - start
+            for held in (queue, host_queue):
+                if held is not None:
+                    held.completed += 1
+                    held.total_service += service
+            if host_queue is not None:
+                host_queue.release()
+    finally:
+        queue.release()
+
+def stats() -> dict:
+    return {
+        "models": {model: queue.stats() for model, queue in queues.items()},
+        "hosts": host_queue.stats() if host_queue is not None else None
+    }
+
+metrics.Gauge(
+    "scheduler_queued", "Requests waiting for a model slot", ("model",),
+    lambda: {(model,): queue.queued for model, queue in queues.items()}
+)
+metrics.Gauge(
+    "scheduler_active", "Generations currently holding a model slot", ("model",),
+    lambda: {(model,): queue.active for model, queue in queues.items()}
+)
+metrics.Gauge(
+    "scheduler_host_queued", "Requests holding a model slot and waiting for a host slot", (),
+    lambda: {(): host_queue.queued} if host_queue is not None else {}
+)
+metrics.Gauge(
+    "scheduler_host_active", "Generations currently holding a host slot", (),
+    lambda: {(): host_queue.active} if host_queue is not None else {}
+)
+metrics.CallbackCounter(
+    "scheduler_rejected_total", "Requests rejected because the model queue was full", ("model",),
+    lambda: {(model,): queue.rejected for model, queue in queues.items()}
+)
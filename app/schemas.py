@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from pydantic import BaseModel, EmailStr, constr, ConfigDict
-from typing import Optional, List
-from datetime import datetime
+from typing import Dict, Optional, List
+from datetime import date, datetime
 
 class UserCreate(BaseModel):
     model_config = ConfigDict(json_encoders={str: str})
@@ -22,12 +22,14 @@ class GenerateRequest(BaseModel):
     model_config = ConfigDict(json_encoders={str: str})
     prompt: constr(min_length=1, max_length=1000)
     tariff: str
+    use_cache: bool = True
 
 class GenerateResponse(BaseModel):
     model_config = ConfigDict(json_encoders={str: str})
     text: str
     cost: float
     remaining_balance: float
+    cached: bool = False
 
 class BalanceUpdate(BaseModel):
     model_config = ConfigDict(json_encoders={str: str})
@@ -36,18 +38,27 @@ class BalanceUpdate(BaseModel):
     new_balance: float
 
 # Analytics schemas
+class ModelStats(BaseModel):
+    generations: int
+    prompt_tokens: int
+    completion_tokens: int
+    tokens_per_second: float
+    avg_load_time: float
+    avg_prompt_eval_time: float
+
 class GenerationStats(BaseModel):
     total_generations: int
     total_tokens: int
     total_cost: float
     avg_processing_time: float
     generations_by_tariff: dict[str, int]
+    models: Dict[str, ModelStats] = {}
 
 class BalanceStats(BaseModel):
     current_balance: float
     total_spent: float
     total_added: float
-    balance_history: List[dict]
+    balance_operations: int
 
 class UserStats(BaseModel):
     generations: GenerationStats
@@ -60,6 +71,20 @@ class AnalyticsResponse(BaseModel):
     recent_generations: List[dict]
     recent_balance_changes: List[dict]
 
+class SeriesStats(BaseModel):
+    generations: int
+    cost: float
+    tokens: int
+    avg_processing_time: float
+
+class SeriesBucket(BaseModel):
+    start: date  # first day of the day, week (Monday) or month
+    by_tariff: Dict[str, SeriesStats]
+
+class AnalyticsSeriesResponse(BaseModel):
+    period: str
+    buckets: List[SeriesBucket]
+
 class GenerationHistory(BaseModel):
     model_config = ConfigDict(json_encoders={str: str})
     id: int
@@ -69,10 +94,55 @@ class GenerationHistory(BaseModel):
     cost: float
     created_at: datetime
     processing_time: float
+    model: Optional[str] = None
+    tokens_used: Optional[int] = None
+    prompt_tokens: Optional[int] = None
+    tokens_per_second: Optional[float] = None
 
 class HistoryResponse(BaseModel):
     model_config = ConfigDict(json_encoders={str: str})
     generations: List[GenerationHistory]
     total_count: int
     page: int
-    page_size: int
\ No newline at end of file
+    page_size: int
+    next_cursor: Optional[int] = None
+
+class BalanceHistoryItem(BaseModel):
+    model_config = ConfigDict(json_encoders={str: str})
+    amount: float
+    type: str
+    description: str
+    date: datetime
+
+class BalanceHistoryResponse(BaseModel):
+    model_config = ConfigDict(json_encoders={str: str})
+    items: List[BalanceHistoryItem]
+    total_count: int
+    page: int
+    page_size: int
+
+class BatchJobResponse(BaseModel):
+    model_config = ConfigDict(json_encoders={str: str}, from_attributes=True)
+    id: int
+    tariff: str
+    status: str
+    total_items: int
+    completed_items: int
+    failed_items: int
+    item_cost: float
+    use_cache: bool
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+class GenerationJobResponse(BaseModel):
+    model_config = ConfigDict(json_encoders={str: str})
+    id: int
+    status: str
+    tariff: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[str] = None
+    cost: Optional[float] = None
+    generation_id: Optional[int] = None
+    error: Optional[str] = None
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Semantic near-duplicate prompt cache.
+
+Catalogue prompts often differ only in whitespace, the order of their specs
+or a single attribute value, which the exact-match GenerationCache misses.
+When enabled, prompts that miss the exact cache are embedded and compared
+by cosine similarity with the prompts of earlier generations of the same
+tariff; above SEMANTIC_CACHE_THRESHOLD the stored ``Generation.result`` is
+served instead of running the model. Like the exact cache, the index is
+shared by all users: a hit may return another user's result. Requests and
+jobs with ``use_cache`` off neither look it up nor add to it.
+
+Vectors are kept unit-length in a fixed-capacity ring per tariff, backed by
+two memory-mapped files (vectors and generation ids) under
+SEMANTIC_CACHE_DIR, so the index survives restarts without being loaded
+into the heap. Each process claims a ``worker-N`` subdirectory of its own
+with a lock file that is released when the process exits, so uvicorn
+workers sharing SEMANTIC_CACHE_DIR never write to each other's rings and a
+restarted worker takes over the files of the one before it.
+
+A sample of hits is kept for review and classified by whether the two
+prompts have the same words (reordered or reformatted) or different ones
+(a changed attribute value, the likely false positives).
+
+NumPy is only imported once a cache is enabled, so workers that do not use
+the semantic cache do not pay for loading it.
+"""
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Optional
+
+from . import metrics
+from .backends import pool
+from .database import SessionLocal
+from .ml_utils import generation_cache, normalize_prompt
+from .models import Generation
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+np = None  # numpy, see _import_numpy()
+
+def _import_numpy() -> bool:
+    """Import NumPy on first use; False when it is not installed"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # optional dependency
+            return False
+        np = numpy
+    return True
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# "ollama" embeds through the backend pool, "hashing" is a local stand-in
+SEMANTIC_CACHE_EMBEDDER = os.getenv('SEMANTIC_CACHE_EMBEDDER', 'ollama')
+SEMANTIC_CACHE_MODEL = os.getenv('SEMANTIC_CACHE_MODEL', 'nomic-embed-text')
+SEMANTIC_CACHE_HASHING_DIM = int(os.getenv('SEMANTIC_CACHE_HASHING_DIM', '512'))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))
+SEMANTIC_CACHE_DIR = os.getenv('SEMANTIC_CACHE_DIR', '/app/db/semantic_cache')
+SEMANTIC_CACHE_CAPACITY = int(os.getenv('SEMANTIC_CACHE_CAPACITY', '16384'))  # vectors per tariff
+SEMANTIC_CACHE_SAMPLE_RATE = float(os.getenv('SEMANTIC_CACHE_SAMPLE_RATE', '0.05'))
+SEMANTIC_CACHE_SAMPLES = int(os.getenv('SEMANTIC_CACHE_SAMPLES', '200'))
+
+_WORD = re.compile(r'\w+')
+
+def _words(prompt: str) -> Counter:
+    return Counter(_WORD.findall(normalize_prompt(prompt).lower()))
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of character trigrams within words.
+
+    Needs nothing but NumPy, so tests and benchmarks can run without an
+    embedding model; word order does not change the vector.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.name = f"hashing{dim}"
+
+    async def embed(self, text: str) -> 'np.ndarray':
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORD.findall(normalize_prompt(text).lower()):
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                digest = hashlib.blake2b(padded[i:i + 3].encode('utf-8'), digest_size=8).digest()
+                h = int.from_bytes(digest, 'little')
+                vector[h % self.dim] += 1.0 if h >> 63 else -1.0
+        return vector
+
+class OllamaEmbedder:
+    """Embeddings from a local model served by the Ollama hosts"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.name = re.sub(r'[^\w.-]', '_', model)
+
+    async def embed(self, text: str) -> 'np.ndarray':
+        response = await pool.call(self.model, lambda backend: backend.client.embed(model=self.model, input=text))
+        return np.asarray(response.embeddings[0], dtype=np.float32)
+
+class VectorIndex:
+    """
+    Ring of unit vectors and the ids of their generations in two memmaps.
+
+    Slots fill in order and then overwrite the oldest entry; generation ids
+    only grow, so after a restart the smallest id marks the next slot. A
+    zero id is an empty slot, and the id is written after its vector.
+    """
+
+    def __init__(self, prefix: str, dim: int, capacity: int):
+        self.dim = dim
+        self.capacity = capacity
+        vectors_path, ids_path = prefix + '.f32', prefix + '.ids'
+        reuse = (
+            os.path.exists(vectors_path) and os.path.getsize(vectors_path) == capacity * dim * 4
+            and os.path.exists(ids_path) and os.path.getsize(ids_path) == capacity * 8
+        )
+        mode = 'r+' if reuse else 'w+'
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self.ids = np.memmap(ids_path, dtype=np.int64, mode=mode, shape=(capacity,))
+        self.size = int(np.count_nonzero(self.ids))
+        self.cursor = self.size % capacity if self.size < capacity else int(np.argmin(self.ids))
+        self._lock = threading.Lock()
+
+    def search(self, vector: 'np.ndarray'):
+        """Return (generation id, cosine similarity) of the closest vector, or None"""
+        with self._lock:
+            if not self.size:
+                return None
+            scores = self.vectors[:self.size] @ vector
+            best = int(np.argmax(scores))
+            return int(self.ids[best]), float(scores[best])
+
+    def add(self, vector: 'np.ndarray', generation_id: int):
+        with self._lock:
+            self.vectors[self.cursor] = vector
+            self.ids[self.cursor] = generation_id
+            self.cursor = (self.cursor + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    def flush(self):
+        with self._lock:
+            self.vectors.flush()
+            self.ids.flush()
+
+class SemanticCache:
+    """Generation results looked up by prompt similarity, one index per tariff"""
+
+    def __init__(self, embedder, directory: str, threshold: float, capacity: int,
+                 sample_rate: float, max_samples: int, enabled: bool = True):
+        self.embedder = embedder
+        self.directory = directory
+        self.threshold = threshold
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.enabled = enabled and _import_numpy()
+        self._indexes: Dict[str, VectorIndex] = {}
+        self._indexes_lock = threading.Lock()
+        self._worker_directory = None
+        self._worker_lock = None
+        # Vectors of recent misses, so storing the generation does not embed twice
+        self._pending = OrderedDict()
+        self.samples = deque(maxlen=max_samples)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.saved_seconds = 0.0
+        self.sampled = {"same_words": 0, "different_words": 0}
+
+    def _claim_directory(self) -> str:
+        """The worker-N subdirectory this process holds the lock of, claimed on first use"""
+        if self._worker_directory is None:
+            os.makedirs(self.directory, exist_ok=True)
+            if fcntl is None:
+                self._worker_directory = os.path.join(self.directory, f"pid-{os.getpid()}")
+            else:
+                for n in itertools.count():
+                    lock = open(os.path.join(self.directory, f"worker-{n}.lock"), "a")
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        lock.close()
+                        continue
+                    # Kept open for the life of the process; closing it would release the claim
+                    self._worker_lock = lock
+                    self._worker_directory = os.path.join(self.directory, f"worker-{n}")
+                    break
+            os.makedirs(self._worker_directory, exist_ok=True)
+        return self._worker_directory
+
+    def _index(self, tariff: str, dim: int) -> VectorIndex:
+        with self._indexes_lock:
+            index = self._indexes.get(tariff)
+            if index is None or index.dim != dim:
+                prefix = os.path.join(self._claim_directory(), f"{tariff}-{self.embedder.name}-{dim}")
+                index = self._indexes[tariff] = VectorIndex(prefix, dim, self.capacity)
+            return index
+
+    async def _embed(self, prompt: str) -> Optional['np.ndarray']:
+        key = normalize_prompt(prompt)
+        vector = self._pending.get(key)
+        if vector is not None:
+            return vector
+        try:
+            vector = await self.embedder.embed(key)
+        except Exception as e:
+            # The cache is an optimisation; a failed embedding is just a miss
+            self.errors += 1
+            logger.warning("Error embedding prompt", extra={"embedder": self.embedder.name, "error": str(e)})
+            return None
+        norm = float(np.linalg.norm(vector))
+        if not norm:
+            return None
+        vector = vector / norm
+        self._pending[key] = vector
+        while len(self._pending) > 1024:
+            self._pending.popitem(last=False)
+        return vector
+
+    def _lookup(self, tariff: str, vector: 'np.ndarray') -> Optional[dict]:
+        found = self._index(tariff, len(vector)).search(vector)
+        if found is None:
+            return None
+        generation_id, similarity = found
+        similarity_histogram.observe(similarity, tariff=tariff)
+        if similarity < self.threshold:
+            return None
+        db = SessionLocal()
+        try:
+            generation = db.get(Generation, generation_id)
+            if generation is None or generation.result is None:
+                return None
+            seconds = sum(d or 0.0 for d in (
+                generation.load_duration, generation.prompt_eval_duration, generation.eval_duration
+            )) or generation.processing_time or 0.0
+            return {
+                "generation_id": generation_id,
+                "similarity": similarity,
+                "prompt": generation.prompt,
+                "result": generation.result,
+                "seconds": seconds
+            }
+        finally:
+            db.close()
+
+    async def get(self, prompt: str, tariff: str) -> Optional[str]:
+        """Result of the most similar earlier generation above the threshold"""
+        if not self.enabled:
+            return None
+        vector = await self._embed(prompt)
+        if vector is None:
+            return None
+        match = await asyncio.to_thread(self._lookup, tariff, vector)
+        if match is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_seconds += match["seconds"]
+        if random.random() < self.sample_rate:
+            self._sample(prompt, tariff, match)
+        return match["result"]
+
+    async def add(self, prompt: str, tariff: str, generation_id: int):
+        """Index a stored generation so later similar prompts can reuse it"""
+        if not self.enabled:
+            return
+        vector = await self._embed(prompt)
+        if vector is None:
+            return
+        self._pending.pop(normalize_prompt(prompt), None)
+        await asyncio.to_thread(lambda: self._index(tariff, len(vector)).add(vector, generation_id))
+
+    def _sample(self, prompt: str, tariff: str, match: dict):
+        verdict = "same_words" if _words(prompt) == _words(match["prompt"]) else "different_words"
+        self.sampled[verdict] += 1
+        self.samples.append({
+            "tariff": tariff,
+            "prompt": prompt,
+            "matched_prompt": match["prompt"],
+            "generation_id": match["generation_id"],
+            "similarity": round(match["similarity"], 4),
+            "verdict": verdict
+        })
+        logger.info("Semantic cache hit sampled", extra={
+            "tariff": tariff,
+            "generation_id": match["generation_id"],
+            "similarity": round(match["similarity"], 4),
+            "verdict": verdict
+        })
+
+    def close(self):
+        with self._indexes_lock:
+            for index in self._indexes.values():
+                index.flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        sampled = sum(self.sampled.values())
+        return {
+            "enabled": self.enabled,
+            "embedder": self.embedder.name,
+            "threshold": self.threshold,
+            "capacity": self.capacity,
+            "size": {tariff: index.size for tariff, index in list(self._indexes.items())},
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "sampled": dict(self.sampled),
+            # Share of sampled hits whose prompts have different words
+            "different_words_rate": self.sampled["different_words"] / sampled if sampled else 0.0
+        }
+
+def _embedder():
+    if SEMANTIC_CACHE_EMBEDDER == 'hashing':
+        return HashingEmbedder(SEMANTIC_CACHE_HASHING_DIM)
+    return OllamaEmbedder(SEMANTIC_CACHE_MODEL)
+
+cache = SemanticCache(
+    _embedder(),
+    SEMANTIC_CACHE_DIR,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_CAPACITY,
+    SEMANTIC_CACHE_SAMPLE_RATE,
+    SEMANTIC_CACHE_SAMPLES,
+    enabled=SEMANTIC_CACHE_ENABLED
+)
+if SEMANTIC_CACHE_ENABLED and not cache.enabled:
+    logger.warning("SEMANTIC_CACHE_ENABLED is set but numpy is not installed; the semantic cache is off")
+
+async def cached_result(prompt: str, tariff: str) -> Optional[str]:
+    """Exact cache first, then the semantic index; semantic hits are promoted to the exact cache"""
+    result = await generation_cache.get(prompt, tariff)
+    if result is None:
+        result = await cache.get(prompt, tariff)
+        if result is not None:
+            await generation_cache.set(prompt, tariff, result)
+    return result
+
+similarity_histogram = metrics.Histogram(
+    "semantic_cache_similarity", "Cosine similarity of the closest indexed prompt", ("tariff",),
+    buckets=(0.5, 0.7, 0.8, 0.85, 0.9, 0.93, 0.95, 0.97, 0.99, 1.0)
+)
+metrics.CallbackCounter(
+    "semantic_cache_lookups_total", "Semantic cache lookups by result", ("result",),
+    lambda: {("hit",): cache.hits, ("miss",): cache.misses, ("error",): cache.errors}
+)
+metrics.CallbackCounter(
+    "semantic_cache_saved_seconds_total", "Backend time of the generations served from the semantic cache", (),
+    lambda: {(): cache.saved_seconds}
+)
+metrics.CallbackCounter(
+    "semantic_cache_samples_total", "Sampled semantic hits by whether the prompts have the same words", ("verdict",),
+    lambda: {(verdict,): count for verdict, count in cache.sampled.items()}
+)
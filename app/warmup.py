@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Worker warm-up, started by the lifespan handler.
+
+Importing app.main does no I/O, so a worker accepts connections as soon as
+it is forked and warms up in the background while /healthz already
+answers. Two steps run concurrently:
+
+    database   ``python -m app.migrate`` has nothing left to do (no
+               missing tables, columns, indexes or backfills), then the job
+               workers start and unfinished batch jobs resume
+    backends   the ollama library is imported and every Ollama host is
+               checked once, then the periodic health checks and model
+               preloading start
+
+/readyz answers 503 until both have finished. An unreachable or not yet
+migrated database is checked again every WARMUP_RETRY_INTERVAL seconds.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from . import batch, jobs, metrics, migrate, ml_utils
+
+logger = logging.getLogger(__name__)
+
+WARMUP_RETRY_INTERVAL = float(os.getenv('WARMUP_RETRY_INTERVAL', '5'))
+
+STEPS = ("database", "backends")
+
+class Warmup:
+    """Progress of this worker's warm-up"""
+
+    def __init__(self):
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        # Seconds each step took, None while it runs
+        self.seconds: Dict[str, Optional[float]] = {step: None for step in STEPS}
+        self.errors: Dict[str, str] = {}
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    def _error(self, step: str, error: str):
+        if self.errors.get(step) != error:
+            logger.warning("Warm-up step waiting", extra={"step": step, "error": error})
+        self.errors[step] = error
+
+    async def _database(self):
+        while True:
+            try:
+                changes = await run_in_threadpool(migrate.check)
+            except migrate.MigrationError as e:
+                self._error("database", f"Migration refused: {e}")
+            except Exception as e:
+                self._error("database", f"Database unavailable: {e}")
+            else:
+                if not changes:
+                    break
+                self._error("database", f"{len(changes)} migration steps pending; run python -m app.migrate")
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+        jobs.start()
+        await batch.resume()
+
+    async def _step(self, step: str, func: Callable[[], Awaitable]) -> bool:
+        started = time.monotonic()
+        try:
+            await func()
+        except Exception as e:
+            logger.exception("Warm-up step failed", extra={"step": step})
+            self.errors[step] = str(e)
+            return False
+        self.seconds[step] = time.monotonic() - started
+        self.errors.pop(step, None)
+        logger.info("Warm-up step finished", extra={"step": step, "seconds": round(self.seconds[step], 3)})
+        return True
+
+    async def _run(self):
+        self.started_at = time.time()
+        done = await asyncio.gather(self._step("database", self._database), self._step("backends", ml_utils.warm_up))
+        if all(done):
+            self.ready_at = time.time()
+            logger.info("Worker ready", extra={"seconds": round(self.ready_at - self.started_at, 3)})
+
+    def start(self):
+        """Warm up in the background on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Cancel a warm-up that has not finished"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def status(self) -> dict:
+        return {
+            "status": "ready" if self.ready else "starting",
+            "started_at": self.started_at,
+            "ready_at": self.ready_at,
+            "steps": {
+                step: {"done": seconds is not None, "seconds": seconds, "error": self.errors.get(step)}
+                for step, seconds in self.seconds.items()
+            }
+        }
+
+warmup = Warmup()
+
+metrics.Gauge(
+    "worker_ready", "Whether this worker has finished warming up", (),
+    lambda: {(): int(warmup.ready)}
+)
+metrics.Gauge(
+    "warmup_seconds", "Time each warm-up step took", ("step",),
+    lambda: {(step,): seconds for step, seconds in warmup.seconds.items() if seconds is not None}
+)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Worker cold-start benchmark.
+
+Starts ``uvicorn app.main:app`` --runs times against an already migrated
+scratch SQLite database and bench/fake_ollama.py, and measures from the
+moment the process is spawned:
+
+    serving   the first HTTP response (on /healthz)
+    ready     the first 200 from /readyz
+    stop      SIGTERM until the process has exited
+
+plus the time ``import app.main`` takes in a fresh interpreter and the
+warm-up steps reported by /readyz. With --ref the same measurements are
+taken on another commit, exported with ``git archive``; a tree without
+/readyz counts as ready once it serves, which is when its import-time setup
+has finished.
+
+Usage:
+    python bench/cold_start.py --runs 10
+    python bench/cold_start.py --runs 10 --ref HEAD~1 --output cold.json
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+def summarize(values):
+    return {"min": min(values), "p50": percentile(values, 50), "p95": percentile(values, 95), "max": max(values)}
+
+def git_commit(ref: str = "HEAD") -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", ref], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def export_tree(ref: str) -> str:
+    directory = tempfile.mkdtemp(prefix="cold-start-ref-")
+    archive = subprocess.run(["git", "archive", ref], cwd=ROOT, check=True, capture_output=True).stdout
+    subprocess.run(["tar", "-x", "-C", directory], input=archive, check=True)
+    return directory
+
+def import_seconds(tree: str, env: dict) -> float:
+    code = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+    return float(subprocess.check_output([sys.executable, "-c", code], cwd=tree, env=env, text=True).split()[-1])
+
+def start_once(tree: str, env: dict, args) -> dict:
+    started = time.perf_counter()
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=tree, env=env
+    )
+    result = {}
+    deadline = started + args.timeout
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{args.port}", timeout=1.0) as client:
+            while "ready" not in result:
+                if time.perf_counter() > deadline or app.poll() is not None:
+                    raise SystemExit(f"Worker in {tree} did not become ready")
+                try:
+                    response = client.get("/healthz" if "serving" not in result else "/readyz")
+                except httpx.HTTPError:
+                    time.sleep(args.poll)
+                    continue
+                now = time.perf_counter() - started
+                if "serving" not in result:
+                    result["serving"] = now
+                    # Nothing to wait for on a tree without the endpoint
+                    if response.status_code == 404:
+                        result["ready"] = now
+                elif response.status_code in (200, 404):
+                    result["ready"] = now
+                    if response.status_code == 200:
+                        result["steps"] = {step: s["seconds"] for step, s in response.json()["steps"].items()}
+                else:
+                    time.sleep(args.poll)
+    finally:
+        stopping = time.perf_counter()
+        app.send_signal(signal.SIGTERM)
+        try:
+            app.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            app.kill()
+            app.wait()
+        result["stop"] = time.perf_counter() - stopping
+    return result
+
+def measure(tree: str, env: dict, args) -> dict:
+    imports = [import_seconds(tree, env) for _ in range(args.runs)]
+    runs = [start_once(tree, env, args) for _ in range(args.runs)]
+    report = {
+        "import_seconds": summarize(imports),
+        **{f"{key}_seconds": summarize([r[key] for r in runs]) for key in ("serving", "ready", "stop")}
+    }
+    steps = [r["steps"] for r in runs if "steps" in r]
+    if steps:
+        report["warmup_step_seconds"] = {step: summarize([s[step] for s in steps]) for step in steps[0]}
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--ollama-port", type=int, default=11445, help="Port of the fake Ollama host")
+    parser.add_argument("--ref", help="Also measure this commit, e.g. HEAD~1")
+    parser.add_argument("--poll", type=float, default=0.005, help="Seconds between probes")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds a worker may take to become ready")
+    parser.add_argument("--output", help="Write the JSON report here as well")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="cold-start-")
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(directory, 'bench.db')}",
+        OLLAMA_HOSTS=f"http://127.0.0.1:{args.ollama_port}",
+        LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING")
+    )
+    subprocess.run([sys.executable, "-m", "app.migrate"], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    fake = subprocess.Popen([sys.executable, os.path.join(ROOT, "bench", "fake_ollama.py"), "--port", str(args.ollama_port)])
+    try:
+        report = {"commit": git_commit(), "runs": args.runs, "workers": args.workers, "current": measure(ROOT, env, args)}
+        if args.ref:
+            report["ref"] = {"commit": git_commit(args.ref), **measure(export_tree(args.ref), env, args)}
+    finally:
+        fake.terminate()
+        fake.wait()
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite read/write concurrency benchmark.
+
+Runs the same mixed workload twice against a fresh database file, once with
+SQLite's default rollback journal and once with the PRAGMAs applied by
+app.database (WAL, synchronous=NORMAL, busy_timeout, mmap_size, cache_size).
+Writers insert generations the way /generate does; readers page through the
+history the way /history does.
+
+Usage:
+    python bench/db_concurrency.py --writers 4 --readers 8 --duration 10
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.database import Base, build_engine  # noqa: E402
+from app.models import Generation, User  # noqa: E402
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+def run_mode(tuned, args):
+    directory = tempfile.mkdtemp(prefix="db-bench-")
+    engine = build_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}", sqlite_pragmas=tuned)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    Base.metadata.create_all(bind=engine)
+
+    with Session() as db:
+        user = User(email="bench@example.com", hashed_password="x", balance_minor=0)
+        db.add(user)
+        db.commit()
+        user_id = user.id
+        db.add_all([
+            Generation(user_id=user_id, prompt="seed", result="x" * 2000, tariff="pro",
+                       cost_minor=400, tokens_used=300, processing_time=1.0)
+            for _ in range(args.seed_rows)
+        ])
+        db.commit()
+
+    deadline = time.monotonic() + args.duration
+    write_latencies, read_latencies, errors = [], [], []
+    lock = threading.Lock()
+
+    def writer():
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                with Session() as db:
+                    db.add(Generation(user_id=user_id, prompt="bench", result="y" * 2000, tariff="pro",
+                                      cost_minor=400, tokens_used=300, processing_time=1.0))
+                    db.commit()
+                with lock:
+                    write_latencies.append(time.monotonic() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__)
+
+    def reader():
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                with Session() as db:
+                    db.query(Generation)\
+                        .filter(Generation.user_id == user_id)\
+                        .order_by(Generation.created_at.desc(), Generation.id.desc())\
+                        .limit(10)\
+                        .all()
+                with lock:
+                    read_latencies.append(time.monotonic() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__)
+
+    threads = [threading.Thread(target=writer) for _ in range(args.writers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    return {
+        "writes_per_sec": len(write_latencies) / args.duration,
+        "reads_per_sec": len(read_latencies) / args.duration,
+        "write_p50": percentile(write_latencies, 50),
+        "write_p99": percentile(write_latencies, 99),
+        "read_p50": percentile(read_latencies, 50),
+        "read_p99": percentile(read_latencies, 99),
+        "errors": len(errors)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--seed-rows", type=int, default=5000)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = {
+        "default": run_mode(False, args),
+        "tuned": run_mode(True, args)
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
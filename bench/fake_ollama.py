@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in Ollama server for offline benchmarks.
+
+Implements the parts of the Ollama HTTP API the backend uses (/api/generate
+streaming and non-streaming, /api/embed, /api/tags, /api/ps, /api/version)
+and fakes the timing of a CPU-only host: every model has a load time, a
+time to first token and a token rate, and only ``--parallel`` requests per
+model are decoded at once, the rest wait like they do in Ollama. Responses
+carry the usual eval_count / eval_duration statistics, and like in Ollama a
+generation stops when its client disconnects. Embeddings are hashed
+character trigrams, so prompts with the same words embed close together.
+
+Usage:
+    python bench/fake_ollama.py --port 11435
+    python bench/fake_ollama.py --port 11435 --speed 10 --model gemma3:12b=8:0.6:4
+"""
+import argparse
+import hashlib
+import itertools
+import math
+import re
+import select
+import socket
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Rough CPU-only figures for the models in app.ml_utils.MODEL_MAP:
+# (tokens per second, seconds to first token, seconds to load the model)
+DEFAULT_PROFILES = {
+    "gemma3:1b": (40.0, 0.05, 1.0),
+    "gemma3:4b": (15.0, 0.15, 3.0),
+    "gemma3:12b": (5.0, 0.4, 8.0)
+}
+FALLBACK_PROFILE = (20.0, 0.1, 2.0)
+# Embedding models: (dimensions, seconds per request)
+EMBEDDING_MODELS = {
+    "nomic-embed-text": (768, 0.01)
+}
+DEFAULT_KEEP_ALIVE = 300.0
+
+WORDS = (
+    "Этот", " товар", " создан", " для", " тех,", " кто", " ценит", " качество", " и", " удобство.",
+    " Прочный", " корпус,", " продуманный", " дизайн", " и", " доступная", " цена", " —", " отличный", " выбор!"
+)
+
+def embed(text: str, dim: int) -> list:
+    vector = [0.0] * dim
+    for word in re.findall(r'\w+', text.lower()):
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            h = int.from_bytes(hashlib.blake2b(padded[i:i + 3].encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[h % dim] += 1.0 if h >> 63 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _parse_keep_alive(value) -> float:
+    """Seconds to keep a model loaded; negative values mean forever, like Ollama"""
+    if value is None:
+        return DEFAULT_KEEP_ALIVE
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        for suffix in sorted(units, key=len, reverse=True):
+            if value.endswith(suffix):
+                seconds = float(value[:-len(suffix)]) * units[suffix]
+                break
+        else:
+            seconds = float(value)
+    return float("inf") if seconds < 0 else seconds
+
+class FakeOllama:
+    """Model state shared by all request threads"""
+
+    def __init__(self, profiles: dict, parallel: int, tokens: int, speed: float):
+        self.profiles = profiles
+        self.tokens = tokens
+        self.speed = speed
+        self._slots = {model: threading.BoundedSemaphore(parallel) for model in profiles}
+        self._lock = threading.Lock()
+        self._loaded = {}  # model -> unload deadline
+        self._loading = {}
+
+    def profile(self, model: str):
+        return self.profiles.get(model, FALLBACK_PROFILE)
+
+    def slot(self, model: str):
+        with self._lock:
+            return self._slots.setdefault(model, threading.BoundedSemaphore(1))
+
+    def ensure_loaded(self, model: str, keep_alive: float) -> float:
+        """Load the model if needed and return the time spent loading"""
+        start = time.monotonic()
+        with self._lock:
+            loading = self._loading.setdefault(model, threading.Lock())
+        with loading:
+            with self._lock:
+                deadline = self._loaded.get(model)
+                loaded = deadline is not None and deadline > time.monotonic()
+            if not loaded:
+                time.sleep(self.profile(model)[2] / self.speed)
+            with self._lock:
+                self._loaded[model] = time.monotonic() + keep_alive
+        return time.monotonic() - start
+
+    def touch(self, model: str, keep_alive: float):
+        with self._lock:
+            if keep_alive <= 0:
+                self._loaded.pop(model, None)
+            else:
+                self._loaded[model] = time.monotonic() + keep_alive
+
+    def running(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {"name": model, "model": model, "size": 0, "expires_at": _now(), "ttl": deadline - now}
+                for model, deadline in self._loaded.items() if deadline > now
+            ]
+
+    def generate(self, model: str, options: dict, keep_alive: float):
+        """Yield (piece, stats) pairs with the timing of the model's profile"""
+        rate, first_token, _ = self.profile(model)
+        count = min(self.tokens, int(options.get("num_predict") or self.tokens))
+        with self.slot(model):
+            start = time.monotonic()
+            load = self.ensure_loaded(model, keep_alive)
+            time.sleep(first_token / self.speed)
+            prompt_done = time.monotonic()
+            words = itertools.cycle(WORDS)
+            for _ in range(count):
+                time.sleep(1 / (rate * self.speed))
+                yield next(words), None
+            end = time.monotonic()
+        self.touch(model, keep_alive)
+        yield "", {
+            "done": True,
+            "done_reason": "length" if count == options.get("num_predict") else "stop",
+            "total_duration": int((end - start) * 1e9),
+            "load_duration": int(load * 1e9),
+            "prompt_eval_count": 32,
+            "prompt_eval_duration": int((prompt_done - start - load) * 1e9),
+            "eval_count": count,
+            "eval_duration": int((end - prompt_done) * 1e9)
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: FakeOllama = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, payload: dict):
+        line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [
+                {"name": model, "model": model, "modified_at": _now(), "size": 0, "digest": ""}
+                for model in list(self.state.profiles) + list(EMBEDDING_MODELS)
+            ]})
+        elif self.path == "/api/ps":
+            self._send_json({"models": self.state.running()})
+        elif self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/api/embed":
+            self._embed(request)
+            return
+        if self.path != "/api/generate":
+            self._send_json({"error": "not found"}, 404)
+            return
+
+        model = request.get("model", "")
+        keep_alive = _parse_keep_alive(request.get("keep_alive"))
+        if not request.get("prompt"):
+            # An empty prompt only loads or unloads the model
+            if keep_alive > 0:
+                self.state.ensure_loaded(model, keep_alive)
+            else:
+                self.state.touch(model, 0)
+            self._send_json({"model": model, "created_at": _now(), "response": "", "done": True})
+            return
+
+        pieces = self.state.generate(model, request.get("options") or {}, keep_alive)
+        if request.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for piece, stats in pieces:
+                    self._write_chunk({"model": model, "created_at": _now(), "response": piece, "done": False, **(stats or {})})
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pieces.close()
+                self.close_connection = True
+        else:
+            text = []
+            for piece, stats in pieces:
+                if self._client_gone():
+                    pieces.close()
+                    return
+                text.append(piece)
+            self._send_json({"model": model, "created_at": _now(), "response": "".join(text), **stats})
+
+    def _client_gone(self) -> bool:
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+
+    def _embed(self, request: dict):
+        model = request.get("model", "")
+        if model not in EMBEDDING_MODELS:
+            self._send_json({"error": f"model \"{model}\" not found"}, 404)
+            return
+        dim, seconds = EMBEDDING_MODELS[model]
+        inputs = request.get("input") or ""
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        time.sleep(seconds / self.state.speed)
+        self._send_json({"model": model, "embeddings": [embed(text, dim) for text in inputs]})
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections when a burst of requests
+    # arrives, which shows up as one second SYN retransmit stalls
+    request_queue_size = 256
+
+def parse_profiles(overrides) -> dict:
+    profiles = dict(DEFAULT_PROFILES)
+    for item in overrides or ():
+        model, _, spec = item.rpartition("=")
+        rate, first_token, load = (float(v) for v in spec.split(":"))
+        profiles[model] = (rate, first_token, load)
+    return profiles
+
+def serve(host: str = "127.0.0.1", port: int = 11435, profiles: dict = None, parallel: int = 1, tokens: int = 64, speed: float = 1.0) -> ThreadingHTTPServer:
+    """Start the server on a background thread and return it"""
+    state = FakeOllama(profiles or dict(DEFAULT_PROFILES), parallel, tokens, speed)
+    server = Server((host, port), type("BoundHandler", (Handler,), {"state": state}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--parallel", type=int, default=1, help="Requests decoded at once per model (OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens per response, capped by num_predict")
+    parser.add_argument("--speed", type=float, default=1.0, help="Divide every delay by this factor")
+    parser.add_argument("--model", action="append", metavar="NAME=RATE:FIRST_TOKEN:LOAD",
+                        help="Override the timing profile of a model")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, parse_profiles(args.model), args.parallel, args.tokens, args.speed)
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
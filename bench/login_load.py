@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Login burst benchmark.
+
+Hammers POST /token with concurrent logins while a probe loop keeps calling
+an authenticated endpoint, then reports login throughput and the latency the
+probe saw. Before bcrypt was moved off the event loop, every login stalled
+the probe for the full hash time.
+
+Usage:
+    uvicorn app.main:app --port 8000
+    python bench/login_load.py --base-url http://localhost:8000 --concurrency 16 --duration 20
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }
+
+async def login_worker(client, email, password, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        response = await client.post("/token", data={"username": email, "password": password})
+        latencies.append(time.monotonic() - start)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+async def probe_worker(client, headers, path, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        response = await client.get(path, headers=headers)
+        latencies.append(time.monotonic() - start)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+        await asyncio.sleep(0.01)
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        password = "bench-password"
+        response = await client.post("/register", json={"email": email, "password": password})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        # Probe latency without any login load as the baseline
+        baseline, baseline_errors = [], []
+        await probe_worker(client, headers, args.probe_path, time.monotonic() + 2, baseline, baseline_errors)
+
+        login_latencies, login_errors = [], []
+        probe_latencies, probe_errors = [], []
+        start = time.monotonic()
+        deadline = start + args.duration
+        await asyncio.gather(
+            probe_worker(client, headers, args.probe_path, deadline, probe_latencies, probe_errors),
+            *[
+                login_worker(client, email, password, deadline, login_latencies, login_errors)
+                for _ in range(args.concurrency)
+            ]
+        )
+        elapsed = time.monotonic() - start
+
+    return {
+        "concurrency": args.concurrency,
+        "duration": elapsed,
+        "login": summarize(login_latencies, len(login_errors), elapsed),
+        "probe_idle": summarize(baseline, len(baseline_errors), 2),
+        "probe_under_load": summarize(probe_latencies, len(probe_errors), elapsed)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--probe-path", default="/users/me")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Semantic cache benchmark.
+
+Indexes the prompts of a synthetic catalogue and then looks up four kinds
+of variants of them:
+
+    whitespace  the same prompt with extra spaces and line breaks
+    reordered   the same specs in a different order
+    attribute   one numeric attribute value changed (a likely false positive)
+    unrelated   a product that was never indexed
+
+For each kind it reports the share of lookups that would hit at several
+similarity thresholds, plus the time to embed a prompt and to search
+indexes of growing size. Runs in-process against a scratch SQLite
+database; ``--embedder ollama`` embeds through OLLAMA_HOSTS (a real Ollama
+or bench/fake_ollama.py) instead of the hashing stand-in.
+
+Usage:
+    python bench/semantic_cache.py --products 500
+    python bench/semantic_cache.py --embedder ollama --sizes 1000,16384,65536
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_directory = tempfile.mkdtemp(prefix="semantic-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_directory, 'bench.db')}")
+
+import numpy as np  # noqa: E402
+
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.models import Generation, User  # noqa: E402
+from app.semantic_cache import (  # noqa: E402
+    SEMANTIC_CACHE_HASHING_DIM, SEMANTIC_CACHE_MODEL, HashingEmbedder, OllamaEmbedder, SemanticCache, VectorIndex
+)
+
+PRODUCTS = ("наушники", "смартфон", "ноутбук", "пылесос", "кофеварка", "чайник", "монитор", "колонка")
+BRANDS = ("Sony", "Xiaomi", "Philips", "Bosch", "Samsung", "JBL", "Lenovo", "Tefal")
+SPECS = (
+    ("аккумулятор", "мАч"), ("вес", "г"), ("мощность", "Вт"), ("гарантия", "мес"),
+    ("диагональ", "дюймов"), ("объём", "л"), ("память", "ГБ"), ("автономность", "ч")
+)
+KINDS = ("whitespace", "reordered", "attribute", "unrelated")
+
+def product(rng: random.Random) -> tuple:
+    specs = [(name, rng.randint(2, 500), unit) for name, unit in rng.sample(SPECS, 4)]
+    return f"{rng.choice(PRODUCTS)} {rng.choice(BRANDS)} {rng.randint(10, 999)}", specs
+
+def render(title: str, specs: list, sep: str = ", ") -> str:
+    return title + ": " + sep.join(f"{name} {value} {unit}" for name, value, unit in specs)
+
+def variant(kind: str, item: tuple, rng: random.Random) -> str:
+    title, specs = item
+    if kind == "whitespace":
+        return "  " + render(title, specs, ",\n  ") + " "
+    if kind == "reordered":
+        specs = list(specs)
+        while specs == item[1]:
+            rng.shuffle(specs)
+        return render(title, specs)
+    if kind == "attribute":
+        specs = list(specs)
+        i = rng.randrange(len(specs))
+        name, value, unit = specs[i]
+        specs[i] = (name, value + rng.randint(1, 50), unit)
+        return render(title, specs)
+    return render(*product(rng))
+
+async def similarities(cache: SemanticCache, args) -> dict:
+    rng = random.Random(args.seed)
+    items = [product(rng) for _ in range(args.products)]
+    with SessionLocal() as db:
+        user = User(email="bench@example.com", hashed_password="x", balance_minor=0)
+        db.add(user)
+        db.commit()
+        generations = [
+            Generation(user_id=user.id, prompt=render(*item), result="описание", tariff="pro",
+                       cost_minor=400, tokens_used=300, processing_time=4.0)
+            for item in items
+        ]
+        db.add_all(generations)
+        db.commit()
+        ids = [g.id for g in generations]
+
+    start = time.perf_counter()
+    for item, generation_id in zip(items, ids):
+        await cache.add(render(*item), "pro", generation_id)
+    embed_seconds = (time.perf_counter() - start) / len(items)
+
+    index = cache._indexes["pro"]
+    scores = {}
+    for kind in KINDS:
+        values = []
+        for item in items[:args.lookups]:
+            vector = await cache._embed(variant(kind, item, rng))
+            values.append(index.search(vector)[1])
+        scores[kind] = values
+    return {"embed_us": embed_seconds * 1e6, "scores": scores}
+
+def search_latency(dim: int, sizes: list, repeat: int) -> dict:
+    results = {}
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        index = VectorIndex(os.path.join(_directory, f"latency-{size}"), dim, size)
+        vectors = rng.standard_normal((size, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index.vectors[:] = vectors
+        index.ids[:] = np.arange(1, size + 1)
+        index.size = size
+        query = vectors[0]
+        index.search(query)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            index.search(query)
+        results[size] = {"search_us": (time.perf_counter() - start) / repeat * 1e6}
+    return results
+
+async def run(args) -> dict:
+    Base.metadata.create_all(bind=engine)
+    embedder = OllamaEmbedder(args.model) if args.embedder == "ollama" else HashingEmbedder(args.dim)
+    cache = SemanticCache(embedder, os.path.join(_directory, "index"), 1.0, max(args.products, 1), 0.0, 0)
+    result = await similarities(cache, args)
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+    dim = next(iter(cache._indexes.values())).dim
+    return {
+        "embedder": embedder.name,
+        "dim": dim,
+        "products": args.products,
+        "embed_us": result["embed_us"],
+        "hit_rate": {
+            kind: {str(t): sum(s >= t for s in values) / len(values) for t in thresholds}
+            for kind, values in result["scores"].items()
+        },
+        "similarity_p50": {kind: float(np.median(values)) for kind, values in result["scores"].items()},
+        "search": search_latency(dim, [int(s) for s in args.sizes.split(",")], args.repeat)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=500, help="Prompts indexed before the lookups")
+    parser.add_argument("--lookups", type=int, default=200, help="Variants looked up per kind")
+    parser.add_argument("--thresholds", default="0.85,0.9,0.93,0.95,0.97,0.99")
+    parser.add_argument("--embedder", choices=("hashing", "ollama"), default="hashing")
+    parser.add_argument("--model", default=SEMANTIC_CACHE_MODEL, help="Embedding model for --embedder ollama")
+    parser.add_argument("--dim", type=int, default=SEMANTIC_CACHE_HASHING_DIM, help="Dimensions of the hashing embedder")
+    parser.add_argument("--sizes", default="1000,16384,65536", help="Index sizes to time searches on")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Response serialization micro-benchmark.
+
+Builds two small FastAPI apps with the same /history-style (response_model)
+and /models/stats-style (plain dict) routes and calls them in-process over
+ASGI, without a socket or HTTP client in the way:
+
+    before  default_response_class=JSONResponse plus the old charset
+            BaseHTTPMiddleware, no compression
+    after   the app's setup: Default(UTF8JSONResponse) and
+            CompressionMiddleware
+
+The "after" app is measured with and without Accept-Encoding. The encoders
+themselves (json, orjson, Pydantic's dump_json) are timed on the same
+payload as well.
+
+Usage:
+    python bench/serialization.py --rows 50 --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.datastructures import Default  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+from app import compression  # noqa: E402
+from app.compression import CompressionMiddleware  # noqa: E402
+from app.responses import UTF8JSONResponse, orjson  # noqa: E402
+from app.schemas import GenerationHistory, HistoryResponse  # noqa: E402
+
+WORDS = (
+    "Беспроводные наушники с активным шумоподавлением и автономностью до 30 часов. "
+    "Мягкие амбушюры, быстрая зарядка и кристально чистый звук для работы и отдыха."
+).split()
+
+def result_text(n: int) -> str:
+    """About 1.5 KB of Russian text that differs between rows, like real results"""
+    rng = random.Random(n)
+    return " ".join(rng.choice(WORDS) for _ in range(130))
+
+def history_payload(rows: int) -> HistoryResponse:
+    return HistoryResponse(
+        generations=[GenerationHistory(
+            id=n,
+            prompt=f"Наушники, модель {n}, 30 ч работы",
+            result=result_text(n),
+            tariff="pro",
+            cost=4.0,
+            created_at=datetime(2024, 5, 1, 12, 0, n % 60),
+            processing_time=3.2,
+            model="gemma3:4b",
+            tokens_used=420,
+            prompt_tokens=64,
+            tokens_per_second=14.7
+        ) for n in range(rows)],
+        total_count=10_000,
+        page=1,
+        page_size=rows,
+        next_cursor=rows
+    )
+
+def stats_payload(rows: int) -> dict:
+    return {f"http://ollama-{n}:11434": {
+        "healthy": True,
+        "models": ["gemma3:1b", "gemma3:4b", "gemma3:12b"],
+        "outstanding": {"gemma3:4b": n % 3},
+        "failures": 0,
+        "last_error": None,
+        "last_check": 1714564800.0 + n
+    } for n in range(rows)}
+
+def build_app(after: bool, rows: int) -> FastAPI:
+    history = history_payload(rows)
+    stats = stats_payload(rows)
+    if after:
+        app = FastAPI(default_response_class=Default(UTF8JSONResponse))
+        app.add_middleware(CompressionMiddleware)
+    else:
+        app = FastAPI(default_response_class=JSONResponse)
+
+        @app.middleware("http")
+        async def add_encoding_header(request, call_next):
+            response = await call_next(request)
+            content_type = response.headers.get("Content-Type", "")
+            if content_type.startswith("application/json"):
+                response.headers["Content-Type"] = "application/json; charset=utf-8"
+            return response
+
+    @app.get("/history", response_model=HistoryResponse)
+    def get_history():
+        return history
+
+    @app.get("/stats")
+    def get_stats():
+        return stats
+
+    return app
+
+async def call(app, path: str, accept_encoding: str) -> int:
+    """Run one GET through the ASGI app and return the size of the body"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"bench"), (b"accept-encoding", accept_encoding.encode())],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80)
+    }
+    size = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal size
+        if message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return size
+
+async def measure(app, path: str, accept_encoding: str, requests: int) -> dict:
+    for _ in range(min(50, requests)):
+        await call(app, path, accept_encoding)
+    start = time.perf_counter()
+    for _ in range(requests):
+        size = await call(app, path, accept_encoding)
+    elapsed = time.perf_counter() - start
+    return {"us_per_request": elapsed / requests * 1e6, "requests_per_second": requests / elapsed, "bytes": size}
+
+def time_encoder(func, repeat: int) -> float:
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def encoders(rows: int, repeat: int) -> dict:
+    model = history_payload(rows)
+    data = model.model_dump(mode="json")
+    adapter = TypeAdapter(HistoryResponse)
+    results = {
+        "json.dumps": time_encoder(lambda: json.dumps(data, ensure_ascii=False).encode("utf-8"), repeat),
+        "pydantic.dump_json": time_encoder(lambda: adapter.dump_json(model), repeat),
+        "model_dump+json.dumps": time_encoder(lambda: json.dumps(model.model_dump(mode="json"), ensure_ascii=False).encode("utf-8"), repeat)
+    }
+    if orjson is not None:
+        results["orjson.dumps"] = time_encoder(lambda: orjson.dumps(data), repeat)
+    return {name: {"us_per_call": us} for name, us in results.items()}
+
+async def run(args) -> dict:
+    before, after = build_app(False, args.rows), build_app(True, args.rows)
+    results = {}
+    for path in ("/history", "/stats"):
+        results[path] = {
+            "before": await measure(before, path, "gzip, br", args.requests),
+            "after": await measure(after, path, "", args.requests),
+            "after_gzip": await measure(after, path, "gzip", args.requests)
+        }
+        if compression.brotli is not None:
+            results[path]["after_br"] = await measure(after, path, "br", args.requests)
+    return {"rows": args.rows, "routes": results, "encoders": encoders(args.rows, args.requests)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50, help="Generations per /history page and hosts in /stats")
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+Mixed workload benchmark.
+
+Starts bench/fake_ollama.py and ``uvicorn app.main:app`` on a throwaway
+SQLite database (unless --base-url points at a running server), then runs
+these scenarios one after another:
+
+    auth        register and login bursts
+    generate    /generate across tariffs with a weighted mix
+    history     paging through /history with next_cursor
+    analytics   /analytics and /analytics/series for a user with --heavy-rows
+                generations
+    export      /history/export of that user in every format, with the
+                server's RSS growth and /balance latency during the export
+    fairness    one user flooding /generate with --concurrency requests at
+                once while --polite-users users send one request at a time;
+                reports both sides' latency and the flooder's 429s
+
+Each scenario reports throughput, p50/p95/p99 latency and error rate. The
+JSON report records the git commit so runs can be compared with --compare.
+Everything runs offline on a CPU-only box.
+
+Usage:
+    python bench/workload.py --output before.json
+    python bench/workload.py --output after.json --compare before.json
+    python bench/workload.py --scenarios generate --concurrency 32 --ollama-speed 5
+    python bench/workload.py --scenarios generate --ollama-hosts 3
+    RATE_LIMIT_CONCURRENCY=0 python bench/workload.py --scenarios fairness
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("auth", "generate", "history", "analytics", "export", "fairness")
+TARIFF_MIX = {"standart": 6, "pro": 3, "premium": 1}
+PASSWORD = "bench-password"
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+class Recorder:
+    """Latencies and failures of one scenario"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self.start = time.monotonic()
+
+    async def call(self, request):
+        start = time.monotonic()
+        try:
+            response = await request
+        except httpx.HTTPError as e:
+            self.latencies.append(time.monotonic() - start)
+            self._error(type(e).__name__)
+            return None
+        self.latencies.append(time.monotonic() - start)
+        if response.status_code >= 400:
+            self._error(str(response.status_code))
+        return response
+
+    def _error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.start
+        requests = len(self.latencies)
+        errors = sum(self.errors.values())
+        return {
+            "requests": requests,
+            "duration": elapsed,
+            "throughput": requests / elapsed if elapsed else 0.0,
+            "error_rate": errors / requests if requests else 0.0,
+            "errors": self.errors,
+            "p50": percentile(self.latencies, 50),
+            "p95": percentile(self.latencies, 95),
+            "p99": percentile(self.latencies, 99),
+            "max": max(self.latencies, default=0.0)
+        }
+
+async def register(client, balance: float = 0) -> dict:
+    email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+    response = await client.post("/register", json={"email": email, "password": PASSWORD})
+    response.raise_for_status()
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    if balance:
+        (await client.post("/balance", params={"amount": balance}, headers=headers)).raise_for_status()
+    return {"email": email, "headers": headers}
+
+async def run_workers(concurrency: int, worker):
+    await asyncio.gather(*[worker(i) for i in range(concurrency)])
+
+async def scenario_auth(client, args) -> dict:
+    registrations, logins = Recorder(), Recorder()
+    emails = []
+
+    async def register_worker(_):
+        for _ in range(args.auth_users // args.auth_concurrency):
+            email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+            response = await registrations.call(client.post("/register", json={"email": email, "password": PASSWORD}))
+            if response is not None and response.status_code == 200:
+                emails.append(email)
+
+    async def login_worker(i):
+        for n in range(args.auth_logins // args.auth_concurrency):
+            email = emails[(i + n) % len(emails)]
+            await logins.call(client.post("/token", data={"username": email, "password": PASSWORD}))
+
+    await run_workers(args.auth_concurrency, register_worker)
+    if emails:
+        logins.start = time.monotonic()
+        await run_workers(args.auth_concurrency, login_worker)
+    return {"register": registrations.summary(), "login": logins.summary()}
+
+async def scenario_generate(client, args) -> dict:
+    users = [await register(client, balance=1_000_000) for _ in range(max(1, args.concurrency // 4))]
+    tariffs = random.Random(args.seed)
+    recorders = {tariff: Recorder() for tariff in TARIFF_MIX}
+    overall = Recorder()
+    deadline = time.monotonic() + args.duration
+
+    async def worker(i):
+        user = users[i % len(users)]
+        while time.monotonic() < deadline:
+            tariff = tariffs.choices(list(TARIFF_MIX), weights=list(TARIFF_MIX.values()))[0]
+            payload = {
+                "prompt": f"Product {uuid.uuid4().hex[:8]}: {args.prompt}",
+                "tariff": tariff,
+                "use_cache": args.use_cache
+            }
+            start = time.monotonic()
+            response = await overall.call(client.post("/generate", json=payload, headers=user["headers"]))
+            recorder = recorders[tariff]
+            recorder.latencies.append(time.monotonic() - start)
+            if response is None or response.status_code >= 400:
+                recorder._error("failed" if response is None else str(response.status_code))
+
+    await run_workers(args.concurrency, worker)
+    return {"overall": overall.summary(), **{tariff: r.summary() for tariff, r in recorders.items()}}
+
+async def scenario_fairness(client, args) -> dict:
+    flooder = await register(client, balance=1_000_000)
+    polite_users = [await register(client, balance=1_000_000) for _ in range(args.polite_users)]
+    flooding, polite = Recorder(), Recorder()
+    deadline = time.monotonic() + args.duration
+
+    def payload() -> dict:
+        return {"prompt": f"Product {uuid.uuid4().hex[:8]}: {args.prompt}", "tariff": "standart", "use_cache": False}
+
+    async def flood_worker(_):
+        while time.monotonic() < deadline:
+            response = await flooding.call(client.post("/generate", json=payload(), headers=flooder["headers"]))
+            if response is not None and response.status_code == 429:
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+    async def polite_worker(i):
+        while time.monotonic() < deadline:
+            await polite.call(client.post("/generate", json=payload(), headers=polite_users[i]["headers"]))
+            await asyncio.sleep(0.5)
+
+    await asyncio.gather(run_workers(args.concurrency, flood_worker), run_workers(args.polite_users, polite_worker))
+    return {"flooder": flooding.summary(), "polite": polite.summary()}
+
+def seed_heavy_user(database_url: str, email: str, rows: int):
+    """
+    Insert generations and balance entries for one user straight into the
+    database, then backfill the user's rollups as ``python -m app.migrate``
+    does for history that predates them
+    """
+    os.environ.setdefault("DATABASE_URL", database_url)
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from app import rollups
+    from app.models import BalanceHistory, Generation, User
+
+    engine = create_engine(database_url)
+    Session = sessionmaker(bind=engine)
+    rng = random.Random(rows)
+    now = datetime.now(timezone.utc)
+    with Session() as db:
+        user = db.query(User).filter(User.email == email).one()
+        generations, entries = [], []
+        for n in range(rows):
+            tariff = rng.choices(list(TARIFF_MIX), weights=list(TARIFF_MIX.values()))[0]
+            created_at = now - timedelta(minutes=rows - n)
+            generations.append({
+                "user_id": user.id, "prompt": f"Seed prompt {n}", "result": "Описание товара. " * 60,
+                "tariff": tariff, "cost_minor": 100, "tokens_used": 180, "processing_time": rng.uniform(0.5, 5),
+                "created_at": created_at
+            })
+            entries.append({
+                "user_id": user.id, "amount_minor": -100, "operation_type": "spend",
+                "description": f"Content generation using {tariff} model", "created_at": created_at
+            })
+        db.execute(Generation.__table__.insert(), generations)
+        db.execute(BalanceHistory.__table__.insert(), entries)
+        rollups.backfill(db, [user.id])
+        db.commit()
+    engine.dispose()
+
+async def heavy_user(client, args, state) -> dict:
+    if "heavy_user" not in state:
+        if not args.database_url:
+            raise SystemExit("--database-url is required to seed the heavy user when --base-url is given")
+        user = await register(client)
+        started = time.monotonic()
+        await asyncio.to_thread(seed_heavy_user, args.database_url, user["email"], args.heavy_rows)
+        user["seed_time"] = time.monotonic() - started
+        state["heavy_user"] = user
+    return state["heavy_user"]
+
+async def scenario_history(client, args, state) -> dict:
+    user = await heavy_user(client, args, state)
+    first_pages, deep_pages, previews = Recorder(), Recorder(), Recorder()
+    deadline = time.monotonic() + args.duration
+
+    async def worker(_):
+        while time.monotonic() < deadline:
+            response = await first_pages.call(client.get("/history", params={"page_size": 20}, headers=user["headers"]))
+            for _ in range(args.history_depth):
+                if response is None or response.status_code != 200 or not response.json()["next_cursor"]:
+                    break
+                response = await deep_pages.call(client.get(
+                    "/history", params={"page_size": 20, "cursor": response.json()["next_cursor"]}, headers=user["headers"]
+                ))
+            await previews.call(client.get("/history", params={"page_size": 50, "preview": "true"}, headers=user["headers"]))
+
+    await run_workers(args.concurrency, worker)
+    return {"first_page": first_pages.summary(), "cursor_pages": deep_pages.summary(), "preview": previews.summary()}
+
+async def scenario_analytics(client, args, state) -> dict:
+    user = await heavy_user(client, args, state)
+    recorder = Recorder()
+    series = {period: Recorder() for period in ("day", "week", "month")}
+    sizes = {}
+    deadline = time.monotonic() + args.duration
+
+    async def worker(i):
+        while time.monotonic() < deadline:
+            await recorder.call(client.get("/analytics", headers=user["headers"]))
+            period = list(series)[i % len(series)]
+            response = await series[period].call(client.get(
+                "/analytics/series", params={"period": period, "limit": 1000}, headers=user["headers"]
+            ))
+            if response is not None and response.status_code == 200:
+                sizes[period] = len(response.content)
+
+    await run_workers(args.concurrency, worker)
+    return {
+        "analytics": recorder.summary(),
+        **{f"series_{period}": {**r.summary(), "bytes": sizes.get(period, 0)} for period, r in series.items()},
+        "rows": args.heavy_rows,
+        "seed_time": user["seed_time"]
+    }
+
+def rss_mb(pid) -> float:
+    """
+    Anonymous resident memory of a local process, 0 when it cannot be read.
+
+    File-backed pages are left out: SQLite's mmap makes them grow with every
+    page read, which says nothing about what the process allocates.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, TypeError):
+        pass
+    return 0.0
+
+async def scenario_export(client, args, state) -> dict:
+    user = await heavy_user(client, args, state)
+    probe = Recorder()
+    results = {}
+    for name, params in (
+        ("ndjson", {"format": "ndjson"}),
+        ("csv", {"format": "csv"}),
+        ("ndjson_gzip", {"format": "ndjson", "gzip": "true"})
+    ):
+        done = asyncio.Event()
+
+        async def probe_worker():
+            # Another user's cheap request, to see whether the export blocks the worker
+            while not done.is_set():
+                await probe.call(client.get("/balance", headers=user["headers"]))
+                await asyncio.sleep(0.01)
+
+        probe_task = asyncio.ensure_future(probe_worker())
+        baseline = peak = rss_mb(args.app_pid)
+        size = 0
+        start = time.monotonic()
+        async with client.stream("GET", "/history/export", params=params, headers=user["headers"]) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+                peak = max(peak, rss_mb(args.app_pid))
+        elapsed = time.monotonic() - start
+        done.set()
+        await probe_task
+        results[name] = {
+            "rows": args.heavy_rows,
+            "bytes": size,
+            "seconds": elapsed,
+            "rows_per_second": args.heavy_rows / elapsed if elapsed else 0.0,
+            "rss_growth_mb": peak - baseline
+        }
+    return {**results, "probe": probe.summary()}
+
+def start_servers(args) -> list:
+    """Migrate the database, start the fake Ollama hosts and the app, returning the processes"""
+    subprocess.run(
+        [sys.executable, "-m", "app.migrate"], cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+        env=dict(os.environ, DATABASE_URL=args.database_url)
+    )
+    ollama_ports = [args.ollama_port + i for i in range(args.ollama_hosts)]
+    fakes = [
+        subprocess.Popen([
+            sys.executable, os.path.join(ROOT, "bench", "fake_ollama.py"), "--port", str(port),
+            "--speed", str(args.ollama_speed), "--parallel", str(args.ollama_parallel), "--tokens", str(args.tokens)
+        ])
+        for port in ollama_ports
+    ]
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database_url,
+        OLLAMA_HOSTS=",".join(f"http://127.0.0.1:{port}" for port in ollama_ports),
+        LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING")
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=ROOT, env=env
+    )
+    return fakes + [app]
+
+async def wait_ready(client, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/readyz")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("Server did not become ready")
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency + args.auth_concurrency + args.polite_users + 8)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        await wait_ready(client)
+        state, results = {}, {}
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr, flush=True)
+            if name == "auth":
+                results[name] = await scenario_auth(client, args)
+            elif name == "generate":
+                results[name] = await scenario_generate(client, args)
+            elif name == "history":
+                results[name] = await scenario_history(client, args, state)
+            elif name == "analytics":
+                results[name] = await scenario_analytics(client, args, state)
+            elif name == "export":
+                results[name] = await scenario_export(client, args, state)
+            elif name == "fairness":
+                results[name] = await scenario_fairness(client, args)
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "app_pid")},
+        "server_settings": {k: v for k, v in os.environ.items() if k.startswith(("RATE_LIMIT_", "SCHEDULER_", "GENERATION_"))},
+        "scenarios": results
+    }
+
+def compare(report: dict, baseline: dict):
+    """Print the relative change of throughput and latency percentiles"""
+    print(f"\n{'metric':<40} {baseline['commit']:>10} {report['commit']:>10} {'change':>8}")
+
+    def walk(current, previous, path):
+        for key, value in current.items():
+            old = previous.get(key) if isinstance(previous, dict) else None
+            if isinstance(value, dict) and "p50" in value and isinstance(old, dict):
+                for metric in ("throughput", "p50", "p95", "p99", "error_rate"):
+                    before, after = old.get(metric, 0.0), value[metric]
+                    change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+                    print(f"{path + key + '.' + metric:<40} {before:>10.4f} {after:>10.4f} {change:>8}")
+            elif isinstance(value, dict):
+                walk(value, old or {}, path + key + ".")
+
+    walk(report["scenarios"], baseline["scenarios"], "")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="Benchmark a running server instead of starting one")
+    parser.add_argument("--database-url", help="Database of the server, used to seed the heavy user")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--ollama-port", type=int, default=11435, help="Port of the first fake Ollama host")
+    parser.add_argument("--ollama-hosts", type=int, default=1, help="Fake Ollama hosts on consecutive ports")
+    parser.add_argument("--ollama-speed", type=float, default=1.0, help="Speed-up factor of the fake Ollama timings")
+    parser.add_argument("--ollama-parallel", type=int, default=2)
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens per fake generation")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per timed scenario")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--auth-users", type=int, default=64)
+    parser.add_argument("--auth-logins", type=int, default=256)
+    parser.add_argument("--auth-concurrency", type=int, default=16)
+    parser.add_argument("--polite-users", type=int, default=4, help="Users sharing the backend with the flooder in the fairness scenario")
+    parser.add_argument("--heavy-rows", type=int, default=10_000)
+    parser.add_argument("--history-depth", type=int, default=5, help="Cursor pages followed after the first page")
+    parser.add_argument("--prompt", default="wireless headphones, 30h battery, noise cancelling")
+    parser.add_argument("--use-cache", action="store_true", help="Let /generate use the result cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    args = parser.parse_args()
+
+    processes = []
+    args.app_pid = None
+    workdir = tempfile.mkdtemp(prefix="workload-bench-")
+    if args.base_url is None:
+        args.base_url = f"http://127.0.0.1:{args.port}"
+        args.database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        processes = start_servers(args)
+        args.app_pid = processes[-1].pid
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
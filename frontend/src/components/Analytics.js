@@ -16,6 +16,10 @@ import {
   Card,
   CardContent,
   Divider,
+  FormControl,
+  InputLabel,
+  Select,
+  MenuItem,
 } from '@mui/material';
 import {
   BarChart,
@@ -32,17 +36,38 @@ import {
 } from 'recharts';
 
 const COLORS = ['#0088FE', '#00C49F', '#FFBB28', '#FF8042'];
+const TARIFFS = ['standart', 'pro', 'premium'];
+const PERIODS = [
+  { value: 'day', label: 'Daily', limit: 30 },
+  { value: 'week', label: 'Weekly', limit: 26 },
+  { value: 'month', label: 'Monthly', limit: 12 },
+];
 
 const Analytics = () => {
   const { api } = useAuth();
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
   const [analytics, setAnalytics] = useState(null);
+  const [period, setPeriod] = useState('day');
+  const [series, setSeries] = useState([]);
 
   useEffect(() => {
     fetchAnalytics();
   }, []);
 
+  useEffect(() => {
+    const fetchSeries = async () => {
+      try {
+        const { limit } = PERIODS.find((p) => p.value === period);
+        const response = await api.get('/analytics/series', { params: { period, limit } });
+        setSeries(response.data.buckets);
+      } catch (error) {
+        console.error('Error fetching analytics series:', error);
+      }
+    };
+    fetchSeries();
+  }, [api, period]);
+
   const fetchAnalytics = async () => {
     try {
       setLoading(true);
@@ -91,6 +116,12 @@ const Analytics = () => {
     { name: 'Added', value: user_stats.balance.total_added },
   ];
 
+  // One row per bucket with a generation count per tariff, as the stacked bars expect
+  const seriesData = series.map((bucket) => ({
+    name: bucket.start,
+    ...Object.fromEntries(TARIFFS.map((t) => [t, bucket.by_tariff[t]?.generations || 0])),
+  }));
+
   return (
     <Container maxWidth="lg" sx={{ mt: 4, mb: 4 }}>
       <Typography variant="h4" gutterBottom>
@@ -194,6 +225,38 @@ const Analytics = () => {
           </Paper>
         </Grid>
 
+        <Grid item xs={12}>
+          <Paper sx={{ p: 2 }}>
+            <Box display="flex" justifyContent="space-between" alignItems="center">
+              <Typography variant="h6" gutterBottom>
+                Generations over Time
+              </Typography>
+              <FormControl size="small" sx={{ minWidth: 140 }}>
+                <InputLabel>Period</InputLabel>
+                <Select value={period} label="Period" onChange={(e) => setPeriod(e.target.value)}>
+                  {PERIODS.map((p) => (
+                    <MenuItem key={p.value} value={p.value}>
+                      {p.label}
+                    </MenuItem>
+                  ))}
+                </Select>
+              </FormControl>
+            </Box>
+            <ResponsiveContainer width="100%" height={300}>
+              <BarChart data={seriesData}>
+                <CartesianGrid strokeDasharray="3 3" />
+                <XAxis dataKey="name" />
+                <YAxis allowDecimals={false} />
+                <Tooltip />
+                <Legend />
+                {TARIFFS.map((t, index) => (
+                  <Bar key={t} dataKey={t} stackId="tariff" fill={COLORS[index % COLORS.length]} />
+                ))}
+              </BarChart>
+            </ResponsiveContainer>
+          </Paper>
+        </Grid>
+
         {/* Recent Activity */}
         <Grid item xs={12} md={6}>
           <Paper sx={{ p: 2 }}>